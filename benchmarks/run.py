@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Runs the benchmark suite and keeps the results
+
+Results are written to benchmarks/results/, and compared with
+benchmarks/baseline.json when it exists.
+"""
+
+
+import os
+import platform
+import time
+
+import gpwm.bench
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    results_dir = os.path.join(BENCHMARKS_DIR, "results")
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    output = os.path.join(results_dir, "{}-py{}.json".format(
+        time.strftime("%Y%m%d%H%M%S"),
+        platform.python_version()
+    ))
+    baseline = os.path.join(BENCHMARKS_DIR, "baseline.json")
+    gpwm.bench.bench(
+        output=output,
+        baseline=baseline if os.path.exists(baseline) else None
+    )
+    print("Results written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
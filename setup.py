@@ -42,8 +42,10 @@ config = {
     "url": "https://github.com/tiadobatima/gpwm",
     "packages": find_packages("src"),
     "package_dir": {'': 'src'},
+    # the asyncio API (gpwm.aio and the async stack methods)
+    "python_requires": ">=3.7",
     "entry_points": {
-        "console_scripts": ["gpwm=gpwm.cli:main"]
+        "console_scripts": ["gpwm=gpwm.client:main"]
     },
     "setup_requires": ["pytest-runner"],
     "install_requires": get_install_requirements(),
@@ -0,0 +1,130 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" asyncio support
+
+Stacks have awaitable counterparts of their actions (async_create(),
+async_update(), async_upsert(), async_delete() and async_wait()), so a single
+thread can drive many deployments at once: waiting is done with asyncio
+sleeps, not with a blocked thread per stack.
+
+The provider SDKs are blocking, so their calls are offloaded to a shared
+thread pool, and the number of calls in flight is limited per provider and
+region (or project).
+
+Usage:
+    stacks = [gpwm.stacks.factory(**attributes) for attributes in ...]
+    asyncio.run(gpwm.aio.execute(stacks, "upsert", wait=True))
+"""
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import random
+import threading
+import weakref
+
+
+# Threads running blocking provider SDK calls, shared by all stacks
+ASYNC_WORKERS = int(os.getenv("GPWM_ASYNC_WORKERS", 64))
+
+# Maximum number of provider API calls in flight per provider and region
+# (AWS) or project (GCP)
+PROVIDER_CONCURRENCY = int(os.getenv("GPWM_PROVIDER_CONCURRENCY", 10))
+
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+# Semaphores keyed by limiter key, per event loop (semaphores can't be
+# shared across loops)
+LIMITERS = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    """ Returns the (lazily created) thread pool for blocking calls
+    """
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+        return EXECUTOR
+
+
+def get_limiter(key):
+    """ Returns the semaphore limiting the calls made under a key
+
+    Args:
+        key(tuple): Identifies what's limited, eg ("aws", "us-east-1") or
+            ("gcp", "my-project")
+    """
+    limiters = LIMITERS.setdefault(asyncio.get_running_loop(), {})
+    if key not in limiters:
+        limiters[key] = asyncio.Semaphore(PROVIDER_CONCURRENCY)
+    return limiters[key]
+
+
+async def call(key, func, *args, **kwargs):
+    """ Runs a blocking function in the thread pool
+
+    Args:
+        key(tuple): The limiter key (see get_limiter()). None for calls
+            that don't hit any provider, which are not limited
+        func(callable): The blocking function
+        args, kwargs: The function arguments
+
+    Returns: What the function returns
+    """
+    loop = asyncio.get_running_loop()
+    partial = functools.partial(func, *args, **kwargs)
+    if key is None:
+        return await loop.run_in_executor(get_executor(), partial)
+    async with get_limiter(key):
+        return await loop.run_in_executor(get_executor(), partial)
+
+
+async def sleep_with_jitter(delay):
+    """ Sleeps for a random time between half and the full delay
+
+    The asyncio counterpart of gpwm.utils.sleep_with_jitter().
+    """
+    await asyncio.sleep(random.uniform(delay / 2.0, delay))
+
+
+async def execute(stacks, action, **kwargs):
+    """ Executes an action on many stacks concurrently
+
+    Args:
+        stacks(list): Stack objects
+        action(str): "create", "update", "upsert" or "delete"
+        kwargs: The action arguments, eg wait=True
+
+    Returns: A list with the result of every stack, in order. Failures are
+        returned as exceptions rather than raised, so a failing stack
+        doesn't abandon the others mid-operation
+    """
+    async def capture(stack):
+        # stacks fail with SystemExit, which asyncio would propagate out of
+        # the event loop
+        try:
+            return await getattr(stack, "async_" + action)(**kwargs)
+        except SystemExit as exc:
+            return exc
+
+    return await asyncio.gather(
+        *(capture(s) for s in stacks),
+        return_exceptions=True
+    )
@@ -0,0 +1,416 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Multi-stack execution engine
+
+Renders many stack files, figures out the dependencies between them from
+their stack references (!Cloudformation, !GCPDM, get_stack_output(),
+get_stack_resource(), get_export_value() and Fn::ImportValue), and executes
+an action on all of them in topological waves. Stacks in the same wave don't
+depend on each other, so they are executed in parallel.
+"""
+
+
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import glob
+import logging
+import os
+
+import gpwm.metrics
+import gpwm.stacks
+import gpwm.utils
+
+
+APPLY_ACTIONS = ["create", "update", "upsert", "delete"]
+
+
+class StackFile(object):
+    """ A stack file taking part in a multi-stack execution
+
+    Attributes:
+        path(str): The path to the stack file
+        templating_engine(str): The templating engine for the stack file
+        reference(tuple): The (provider, name) other stacks use to reference
+            this stack, or None if the stack can't be referenced (eg shell
+            stacks)
+        dependencies(set): The (provider, name) of the stacks referenced by
+            this stack, and ("export", name) for the exports it imports
+        exports(set): The names of the Cloudformation exports of this stack
+        upstream(set): The StackFile objects this stack depends on (see
+            build_waves())
+        stack(object): The stack object rendered while discovering
+            dependencies, if it can be executed as is
+    """
+    def __init__(self, path):
+        self.path = path
+        self.templating_engine = gpwm.utils.get_templating_engine(path)
+        self.reference = None
+        self.dependencies = set()
+        self.exports = set()
+        self.upstream = set()
+        self.stack = None
+
+    def __repr__(self):
+        return "StackFile({})".format(self.path)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def load(self, build_id):
+        """ Renders the stack file and returns the stack object
+        """
+        stack_attributes = gpwm.utils.render_stack(
+            self.read(),
+            self.templating_engine,
+            build_id
+        )
+        return gpwm.stacks.factory(**stack_attributes)
+
+
+def find_stack_files(paths):
+    """ Finds all stack files in the given directories or glob patterns
+
+    Args:
+        paths(list): Directories (searched recursively), glob patterns or
+            paths to stack files
+
+    Returns: A sorted list of paths to stack files
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                found.update(os.path.join(root, f) for f in files)
+        else:
+            found.update(glob.glob(path, recursive=True))
+    return sorted(
+        f for f in found
+        if os.path.isfile(f) and gpwm.utils.get_templating_engine(f)
+    )
+
+
+def get_stack_reference(stack):
+    """ Returns the (provider, name) used to reference a stack object
+    """
+    if hasattr(stack, "StackName"):
+        return ("cloudformation", stack.StackName)
+    elif hasattr(stack, "project") and hasattr(stack, "name"):
+        return ("gcp", stack.name)
+    return None
+
+
+def get_stack_exports(stack):
+    """ Returns the names of the exports of a stack object
+
+    Only export names that are plain strings once rendered are found, eg not
+    the ones built with intrinsic functions.
+    """
+    template = getattr(stack, "_template", None) or {}
+    exports = set()
+    for output in template.get("Outputs", {}).values():
+        name = output.get("Export", {}).get("Name")
+        if isinstance(name, str):
+            exports.add(name)
+    return exports
+
+
+def get_stack_imports(stack):
+    """ Returns the names of the exports imported by a stack object
+
+    Finds the Fn::ImportValue functions of the template whose export name is
+    a plain string once rendered, as the ones built with intrinsic functions
+    can't be known before the stack is created.
+    """
+    imports = set()
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "Fn::ImportValue" and isinstance(value, str):
+                    imports.add(value)
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(getattr(stack, "_template", None) or {})
+    return imports
+
+
+@contextlib.contextmanager
+def recording_stack_references(references):
+    """ Records stack references instead of resolving them
+
+    While active, get_stack_output() and get_stack_resource() (and therefore
+    the !Cloudformation and !GCPDM yaml tags) don't call the provider APIs,
+    they only add the (provider, name) of the referenced stack to the
+    references set and return an empty string. get_export_value() adds
+    ("export", name), as exports are tied to a stack by their name only.
+
+    Not thread safe: only meant to be used while discovering dependencies.
+    """
+    original_get_stack_output = gpwm.utils.get_stack_output
+    original_get_stack_resource = gpwm.utils.get_stack_resource
+    original_get_export_value = gpwm.utils.get_export_value
+
+    def get_stack_output(
+            stack_name,
+            output_key,
+            provider="cloudformation",
+            **kwargs):
+        references.add((provider, stack_name))
+        return ""
+
+    def get_stack_resource(stack_name, resource_id):
+        references.add(("cloudformation", stack_name))
+        return ""
+
+    def get_export_value(export_name):
+        references.add(("export", export_name))
+        return ""
+
+    gpwm.utils.get_stack_output = get_stack_output
+    gpwm.utils.get_stack_resource = get_stack_resource
+    gpwm.utils.get_export_value = get_export_value
+    try:
+        yield references
+    finally:
+        gpwm.utils.get_stack_output = original_get_stack_output
+        gpwm.utils.get_stack_resource = original_get_stack_resource
+        gpwm.utils.get_export_value = original_get_export_value
+
+
+def discover_dependencies(stack_files, build_id):
+    """ Renders every stack file to find out what stacks it references
+
+    Stack references are recorded instead of being resolved, so stacks can be
+    rendered before the stacks they depend on exist. Stacks without any
+    reference are rendered exactly as they would be when executed, so their
+    stack object is kept for the execution.
+    """
+    for stack_file in stack_files:
+        logging.debug("Discovering dependencies of %s", stack_file.path)
+        references = set()
+        with recording_stack_references(references):
+            stack = stack_file.load(build_id)
+        stack_file.reference = get_stack_reference(stack)
+        stack_file.exports = get_stack_exports(stack)
+        stack_file.dependencies = (
+            references | {("export", i) for i in get_stack_imports(stack)}
+        ) - {stack_file.reference}
+        # imports are resolved by Cloudformation, not while rendering
+        if not references:
+            stack_file.stack = stack
+
+
+def build_waves(stack_files):
+    """ Sorts the stack files in topological waves
+
+    Stacks in a wave only depend on stacks of previous waves. References to
+    stacks (or exports) that aren't part of the execution are assumed to
+    already exist. Sets the upstream attribute of every stack file.
+
+    Returns: A list of waves, each a list of StackFile objects
+    """
+    by_reference = {}
+    for stack_file in stack_files:
+        if stack_file.reference is None:
+            continue
+        if stack_file.reference in by_reference:
+            raise SystemExit("Stack {} defined in both {} and {}".format(
+                stack_file.reference[1],
+                by_reference[stack_file.reference].path,
+                stack_file.path
+            ))
+        by_reference[stack_file.reference] = stack_file
+        for export in stack_file.exports:
+            reference = ("export", export)
+            if reference in by_reference:
+                raise SystemExit("Export {} defined in both {} and {}".format(
+                    export,
+                    by_reference[reference].path,
+                    stack_file.path
+                ))
+            by_reference[reference] = stack_file
+
+    for stack_file in stack_files:
+        stack_file.upstream = {
+            by_reference[r] for r in stack_file.dependencies
+            if r in by_reference
+        } - {stack_file}
+    pending = {
+        stack_file: set(stack_file.upstream) for stack_file in stack_files
+    }
+    waves = []
+    while pending:
+        wave = sorted(
+            (s for s, deps in pending.items() if not deps),
+            key=lambda s: s.path
+        )
+        if not wave:
+            raise SystemExit("Circular dependency between stacks: {}".format(
+                ", ".join(sorted(s.path for s in pending))
+            ))
+        for stack_file in wave:
+            del pending[stack_file]
+        for deps in pending.values():
+            deps.difference_update(wave)
+        waves.append(wave)
+    return waves
+
+
+def execute_stack(stack_file, action, build_id, force=False):
+    """ Renders a stack file and executes the action on it
+
+    The action waits for completion, so stacks in the next wave can
+    reference the outputs of this one. The exception are GCP deployments:
+    their operations are polled together once the whole wave is started
+    (see wait_for_operations()).
+
+    Returns: The stack object if its operation must still be waited on,
+        otherwise None
+    """
+    with gpwm.metrics.phase("stack", path=stack_file.path, action=action):
+        stack = stack_file.stack or stack_file.load(build_id)
+        if not hasattr(stack, action):
+            raise SystemExit("Action {} not supported by {}".format(
+                action,
+                stack_file.path
+            ))
+        wait = stack_file.reference is None or \
+            stack_file.reference[0] != "gcp"
+        if action in ["update", "upsert"]:
+            getattr(stack, action)(wait=wait, review=False, force=force)
+        else:
+            getattr(stack, action)(wait=wait)
+    # unchanged deployments are skipped, so there's no operation to wait for
+    if wait or getattr(stack, "operation", None) is None:
+        return None
+    return stack
+
+
+def wait_for_operations(stacks):
+    """ Waits for the operations of GCP deployments started by a wave
+
+    Args:
+        stacks(dict): GCPStack objects keyed by StackFile
+
+    Returns: A dict mapping the StackFile objects of the failed deployments
+        to their error message
+    """
+    import gpwm.stacks.gcp
+    errors = gpwm.stacks.gcp.poll_operations(
+        [(s.project, s.operation) for s in stacks.values()]
+    )
+    failed = {}
+    for stack_file, stack in stacks.items():
+        error = errors.get((stack.project, stack.operation["name"]))
+        if error:
+            failed[stack_file] = error
+        else:
+            stack.invalidate_cache()
+    return failed
+
+
+def apply(paths, action, build_id, jobs=4, dry_run=False, force=False):
+    """ Executes an action on all stacks found in paths
+
+    Args:
+        paths(list): Directories, glob patterns, or stack files
+        action(str): One of "create", "update", "upsert" or "delete"
+        build_id(str): The build ID
+        jobs(int): The maximum number of stacks executed in parallel
+        dry_run(bool): Only print the execution plan
+        force(bool): Update stacks even when their content didn't change
+    """
+    if action not in APPLY_ACTIONS:
+        raise SystemExit("Action not supported by apply: {}".format(action))
+
+    stack_files = [StackFile(p) for p in find_stack_files(paths)]
+    if not stack_files:
+        raise SystemExit("No stack files found in: {}".format(
+            " ".join(paths)
+        ))
+
+    discover_dependencies(stack_files, build_id)
+    waves = build_waves(stack_files)
+    # dependents must go away before the stacks they reference
+    if action == "delete":
+        waves.reverse()
+
+    for n, wave in enumerate(waves, 1):
+        print("===> Wave {}: {}".format(
+            n,
+            " ".join(s.path for s in wave)
+        ))
+    if dry_run:
+        return
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for n, wave in enumerate(waves, 1):
+            futures = {}
+            for stack_file in wave:
+                # dependencies are dependents when deleting
+                if action == "delete":
+                    blocked_by = {
+                        s for s in failed if stack_file in s.upstream
+                    }
+                else:
+                    blocked_by = failed & stack_file.upstream
+                if blocked_by:
+                    logging.error("Skipping %s: depends on failed stacks %s",
+                                  stack_file.path,
+                                  ", ".join(s.path for s in blocked_by))
+                    failed.add(stack_file)
+                    continue
+                futures[stack_file] = executor.submit(
+                    execute_stack,
+                    stack_file,
+                    action,
+                    build_id,
+                    force
+                )
+            errors = {}
+            pending_operations = {}
+            for stack_file, future in futures.items():
+                try:
+                    stack = future.result()
+                    if stack is not None:
+                        pending_operations[stack_file] = stack
+                # SystemExit is how stacks report errors, so it must not
+                # bring the other stacks down
+                except (Exception, SystemExit) as exc:
+                    errors[stack_file] = exc
+            if pending_operations:
+                errors.update(wait_for_operations(pending_operations))
+            for stack_file in futures:
+                if stack_file in errors:
+                    logging.error("Failed to %s %s: %s",
+                                  action,
+                                  stack_file.path,
+                                  errors[stack_file])
+                    failed.add(stack_file)
+                else:
+                    print("===> {} {}: done".format(action, stack_file.path))
+
+    if failed:
+        raise SystemExit("Failed stacks: {}".format(
+            " ".join(sorted(s.path for s in failed))
+        ))
@@ -0,0 +1,430 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Benchmarks of the render pipeline
+
+Synthetic stacks of growing size are rendered through the whole CLI path
+(cli.main, templating engine resolution, Mako/Jinja rendering, yaml loading,
+tag resolution and stack object initialization) against in-process stubs of
+the provider APIs, so results only measure gpwm itself.
+
+Results are JSON, so render latency and peak memory can be tracked across
+releases (see compare()).
+"""
+
+
+from __future__ import print_function
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import gpwm.cache
+import gpwm.cli
+import gpwm.utils
+
+
+BENCH_CASES = [
+    "cloudformation-mako",
+    "cloudformation-jinja",
+    "cloudformation-yaml",
+    "gcp-mako"
+]
+BENCH_SIZES = [10, 100, 500]
+BENCH_ITERATIONS = 5
+
+# Cases slower than the baseline by more than this ratio are regressions
+REGRESSION_THRESHOLD = 0.1
+
+MAKO_TEMPLATE = """
+Resources:
+% for i in range(int(count)):
+  Subnet${i}:
+    Type: AWS::EC2::Subnet
+    Properties:
+      VpcId: !Cloudformation {stack: bench-vpc, output: VpcId}
+      CidrBlock: 10.${i // 256}.${i % 256}.0/24
+      Tags:
+        - Key: team
+          Value: !SSM {Name: /bench/team}
+        - Key: name
+          Value: subnet-${i}
+% endfor
+"""
+
+JINJA_TEMPLATE = """
+Resources:
+{% for i in range(count|int) %}
+  Subnet{{ i }}:
+    Type: AWS::EC2::Subnet
+    Properties:
+      VpcId: !Cloudformation {stack: bench-vpc, output: VpcId}
+      CidrBlock: 10.{{ i // 256 }}.{{ i % 256 }}.0/24
+      Tags:
+        - Key: team
+          Value: !SSM {Name: /bench/team}
+        - Key: name
+          Value: subnet-{{ i }}
+{% endfor %}
+"""
+
+CLOUDFORMATION_STACK = """
+StackName: bench-{size}
+TemplateBody: {template}
+Parameters:
+  count: {size}
+Tags:
+  team: bench
+"""
+
+GCP_STACK = """
+stack_type: gcp
+name: bench-{size}
+project: bench
+resources:
+% for i in range({size}):
+- name: instance-${{i}}
+  type: compute.v1.instance
+  properties:
+    zone: us-central1-a
+    network: !GCPDM {{deployment: bench-network, output: network,
+      project: bench}}
+% endfor
+"""
+
+
+class StubCall(object):
+    """ A stubbed API call returning a canned response
+    """
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class StubProvider(object):
+    """ In-process stand-in for the provider APIs used while rendering
+
+    Implements just enough of the boto3 clients (Cloudformation, SSM, STS)
+    and of the GCP Deployment Manager API for the synthetic stacks, and
+    counts the calls made to each of them.
+    """
+    class meta(object):
+        region_name = "us-east-1"
+
+    def __init__(self):
+        self.calls = {}
+
+    def count(self, action):
+        self.calls[action] = self.calls.get(action, 0) + 1
+
+    # Cloudformation
+    def describe_stacks(self, StackName):
+        self.count("cloudformation.describe_stacks")
+        return {"Stacks": [{
+            "StackName": StackName,
+            "Outputs": [{"OutputKey": "VpcId", "OutputValue": "vpc-12345"}],
+            "Tags": []
+        }]}
+
+    # SSM
+    def get_parameters(self, Names, WithDecryption=False):
+        self.count("ssm.get_parameters")
+        return {
+            "Parameters": [{"Name": n, "Value": "bench"} for n in Names],
+            "InvalidParameters": []
+        }
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.count("ssm.get_parameter")
+        return {"Parameter": {"Name": Name, "Value": "bench"}}
+
+    # STS
+    def get_caller_identity(self):
+        self.count("sts.get_caller_identity")
+        return {"Account": "123456789012"}
+
+    # GCP Deployment Manager
+    def deployments(self):
+        return self
+
+    def manifests(self):
+        return self
+
+    def get(self, project, deployment, manifest=None):
+        if manifest is None:
+            self.count("deploymentmanager.deployments.get")
+            return StubCall({
+                "name": deployment,
+                "manifest": "projects/{}/manifests/bench".format(project)
+            })
+        self.count("deploymentmanager.manifests.get")
+        return StubCall({"layout": (
+            "outputs:\n"
+            "- name: network\n"
+            "  finalValue: bench-network\n"
+        )})
+
+
+@contextlib.contextmanager
+def stubbed_providers(stub):
+    """ Makes gpwm use the stub instead of the real provider APIs
+
+    The stub is injected in the provider client registry, so nothing is
+    patched and the code paths are the same as in real runs.
+    """
+    with gpwm.utils.PROVIDER_CLIENTS_LOCK:
+        original = dict(gpwm.utils.PROVIDER_CLIENTS)
+        original_settings = gpwm.utils.PROVIDER_CLIENTS_SETTINGS
+        # marks the registry as current, otherwise the first lookup drops
+        # the stubs and creates real clients
+        gpwm.utils.PROVIDER_CLIENTS_SETTINGS = (
+            gpwm.utils.MAX_POOL_CONNECTIONS,
+        )
+        gpwm.utils.PROVIDER_CLIENTS.update({
+            ("aws", "client", "cloudformation", None, None): stub,
+            ("aws", "client", "ssm", None, None): stub,
+            ("aws", "client", "sts", None, None): stub,
+            ("aws", "account_id"): "123456789012",
+            ("gcp", "deploymentmanager", "v2"): stub
+        })
+    try:
+        yield stub
+    finally:
+        with gpwm.utils.PROVIDER_CLIENTS_LOCK:
+            gpwm.utils.PROVIDER_CLIENTS.clear()
+            gpwm.utils.PROVIDER_CLIENTS.update(original)
+            gpwm.utils.PROVIDER_CLIENTS_SETTINGS = original_settings
+
+
+def write_stack_file(directory, case, size):
+    """ Writes the synthetic stack file (and template) for a case
+
+    Returns: The path to the stack file
+    """
+    def write(name, content):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    if case == "cloudformation-mako":
+        template = write("subnets.mako", MAKO_TEMPLATE)
+        content = CLOUDFORMATION_STACK.format(size=size, template=template)
+        return write("bench-{}.mako".format(size), content)
+    elif case == "cloudformation-jinja":
+        template = write("subnets.jinja", JINJA_TEMPLATE)
+        content = CLOUDFORMATION_STACK.format(size=size, template=template)
+        return write("bench-{}.jinja".format(size), content)
+    elif case == "cloudformation-yaml":
+        # no templating at all, so the template is inline
+        lines = ["StackName: bench-{}".format(size), "TemplateBody:"]
+        lines.append("  Resources:")
+        for i in range(size):
+            lines.extend([
+                "    Subnet{}:".format(i),
+                "      Type: AWS::EC2::Subnet",
+                "      Properties:",
+                "        VpcId: !Cloudformation "
+                "{stack: bench-vpc, output: VpcId}",
+                "        CidrBlock: 10.{}.{}.0/24".format(i // 256, i % 256)
+            ])
+        return write("bench-{}.yaml".format(size), "\n".join(lines) + "\n")
+    elif case == "gcp-mako":
+        return write(
+            "bench-gcp-{}.mako".format(size),
+            GCP_STACK.format(size=size)
+        )
+    raise SystemExit("Benchmark case not supported: {}".format(case))
+
+
+def render(stack_file):
+    """ Renders a stack file through the CLI entry point
+    """
+    argv = sys.argv
+    stdout = sys.stdout
+    sys.argv = ["gpwm", "--no-cache", "render", stack_file, "-b", "bench"]
+    sys.stdout = io.StringIO()
+    try:
+        gpwm.cli.main()
+    finally:
+        sys.argv = argv
+        sys.stdout = stdout
+
+
+def reset_caches():
+    """ Drops the in-process caches, so every iteration starts cold
+    """
+    gpwm.cache.STACK_CACHE = None
+    with gpwm.utils.CALL_AWS_CACHE_LOCK:
+        gpwm.utils.CALL_AWS_CACHE.clear()
+
+
+@contextlib.contextmanager
+def bench_environment():
+    """ Runs the benchmarks in a scratch directory, with cold caches
+
+    Yields: The scratch directory
+    """
+    directory = tempfile.mkdtemp(prefix="gpwm-bench-")
+    settings = (
+        gpwm.utils.CACHE_DIR,
+        gpwm.utils.TEMPLATE_CACHE_DIR,
+        gpwm.cache.CACHE_BACKEND
+    )
+    gpwm.utils.CACHE_DIR = os.path.join(directory, "cache")
+    gpwm.utils.TEMPLATE_CACHE_DIR = None
+    gpwm.utils.COMPILED_TEMPLATES.clear()
+    gpwm.utils.JINJA_ENVIRONMENT = None
+    try:
+        yield directory
+    finally:
+        (
+            gpwm.utils.CACHE_DIR,
+            gpwm.utils.TEMPLATE_CACHE_DIR,
+            gpwm.cache.CACHE_BACKEND
+        ) = settings
+        # compiled templates point to the scratch directory
+        gpwm.utils.COMPILED_TEMPLATES.clear()
+        gpwm.utils.JINJA_ENVIRONMENT = None
+        reset_caches()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_case(directory, case, size, iterations=BENCH_ITERATIONS):
+    """ Benchmarks a case
+
+    The first render also compiles the templates not seen before, so it's
+    reported separately. Peak memory is measured in an extra render, as
+    tracing allocations slows everything down.
+
+    Returns: A dict with the results
+    """
+    stack_file = write_stack_file(directory, case, size)
+    with stubbed_providers(StubProvider()) as stub:
+        timings = []
+        for _ in range(iterations + 1):
+            reset_caches()
+            start = time.time()
+            render(stack_file)
+            timings.append(time.time() - start)
+        calls = dict(stub.calls)
+
+        reset_caches()
+        tracemalloc.start()
+        try:
+            render(stack_file)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    first, timings = timings[0], timings[1:]
+    return {
+        "case": case,
+        "size": size,
+        "iterations": iterations,
+        "first": first,
+        "min": min(timings),
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "peak_memory": peak_memory,
+        "api_calls": {k: v // (iterations + 1) for k, v in calls.items()}
+    }
+
+
+def run(cases=BENCH_CASES, sizes=BENCH_SIZES, iterations=BENCH_ITERATIONS):
+    """ Runs the benchmarks
+
+    Returns: A dict with the environment and the results of all cases
+    """
+    results = []
+    with bench_environment() as directory:
+        for case in cases:
+            for size in sizes:
+                print("===> {} {}".format(case, size), file=sys.stderr)
+                results.append(run_case(directory, case, size, iterations))
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """ Compares benchmark results with a baseline
+
+    Args:
+        baseline(dict): Results of run()
+        current(dict): Results of run()
+        threshold(float): The tolerated slowdown/memory growth ratio
+
+    Returns: A list of regression messages. Empty if there are none
+    """
+    previous = {(r["case"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = previous.get((result["case"], result["size"]))
+        if old is None:
+            continue
+        for metric in ["median", "peak_memory"]:
+            if old[metric] and \
+                    result[metric] > old[metric] * (1 + threshold):
+                regressions.append("{} {}: {} went from {} to {}".format(
+                    result["case"],
+                    result["size"],
+                    metric,
+                    old[metric],
+                    result[metric]
+                ))
+    return regressions
+
+
+def bench(cases=BENCH_CASES, sizes=BENCH_SIZES, iterations=BENCH_ITERATIONS,
+          output=None, baseline=None):
+    """ Runs the benchmarks and reports the results
+
+    Args:
+        cases(list): The benchmark cases
+        sizes(list): The number of resources of the synthetic stacks
+        iterations(int): The number of renders timed per case and size
+        output(str): The file the JSON results are written to. Defaults to
+            stdout
+        baseline(str): A file with previous results. Raises SystemExit if
+            the results regressed
+    """
+    results = run(cases, sizes, iterations)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(json.load(f), results)
+        if regressions:
+            raise SystemExit("Performance regressions:\n{}".format(
+                "\n".join("  - {}".format(r) for r in regressions)
+            ))
@@ -0,0 +1,301 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Caches for data fetched from the cloud providers
+
+Stack outputs and physical resource IDs are cached in-process, and
+optionally in a persistent backend shared by all gpwm runs in the machine,
+so repeated renders don't hammer the provider APIs.
+
+Remote templates are cached on disk, and only downloaded again when they
+change.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import gpwm.utils
+
+
+# Time (in seconds) cached entries are trusted
+CACHE_TTL = int(os.getenv("GPWM_CACHE_TTL", 300))
+
+# The persistent backend: "sqlite", or "memory" for no persistence at all
+CACHE_BACKEND = os.getenv("GPWM_CACHE_BACKEND", "sqlite")
+
+STACK_CACHE = None
+STACK_CACHE_SETTINGS = None
+STACK_CACHE_LOCK = threading.Lock()
+
+# Maximum size (in bytes) of the remote templates kept on disk. The least
+# recently used templates are evicted first
+FETCH_CACHE_MAX_SIZE = int(
+    os.getenv("GPWM_FETCH_CACHE_MAX_SIZE", 100 * 1024 * 1024)
+)
+
+FETCH_CACHE = None
+FETCH_CACHE_SETTINGS = None
+FETCH_CACHE_LOCK = threading.Lock()
+
+
+class MemoryCache(object):
+    """ In-process cache with TTL-based eviction
+
+    Keys are strings, values anything. Thread safe.
+    """
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (None, 0))
+            if expires < time.time():
+                self._data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+
+    def invalidate(self, prefix):
+        """ Removes all entries with keys starting with prefix
+        """
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+
+class SqliteCache(object):
+    """ Persistent cache with TTL-based eviction backed by sqlite
+
+    Keys are strings, values anything JSON serializable. The database can
+    be shared by concurrent gpwm processes.
+    """
+    def __init__(self, path, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+            self._connection.execute(
+                "DELETE FROM cache WHERE expires < ?",
+                (time.time(),)
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires >= ?",
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (key, json.dumps(value, default=str), time.time() + self.ttl)
+            )
+
+    def invalidate(self, prefix):
+        """ Removes all entries with keys starting with prefix
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM cache WHERE substr(key, 1, ?) = ?",
+                (len(prefix), prefix)
+            )
+
+
+class TieredCache(object):
+    """ An in-process cache in front of an optional persistent backend
+    """
+    def __init__(self, ttl=CACHE_TTL, backend=None):
+        self.memory = MemoryCache(ttl=ttl)
+        self.backend = backend
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        logging.debug("Cache %s: %s", "miss" if value is None else "hit", key)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def invalidate(self, prefix):
+        logging.debug("Cache invalidation: %s", prefix)
+        self.memory.invalidate(prefix)
+        if self.backend is not None:
+            self.backend.invalidate(prefix)
+
+
+class FetchCache(object):
+    """ On-disk cache for remote templates, with LRU eviction
+
+    Each entry is the template body plus the metadata needed to revalidate
+    it (eg ETag and Last-Modified), so callers can make conditional requests
+    and only download templates that changed. Reading an entry marks it as
+    recently used. Writes are atomic, so the cache can be shared by
+    concurrent gpwm processes.
+    """
+    def __init__(self, directory, max_size=FETCH_CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode("utf-8")).hexdigest()
+        )
+
+    def get(self, key):
+        """ Returns the (body, metadata) tuple cached for key, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path + ".json") as f:
+                metadata = json.load(f)
+            with open(path + ".body", "rb") as f:
+                body = f.read().decode("utf-8")
+            os.utime(path + ".body", None)
+        except (IOError, OSError, ValueError):
+            return None
+        if metadata.get("key") != key:
+            return None
+        return body, metadata
+
+    def set(self, key, body, metadata):
+        path = self._path(key)
+        try:
+            gpwm.utils.write_cache_file(path + ".body", body.encode("utf-8"))
+            gpwm.utils.write_cache_file(
+                path + ".json",
+                json.dumps(dict(metadata, key=key), default=str)
+            )
+        except (IOError, OSError) as exc:
+            logging.debug("Failed to cache %s: %s", key, exc)
+            return
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in
+        max_size
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".body"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-5]))
+        size = sum(e[1] for e in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            for extension in [".body", ".json"]:
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except OSError:
+                    pass
+            size -= entry_size
+
+
+def get_fetch_cache():
+    """ Returns the (lazily created) cache for remote templates
+
+    Returns None when CACHE_BACKEND is "memory", as nothing should be
+    persisted.
+    """
+    global FETCH_CACHE, FETCH_CACHE_SETTINGS
+    if CACHE_BACKEND == "memory":
+        return None
+    settings = (gpwm.utils.CACHE_DIR, FETCH_CACHE_MAX_SIZE)
+    if FETCH_CACHE is None or FETCH_CACHE_SETTINGS != settings:
+        with FETCH_CACHE_LOCK:
+            if FETCH_CACHE is None or FETCH_CACHE_SETTINGS != settings:
+                FETCH_CACHE = FetchCache(
+                    gpwm.utils.get_cache_dir("fetch"),
+                    max_size=FETCH_CACHE_MAX_SIZE
+                )
+                FETCH_CACHE_SETTINGS = settings
+    return FETCH_CACHE
+
+
+def get_stack_cache():
+    """ Returns the (lazily created) cache for stack data
+
+    The cache is built according to CACHE_TTL and CACHE_BACKEND, and built
+    again if they change (eg between the requests served by the daemon).
+    """
+    global STACK_CACHE, STACK_CACHE_SETTINGS
+    settings = (CACHE_BACKEND, CACHE_TTL, gpwm.utils.CACHE_DIR)
+    if STACK_CACHE is None or STACK_CACHE_SETTINGS != settings:
+        with STACK_CACHE_LOCK:
+            if STACK_CACHE is None or STACK_CACHE_SETTINGS != settings:
+                backend = None
+                if CACHE_BACKEND == "sqlite":
+                    backend = SqliteCache(
+                        os.path.join(
+                            gpwm.utils.get_cache_dir(),
+                            "stacks.sqlite"
+                        ),
+                        ttl=CACHE_TTL
+                    )
+                elif CACHE_BACKEND != "memory":
+                    raise SystemExit(
+                        "Cache backend not supported: {}".format(
+                            CACHE_BACKEND
+                        )
+                    )
+                STACK_CACHE = TieredCache(ttl=CACHE_TTL, backend=backend)
+                STACK_CACHE_SETTINGS = settings
+    return STACK_CACHE
+
+
+def stack_cache_key(provider, *parts):
+    """ Builds the cache key for stack data
+
+    Args:
+        provider(str): The provider, eg "cloudformation", "gcp"
+        parts(str): What identifies the data within the provider, from the
+            most to the least generic, eg region, account, stack, "outputs"
+    """
+    return ":".join((provider,) + parts)
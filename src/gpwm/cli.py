@@ -19,25 +19,30 @@
 
 from __future__ import print_function
 import argparse
+import cProfile
 import logging
 import os
 import sys
-import yaml
-
-import jinja2
-import mako.exceptions
-import mako.template
 
+import gpwm.apply
+import gpwm.bench
+import gpwm.cache
+import gpwm.client
+import gpwm.metrics
+import gpwm.ratelimit
+import gpwm.render
+import gpwm.server
 import gpwm.utils
 import gpwm.stacks
 
 
-def build_common_args(parser):
+def build_common_args(parser, stack_optional=False):
     """ Configures arguments to all actions/subparsers
     """
     parser.add_argument(
         "stack",
         type=argparse.FileType("r"),
+        nargs="?" if stack_optional else None,
         help=("The path to the stack file. "
               "Use - for stdin, in which case -t must be specified")
     )
@@ -74,7 +79,7 @@ def parse_args(args):
     parser.add_argument(
         "--dry-run",
         action="store_true",
-        help="Not implemented yet"
+        help="Only print the execution plan (apply only)"
     )
     parser.add_argument(
         "--loglevel",
@@ -87,6 +92,122 @@ def parse_args(args):
         default="error",
         help="The log level for botocore"
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=gpwm.utils.CACHE_DIR,
+        help=("The directory for local caches. "
+              "Defaults to GPWM_CACHE_DIR env variable or ~/.cache/gpwm")
+    )
+    parser.add_argument(
+        "--template-cache-dir",
+        default=gpwm.utils.TEMPLATE_CACHE_DIR,
+        help=("The directory for compiled templates. Defaults to "
+              "GPWM_TEMPLATE_CACHE_DIR env variable or the templates "
+              "directory inside the cache directory")
+    )
+    parser.add_argument(
+        "--max-pool-connections",
+        type=int,
+        default=gpwm.utils.MAX_POOL_CONNECTIONS,
+        help=("Maximum number of HTTP connections kept alive per provider "
+              "client. Defaults to GPWM_MAX_POOL_CONNECTIONS env variable "
+              "or 20")
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=gpwm.cache.CACHE_TTL,
+        help=("Time in seconds cached stack outputs and resource IDs are "
+              "trusted. Defaults to GPWM_CACHE_TTL env variable or 300")
+    )
+    parser.add_argument(
+        "--fetch-cache-max-size",
+        type=int,
+        default=gpwm.cache.FETCH_CACHE_MAX_SIZE,
+        help=("Maximum size in bytes of the remote templates cached on "
+              "disk. Defaults to GPWM_FETCH_CACHE_MAX_SIZE env variable or "
+              "100MB")
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help=("Don't keep stack outputs and resource IDs cached across "
+              "gpwm runs")
+    )
+    parser.add_argument(
+        "--no-local-validation",
+        dest="local_validation",
+        action="store_false",
+        default=os.getenv("GPWM_LOCAL_VALIDATION", "") != "false",
+        help=("Don't validate Cloudformation templates locally. Local "
+              "validation is disabled when GPWM_LOCAL_VALIDATION env "
+              "variable is \"false\"")
+    )
+    parser.add_argument(
+        "--remote-validation",
+        action="store_true",
+        default=os.getenv("GPWM_REMOTE_VALIDATION", "") == "true",
+        help=("Also validate Cloudformation templates with the "
+              "ValidateTemplate API, not only locally. Defaults to "
+              "GPWM_REMOTE_VALIDATION env variable")
+    )
+    parser.add_argument(
+        "--template-bucket",
+        default=os.getenv("GPWM_TEMPLATE_BUCKET", ""),
+        help=("Upload rendered Cloudformation templates to this bucket "
+              "(\"bucket\" or \"bucket/prefix\") and pass them by URL. "
+              "Defaults to GPWM_TEMPLATE_BUCKET env variable")
+    )
+    parser.add_argument(
+        "--nested-stack-size",
+        type=int,
+        default=int(os.getenv("GPWM_NESTED_STACK_SIZE", 0)),
+        help=("Split Cloudformation templates with more resources than "
+              "this into nested stacks of at most this many resources. "
+              "Requires a template bucket. Defaults to "
+              "GPWM_NESTED_STACK_SIZE env variable or 0 (disabled)")
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=gpwm.ratelimit.RATE_LIMIT,
+        help=("Maximum provider API requests per second, per provider, "
+              "service and region. The rate adapts to throttling errors. "
+              "Defaults to GPWM_RATE_LIMIT env variable or 20. 0 disables "
+              "rate limiting")
+    )
+    parser.add_argument(
+        "--rate-limit-burst",
+        type=float,
+        default=gpwm.ratelimit.RATE_LIMIT_BURST,
+        help=("Requests that can be made at once after a quiet period. "
+              "Defaults to GPWM_RATE_LIMIT_BURST env variable or the rate "
+              "limit")
+    )
+    parser.add_argument(
+        "--rate-limit-min",
+        type=float,
+        default=gpwm.ratelimit.RATE_LIMIT_MIN,
+        help=("The rate throttling errors can bring the rate limit down to. "
+              "Defaults to GPWM_RATE_LIMIT_MIN env variable or 0.5")
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help=("Time the execution phases and the provider API calls, and "
+              "write the metrics to this file. Use - for stderr")
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=gpwm.metrics.METRICS_FORMATS,
+        default="table",
+        help=("The format of the metrics: a summary table, JSON, or "
+              "Chrome's trace event format")
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the execution with cProfile, and dump the stats here"
+    )
 
     # subparser for each action
     subparser_obj = parser.add_subparsers(dest="action")
@@ -103,7 +224,10 @@ def parse_args(args):
     subparsers = {}
     for action in actions:
         subparsers[action] = subparser_obj.add_parser(action)
-        build_common_args(subparsers[action])
+        build_common_args(
+            subparsers[action],
+            stack_optional=(action == "render")
+        )
 
     # action-specficic arguments
     #
@@ -116,15 +240,132 @@ def parse_args(args):
         help="Review changes"
     )
 
-    # upsert
+    # render
+    subparsers["render"].add_argument(
+        "--all",
+        metavar="DIR",
+        help=("Render all stack files in this directory (recursively) "
+              "instead of a single stack. Requires --out")
+    )
+    subparsers["render"].add_argument(
+        "--out",
+        metavar="DIR",
+        help=("The directory the rendered stacks and the manifest are "
+              "written to (--all only)")
+    )
+    subparsers["render"].add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help=("Number of processes rendering stacks (--all only). Defaults "
+              "to the number of CPUs")
+    )
+
+    # upsert: updates are reviewed unless --no-review is given
     subparsers["upsert"].add_argument(
         "--review",
         "-r",
         action="store_true",
-        default=False,
-        help="Review changes"
+        default=True,
+        help="Review changes (default)"
+    )
+    subparsers["upsert"].add_argument(
+        "--no-review",
+        dest="review",
+        action="store_false",
+        help="Update without reviewing the changes"
+    )
+
+    # apply: executes an action on many stacks, so it doesn't take the
+    # common arguments
+    subparsers["apply"] = subparser_obj.add_parser("apply")
+    subparsers["apply"].add_argument(
+        "paths",
+        nargs="+",
+        help="Directories, glob patterns, or paths to stack files"
+    )
+    subparsers["apply"].add_argument(
+        "--apply-action",
+        "-a",
+        choices=gpwm.apply.APPLY_ACTIONS,
+        default="upsert",
+        help="The action executed on every stack"
+    )
+    subparsers["apply"].add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Maximum number of stacks executed in parallel"
+    )
+    subparsers["apply"].add_argument(
+        "--build-id",
+        "-b",
+        default=os.getenv("BUILD_ID", ""),
+        help="The build id. Defaults to BUILD_ID env variable"
+    )
+
+    # bench: benchmarks the render pipeline, so it doesn't take the common
+    # arguments either
+    subparsers["bench"] = subparser_obj.add_parser("bench")
+    subparsers["bench"].add_argument(
+        "--cases",
+        nargs="+",
+        default=gpwm.bench.BENCH_CASES,
+        choices=gpwm.bench.BENCH_CASES,
+        help="The benchmark cases"
+    )
+    subparsers["bench"].add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=gpwm.bench.BENCH_SIZES,
+        help="The number of resources of the synthetic stacks"
+    )
+    subparsers["bench"].add_argument(
+        "--iterations",
+        "-n",
+        type=int,
+        default=gpwm.bench.BENCH_ITERATIONS,
+        help="The number of renders timed per case and size"
+    )
+    subparsers["bench"].add_argument(
+        "--output",
+        "-o",
+        help="The file the JSON results are written to. Defaults to stdout"
+    )
+    subparsers["bench"].add_argument(
+        "--baseline",
+        help=("A file with previous results. Fails if render time or peak "
+              "memory regressed")
     )
 
+    # serve: runs the daemon executing the requests of gpwm.client
+    subparsers["serve"] = subparser_obj.add_parser("serve")
+    subparsers["serve"].add_argument(
+        "--socket",
+        default=gpwm.client.SOCKET_PATH,
+        help=("The Unix socket to listen on. Defaults to GPWM_SOCKET env "
+              "variable or gpwm.sock inside the cache directory")
+    )
+    subparsers["serve"].add_argument(
+        "--idle-timeout",
+        type=float,
+        default=gpwm.server.IDLE_TIMEOUT,
+        help=("Exit after this many seconds without requests. Defaults to "
+              "GPWM_IDLE_TIMEOUT env variable or 0 (never)")
+    )
+
+    # update, upsert and apply skip stacks whose content didn't change
+    for action in ["update", "upsert", "apply"]:
+        subparsers[action].add_argument(
+            "--force",
+            "-f",
+            action="store_true",
+            default=False,
+            help="Update stacks even when their content didn't change"
+        )
+
     return parser.parse_args(args)
 
 
@@ -135,12 +376,9 @@ def resolve_templating_engine(args):
     # Only use -t option when stack comes from stdin
     if args.stack.name == "<stdin>":
         return args.templating_engine
-    elif ".mako" in args.stack.name[-5:]:
-        return "mako"
-    elif ".jinja" in args.stack.name[-6:]:
-        return "jinja"
-    elif ".yaml" in args.stack.name[-5:]:
-        return "yaml"
+    templating_engine = gpwm.utils.get_templating_engine(args.stack.name)
+    if templating_engine:
+        return templating_engine
     raise NotImplementedError("Templating engine not supported. Must be set "
                               "to 'mako', 'jinja', or '' in the command line "
                               "or by using the equivalent file extension")
@@ -154,12 +392,12 @@ def execute_action(stack, args, stack_attributes):
     elif args.action == "delete":
         stack.delete(wait=args.wait)
     elif args.action == "update":
-        stack.update(wait=args.wait, review=args.review)
+        stack.update(wait=args.wait, review=args.review, force=args.force)
     elif args.action == "upsert":
-        stack.upsert(wait=args.wait)
+        stack.upsert(wait=args.wait, review=args.review, force=args.force)
     elif args.action == "render":
         print("===> Stack Attributes:")
-        print(yaml.dump(stack_attributes, indent=2))
+        print(gpwm.utils.dump_yaml(stack_attributes))
         print("===> Final Template:")
         stack.render()
     elif args.action == "list":
@@ -170,10 +408,80 @@ def execute_action(stack, args, stack_attributes):
         raise NotImplementedError("Action not implemented")
 
 
-def main():
+def configure_cloudformation_stacks(args):
+    """ Applies the Cloudformation specific options
+
+    The module is only imported when needed, so the AWS SDK isn't loaded
+    for other providers.
+    """
+    import gpwm.stacks.aws
+    gpwm.stacks.aws.LOCAL_VALIDATION = args.local_validation
+    gpwm.stacks.aws.REMOTE_VALIDATION = args.remote_validation
+    gpwm.stacks.aws.TEMPLATE_BUCKET = args.template_bucket
+    gpwm.stacks.aws.NESTED_STACK_SIZE = args.nested_stack_size
+
+
+def run(args):
+    """ Executes the action
+    """
+    if args.action == "apply":
+        gpwm.apply.apply(
+            args.paths,
+            args.apply_action,
+            args.build_id,
+            jobs=args.jobs,
+            dry_run=args.dry_run,
+            force=args.force
+        )
+        gpwm.utils.log_call_aws_stats()
+        return
+
+    if args.action == "render" and args.all:
+        if not args.out or args.stack:
+            raise SystemExit("render --all requires --out, and no stack")
+        gpwm.render.render_all(
+            args.all,
+            args.out,
+            args.build_id,
+            jobs=args.jobs
+        )
+        return
+    if args.stack is None:
+        raise SystemExit("The stack file is required")
+
+    templating_engine = resolve_templating_engine(args)
+    stack_attributes = gpwm.utils.render_stack(
+        args.stack.read(),
+        templating_engine,
+        args.build_id
+    )
+    stack = gpwm.stacks.factory(**stack_attributes)
+    with gpwm.metrics.phase("action", action=args.action):
+        execute_action(stack, args, stack_attributes)
+    gpwm.utils.log_call_aws_stats()
+
+
+def main(argv=None):
     """ Entry point
+
+    Args:
+        argv(list): The command line arguments. Defaults to sys.argv
     """
-    args = parse_args(sys.argv[1:])
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.action == "serve":
+        gpwm.server.serve(args.socket, idle_timeout=args.idle_timeout)
+        return
+
+    if args.action == "bench":
+        gpwm.bench.bench(
+            cases=args.cases,
+            sizes=args.sizes,
+            iterations=args.iterations,
+            output=args.output,
+            baseline=args.baseline
+        )
+        return
 
     if not args.build_id:
         raise SystemExit("The build ID is required. \
@@ -187,45 +495,40 @@ def main():
     boto_logger = logging.getLogger("botocore")
     boto_logger.setLevel(level=botocore_loglevel)
 
-    # script logging level
+    # script logging level. The root logger is already configured in the
+    # daemon, so the level is also set explicitly
     logging.basicConfig(level=loglevel)
-
-    templating_engine = resolve_templating_engine(args)
-
-    stack_file = args.stack.read()
-    template_params = {
-        "build_id": args.build_id,
-        "call_aws": gpwm.utils.call_aws,
-        "get_stack_output": gpwm.utils.get_stack_output,
-        "get_stack_resource": gpwm.utils.get_stack_resource
-    }
-
-    # try rendering stack with mako first, if fails try jinja,
-    # so we get all the goodies on the stack level as well,
-    # not just the on the template
-
-    if templating_engine == "mako":
-        logging.debug("Trying to render mako input file...")
-        stack_template = mako.template.Template(
-            stack_file,
-            strict_undefined=False
-        )
-        try:
-            rendered_template = stack_template.render(**template_params)
-        # mako wraps the exception where the real information is, so we unwrap
-        # and display only the part that matters to the user
-        except Exception:
-            raise SystemExit(mako.exceptions.text_error_template().render())
-    elif templating_engine == "jinja":
-        stack_template = jinja2.Template(stack_file)
-        rendered_template = yaml.load(stack_template.render(**template_params))
-    else:
-        stack_attributes = stack_file
-
-    stack_attributes = yaml.load(rendered_template)
-    stack_attributes["BuildId"] = args.build_id
-    stack = gpwm.stacks.factory(**stack_attributes)
-    execute_action(stack, args, stack_attributes)
+    logging.getLogger().setLevel(loglevel)
+
+    gpwm.utils.CACHE_DIR = args.cache_dir
+    gpwm.utils.TEMPLATE_CACHE_DIR = args.template_cache_dir
+    gpwm.utils.MAX_POOL_CONNECTIONS = args.max_pool_connections
+    gpwm.cache.CACHE_TTL = args.cache_ttl
+    gpwm.cache.FETCH_CACHE_MAX_SIZE = args.fetch_cache_max_size
+    if args.no_cache:
+        gpwm.cache.CACHE_BACKEND = "memory"
+    # also configured when already loaded, eg by a previous daemon request
+    if not args.local_validation or args.remote_validation or \
+            args.template_bucket or \
+            args.nested_stack_size or "gpwm.stacks.aws" in sys.modules:
+        configure_cloudformation_stacks(args)
+
+    gpwm.ratelimit.RATE_LIMIT = args.rate_limit
+    gpwm.ratelimit.RATE_LIMIT_BURST = args.rate_limit_burst
+    gpwm.ratelimit.RATE_LIMIT_MIN = args.rate_limit_min
+    gpwm.metrics.ENABLED = bool(args.metrics_out)
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.runcall(run, args)
+        else:
+            run(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+        if args.metrics_out:
+            gpwm.metrics.write(args.metrics_out, args.metrics_format)
+        sys.stderr.write(gpwm.ratelimit.format_summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Thin client of the gpwm daemon (see gpwm.server)
+
+This is the "gpwm" entry point. When a daemon is listening on SOCKET_PATH,
+the command line is sent to it and executed there, with warm provider
+clients and caches. Otherwise, or when the daemon is busy with another
+request, the command is executed in this process, as usual.
+
+Only the standard library is imported here, so a request to the daemon
+doesn't pay for the imports the daemon exists to avoid.
+
+Protocol: the client sends one JSON line with the request (argv, cwd, env
+and tty, telling if stdin is a terminal). The daemon answers with a JSON
+line with one key: "busy" (the client executes the command itself) or
+"accepted". Once accepted, the client sends its stdin as it's read, in
+"stdin" messages (null at the end of the input), and the daemon answers
+with JSON lines, each with one key: "stdout" or "stderr" (text written by
+the command), or "exit" (the exit code, always the last line).
+"""
+
+
+from __future__ import print_function
+import codecs
+import json
+import os
+import socket
+import sys
+import threading
+
+
+# The Unix socket the daemon listens on
+SOCKET_PATH = os.getenv(
+    "GPWM_SOCKET",
+    os.path.join(
+        os.getenv(
+            "GPWM_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "gpwm")
+        ),
+        "gpwm.sock"
+    )
+)
+
+# Actions always executed in the client process
+LOCAL_ACTIONS = ["serve"]
+
+# Options of gpwm.cli's top level parser not taking a value. All others
+# take one
+FLAG_OPTIONS = [
+    "--dry-run",
+    "--help",
+    "--no-cache",
+    "--no-local-validation",
+    "--remote-validation",
+    "-h"
+]
+
+# Options of the update and upsert actions taking a value
+ACTION_VALUE_OPTIONS = ["--build-id", "--templating-engine", "-b", "-t"]
+
+# Size (in bytes) of the reads of stdin
+READ_SIZE = 65536
+
+
+def takes_value(option, flag_options):
+    """ Tells if a top level option is followed by its value
+
+    Long options can be abbreviated, as argparse allows.
+    """
+    if option.startswith("--"):
+        return "=" not in option and \
+            not any(f.startswith(option) for f in flag_options)
+    # eg -lerror
+    return len(option) == 2 and option not in flag_options
+
+
+def parse_command(argv):
+    """ Finds the action of a command line, and if changes are reviewed
+
+    Only the options gpwm.cli defines for update and upsert are known here:
+    updates are reviewed with --review/-r, and upserts unless --no-review
+    is given.
+
+    Returns: A tuple with the action (None if missing) and a boolean
+    """
+    action = None
+    args = iter(argv)
+    for arg in args:
+        if arg == "--":
+            action = next(args, None)
+            break
+        if not arg.startswith("-") or arg == "-":
+            action = arg
+            break
+        if takes_value(arg, FLAG_OPTIONS):
+            next(args, None)
+    review = action == "upsert"
+    for arg in args:
+        if arg == "--":
+            break
+        if arg in ["--review", "-r"]:
+            review = True
+        elif arg == "--no-review":
+            review = False
+        elif arg in ACTION_VALUE_OPTIONS:
+            next(args, None)
+        elif arg.startswith("-") and not arg.startswith("--"):
+            # combined short options, eg -wr. -t and -b take the rest of
+            # the argument as their value
+            for flag in arg[1:]:
+                if flag in "tb":
+                    break
+                if flag == "r":
+                    review = True
+    return action, review and action in ["update", "upsert"]
+
+
+def send_message(stream, message):
+    """ Writes a message as a JSON line to a binary stream
+    """
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def read_message(stream):
+    """ Reads a JSON line message from a binary stream
+
+    Returns: The message, or None if the stream was closed
+    """
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
+def connect(path=None):
+    """ Connects to the daemon
+
+    Returns: The connected socket, or None if no daemon is listening
+    """
+    path = path or SOCKET_PATH
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def forward_stdin(stream):
+    """ Sends stdin to the daemon as it's read, until the end of the input
+
+    Runs in a daemon thread, as the command may exit without reading all of
+    it (eg a terminal).
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    try:
+        fileno = sys.stdin.fileno()
+    except (AttributeError, ValueError, OSError):
+        fileno = None
+    try:
+        while fileno is not None:
+            data = os.read(fileno, READ_SIZE)
+            text = decoder.decode(data, final=not data)
+            if text:
+                send_message(stream, {"stdin": text})
+            if not data:
+                break
+        send_message(stream, {"stdin": None})
+    except (IOError, OSError, ValueError):
+        # the daemon went away, or the request is over
+        pass
+
+
+def request(sock, argv):
+    """ Executes a command line in the daemon
+
+    Args:
+        sock(socket): The socket connected to the daemon
+        argv(list): The command line arguments
+
+    Returns: The exit code of the command, or None if the daemon is busy
+    """
+    try:
+        tty = sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        tty = False
+    with sock.makefile("rb") as stream, sock.makefile("wb") as output:
+        send_message(output, {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "tty": tty
+        })
+        message = read_message(stream)
+        if message is None:
+            print("Lost the connection to the gpwm daemon", file=sys.stderr)
+            return 1
+        if message.get("busy"):
+            return None
+        threading.Thread(
+            target=forward_stdin,
+            args=(output,),
+            daemon=True
+        ).start()
+        while True:
+            message = read_message(stream)
+            if message is None:
+                print("Lost the connection to the gpwm daemon",
+                      file=sys.stderr)
+                return 1
+            if "exit" in message:
+                return message["exit"]
+            for name, text in message.items():
+                stream_out = sys.stdout if name == "stdout" else sys.stderr
+                stream_out.write(text)
+                stream_out.flush()
+
+
+def main(argv=None):
+    """ Entry point
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    action, review = parse_command(argv)
+    # change set reviews prompt the user, so they're executed in this
+    # process too
+    local = action in LOCAL_ACTIONS or review
+    sock = None if local else connect()
+    if sock is None:
+        import gpwm.cli
+        return gpwm.cli.main(argv)
+    try:
+        code = request(sock, argv)
+    finally:
+        sock.close()
+    if code is None:
+        print("gpwm daemon busy, running in this process", file=sys.stderr)
+        import gpwm.cli
+        return gpwm.cli.main(argv)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
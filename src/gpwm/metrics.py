@@ -0,0 +1,285 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Timing of the execution phases and of the provider API calls
+
+Phases (template compilation, rendering, yaml loading, tag resolution,
+validation, waiting, etc) and API calls are recorded as spans, which can be
+reported as a summary table, JSON, or in Chrome's trace event format (to be
+loaded in chrome://tracing or https://ui.perfetto.dev).
+
+Nothing is recorded unless ENABLED is set.
+"""
+
+
+from __future__ import print_function
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+ENABLED = False
+
+METRICS_FORMATS = ["table", "json", "chrome"]
+
+# Error codes AWS uses for throttling
+THROTTLING_ERROR_CODES = [
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown"
+]
+
+SPANS = []
+SPANS_LOCK = threading.Lock()
+START_TIME = time.time()
+
+
+def record(category, name, start, duration, **args):
+    """ Records a span
+
+    Args:
+        category(str): "phase" or "api"
+        name(str): What happened, eg "render" or
+            "cloudformation.DescribeStacks"
+        start(float): The start timestamp
+        duration(float): The duration in seconds
+        args: Details, eg the stack name or the number of retries
+    """
+    if not ENABLED:
+        return
+    with SPANS_LOCK:
+        SPANS.append({
+            "category": category,
+            "name": name,
+            "start": start,
+            "duration": duration,
+            "thread": threading.current_thread().ident,
+            "args": args
+        })
+
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """ Times a phase of the execution
+
+    Usage:
+        with gpwm.metrics.phase("render", engine="mako"):
+            ...
+    """
+    if not ENABLED:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record("phase", name, start, time.time() - start, **args)
+
+
+@contextlib.contextmanager
+def api_call(provider, operation, **args):
+    """ Times an API call
+    """
+    if not ENABLED:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(
+            "api",
+            "{}.{}".format(provider, operation),
+            start,
+            time.time() - start,
+            **args
+        )
+
+
+def instrument_boto_client(client):
+    """ Registers botocore event hooks timing every call of a client
+
+    Calls are timed from before the first attempt to after the last one,
+    so the time spent in retries is included. The retries and the
+    throttling errors that caused them are counted too.
+    """
+    service = client.meta.service_model.service_name
+
+    def before_parameter_build(context, **kwargs):
+        context["gpwm_start"] = time.time()
+        context["gpwm_throttles"] = 0
+
+    def needs_retry(response, request_dict=None, **kwargs):
+        if response is None:
+            return
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in THROTTLING_ERROR_CODES and \
+                request_dict is not None:
+            context = request_dict.get("context", {})
+            context["gpwm_throttles"] = context.get("gpwm_throttles", 0) + 1
+
+    def after_call(parsed, model, context, **kwargs):
+        start = context.get("gpwm_start")
+        if start is None:
+            return
+        record(
+            "api",
+            "{}.{}".format(service, model.name),
+            start,
+            time.time() - start,
+            retries=parsed.get("ResponseMetadata", {}).get(
+                "RetryAttempts",
+                0
+            ),
+            throttles=context.get("gpwm_throttles", 0),
+            error=parsed.get("Error", {}).get("Code")
+        )
+
+    # emitted before "before-call", which handlers (eg stubs) can
+    # short-circuit
+    client.meta.events.register(
+        "before-parameter-build",
+        before_parameter_build
+    )
+    client.meta.events.register("needs-retry", needs_retry)
+    client.meta.events.register("after-call", after_call)
+    return client
+
+
+def summarize():
+    """ Aggregates the spans by category and name
+
+    Returns: A list of dicts, one per category and name, sorted by total
+        time, slowest first
+    """
+    summary = {}
+    with SPANS_LOCK:
+        spans = list(SPANS)
+    for span in spans:
+        entry = summary.setdefault((span["category"], span["name"]), {
+            "category": span["category"],
+            "name": span["name"],
+            "count": 0,
+            "total": 0.0,
+            "max": 0.0,
+            "retries": 0,
+            "throttles": 0,
+            "errors": 0
+        })
+        entry["count"] += 1
+        entry["total"] += span["duration"]
+        entry["max"] = max(entry["max"], span["duration"])
+        entry["retries"] += span["args"].get("retries", 0)
+        entry["throttles"] += span["args"].get("throttles", 0)
+        entry["errors"] += 1 if span["args"].get("error") else 0
+    for entry in summary.values():
+        entry["mean"] = entry["total"] / entry["count"]
+    return sorted(summary.values(), key=lambda e: -e["total"])
+
+
+def format_table():
+    """ Returns the summary as a text table
+    """
+    row = "{:<6} {:<40} {:>6} {:>9} {:>9} {:>9} {:>7} {:>9} {:>6}"
+    lines = [row.format(
+        "TYPE", "NAME", "COUNT", "TOTAL(s)", "MEAN(s)", "MAX(s)",
+        "RETRIES", "THROTTLES", "ERRORS"
+    )]
+    for entry in summarize():
+        lines.append(
+            row.format(
+                entry["category"],
+                entry["name"][:40],
+                entry["count"],
+                "{:.3f}".format(entry["total"]),
+                "{:.3f}".format(entry["mean"]),
+                "{:.3f}".format(entry["max"]),
+                entry["retries"],
+                entry["throttles"],
+                entry["errors"]
+            )
+        )
+    lines.append("Wall time: {:.3f}s".format(time.time() - START_TIME))
+    return "\n".join(lines) + "\n"
+
+
+def format_json():
+    """ Returns the summary and all spans as JSON
+    """
+    with SPANS_LOCK:
+        spans = list(SPANS)
+    return json.dumps({
+        "wall_time": time.time() - START_TIME,
+        "summary": summarize(),
+        "spans": spans
+    }, indent=2, default=str) + "\n"
+
+
+def format_chrome():
+    """ Returns the spans in Chrome's trace event format
+    """
+    with SPANS_LOCK:
+        spans = list(SPANS)
+    events = [{
+        "name": span["name"],
+        "cat": span["category"],
+        "ph": "X",
+        "ts": int((span["start"] - START_TIME) * 1000000),
+        "dur": int(span["duration"] * 1000000),
+        "pid": os.getpid(),
+        "tid": span["thread"],
+        "args": span["args"]
+    } for span in spans]
+    return json.dumps({"traceEvents": events}, default=str) + "\n"
+
+
+def write(path, metrics_format="table"):
+    """ Writes the metrics
+
+    Args:
+        path(str): The output file, or "-" for stderr
+        metrics_format(str): "table", "json" or "chrome"
+    """
+    formatters = {
+        "table": format_table,
+        "json": format_json,
+        "chrome": format_chrome
+    }
+    if metrics_format not in formatters:
+        raise SystemExit("Metrics format not supported: {}".format(
+            metrics_format
+        ))
+    content = formatters[metrics_format]()
+    if path == "-":
+        sys.stderr.write(content)
+    else:
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def reset():
+    """ Drops all recorded spans
+    """
+    global START_TIME
+    with SPANS_LOCK:
+        del SPANS[:]
+    START_TIME = time.time()
@@ -0,0 +1,524 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Splitting of large Cloudformation templates into nested stacks
+
+The resources of a rendered template are partitioned into child templates,
+which become AWS::CloudFormation::Stack resources of a parent template.
+References between resources in different children are rewritten into
+parameters of the referencing child, fed by outputs of the referenced one.
+
+Resources that don't reference each other, directly or indirectly, are
+kept in independent children, so Cloudformation can deploy them in
+parallel.
+
+Pseudo parameters identifying the stack (AWS::StackName, AWS::StackId)
+would refer to the child stack in the children, so they're passed down by
+the parent as parameters too.
+"""
+
+
+import copy
+import re
+
+import six
+
+
+# Tag set on parent stacks, so gpwm knows to look for outputs and resources
+# in their children
+NESTED_STACKS_TAG = "gpwm_nested_stacks"
+
+# Prefix of the logical IDs of the nested stacks in the parent template
+NESTED_STACK_PREFIX = "NestedStack"
+
+# Cloudformation limit
+MAX_OUTPUTS = 200
+
+# Pseudo parameters the parent passes to the children, as they must keep
+# referring to the parent stack
+PARENT_PSEUDO_PARAMETERS = ["AWS::StackName", "AWS::StackId"]
+
+SUB_VARIABLE_REGEX = re.compile(r"\$\{([^!][^}]*)\}")
+
+
+def find_references(value, names):
+    """ Finds the references to the given names in a value
+
+    Args:
+        value: Any part of a template
+        names(container): The logical IDs of interest
+
+    Returns: A set of (name, attribute) tuples, where attribute is None for
+        Ref and the attribute name for Fn::GetAtt and Fn::Sub
+    """
+    references = set()
+
+    def walk(value):
+        if isinstance(value, list):
+            for item in value:
+                walk(item)
+        elif isinstance(value, dict):
+            if len(value) == 1:
+                function, arguments = list(value.items())[0]
+                if function == "Ref" and arguments in names:
+                    references.add((arguments, None))
+                    return
+                if function == "Fn::GetAtt":
+                    if isinstance(arguments, six.string_types):
+                        arguments = arguments.split(".", 1)
+                    if isinstance(arguments, list) and \
+                            len(arguments) == 2 and \
+                            arguments[0] in names and \
+                            isinstance(arguments[1], six.string_types):
+                        references.add(tuple(arguments))
+                        return
+                if function == "Fn::Sub":
+                    variables = {}
+                    if isinstance(arguments, list) and len(arguments) == 2:
+                        arguments, variables = arguments
+                        walk(variables)
+                    if isinstance(arguments, six.string_types):
+                        for variable in SUB_VARIABLE_REGEX.findall(arguments):
+                            name, _, attribute = variable.partition(".")
+                            if name in names and name not in variables:
+                                references.add((name, attribute or None))
+                    return
+            for item in value.values():
+                walk(item)
+
+    walk(value)
+    return references
+
+
+def rewrite_references(value, replace):
+    """ Rewrites the references to resources in a value
+
+    Args:
+        value: Any part of a template
+        replace(function): Takes the (name, attribute) of a reference and
+            returns what replaces it, or None to keep the reference.
+            Replacements are "Name" for a Ref or "Name.Attribute" for a
+            Fn::GetAtt, so they can also be used in Fn::Sub strings.
+
+    Returns: The rewritten value
+    """
+    def intrinsic(replacement):
+        if "." in replacement:
+            return {"Fn::GetAtt": replacement.split(".", 1)}
+        return {"Ref": replacement}
+
+    if isinstance(value, list):
+        return [rewrite_references(v, replace) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        function, arguments = list(value.items())[0]
+        if function == "Ref" and isinstance(arguments, six.string_types):
+            replacement = replace(arguments, None)
+            return intrinsic(replacement) if replacement else value
+        if function == "Fn::GetAtt":
+            if isinstance(arguments, six.string_types):
+                arguments = arguments.split(".", 1)
+            if isinstance(arguments, list) and len(arguments) == 2 and \
+                    isinstance(arguments[0], six.string_types) and \
+                    isinstance(arguments[1], six.string_types):
+                replacement = replace(*arguments)
+                return intrinsic(replacement) if replacement else value
+        if function == "Fn::Sub":
+            variables = {}
+            if isinstance(arguments, list) and len(arguments) == 2:
+                arguments, variables = arguments
+            if isinstance(arguments, six.string_types):
+                def sub(match):
+                    name, _, attribute = match.group(1).partition(".")
+                    if name in variables:
+                        return match.group(0)
+                    replacement = replace(name, attribute or None)
+                    if replacement:
+                        return "${" + replacement + "}"
+                    return match.group(0)
+                arguments = SUB_VARIABLE_REGEX.sub(sub, arguments)
+                if variables:
+                    return {"Fn::Sub": [
+                        arguments,
+                        rewrite_references(variables, replace)
+                    ]}
+                return {"Fn::Sub": arguments}
+    return {k: rewrite_references(v, replace) for k, v in value.items()}
+
+
+def reference_name(name, attribute):
+    """ Returns the name of the parameter/output carrying a reference
+
+    The name may be taken by a logical ID of the template, see
+    split_template() for how collisions are avoided.
+    """
+    if name in PARENT_PSEUDO_PARAMETERS:
+        return "Parent" + name.split("::", 1)[1]
+    if attribute is None:
+        return "{}Ref".format(name)
+    return name + re.sub(r"[^A-Za-z0-9]", "", attribute)
+
+
+def get_dependencies(resources):
+    """ Returns a dict mapping each resource to the resources it depends on
+    """
+    dependencies = {}
+    for name, resource in resources.items():
+        depends_on = resource.get("DependsOn", [])
+        if isinstance(depends_on, six.string_types):
+            depends_on = [depends_on]
+        dependencies[name] = {
+            r for r, _ in find_references(resource, resources)
+        } | {r for r in depends_on if r in resources}
+        dependencies[name].discard(name)
+    return dependencies
+
+
+def get_referrers(resources, outputs):
+    """ Returns what references every referenced resource (or attribute)
+
+    Args:
+        resources(dict): The resources of the template
+        outputs(dict): The outputs of the template
+
+    Returns: A dict mapping the (name, attribute) of every reference made
+        to a resource to the set of resources making it. References made by
+        outputs are recorded as None
+    """
+    referrers = {}
+    for name, resource in resources.items():
+        for reference in find_references(resource, resources):
+            if reference[0] != name:
+                referrers.setdefault(reference, set()).add(name)
+    for output in outputs.values():
+        for reference in find_references(output, resources):
+            referrers.setdefault(reference, set()).add(None)
+    return referrers
+
+
+def count_outputs(partition, referrers):
+    """ Returns the number of outputs the child template of a partition
+    needs: one per reference made to its resources from outside of it
+    """
+    members = set(partition)
+    return sum(
+        1 for (name, _), referencing in referrers.items()
+        if name in members and referencing - members
+    )
+
+
+def partition_resources(resources, size, outputs=None):
+    """ Partitions resources in groups of at most size resources
+
+    Resources connected by references are kept together when possible.
+    Groups of connected resources bigger than size are split in topological
+    order, so references between partitions never form cycles. Partitions
+    are also kept under the outputs limit of Cloudformation, counting an
+    output per reference made from another partition or from the outputs of
+    the template.
+
+    Args:
+        resources(dict): The resources of the template
+        size(int): The maximum number of resources per partition
+        outputs(dict): The outputs of the template
+
+    Returns: A list of partitions, each a list of resource names
+    """
+    dependencies = get_dependencies(resources)
+    referrers = get_referrers(resources, outputs or {})
+
+    # connected components, with union-find
+    parents = {name: name for name in resources}
+
+    def find(name):
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    for name, deps in dependencies.items():
+        for dep in deps:
+            parents[find(dep)] = find(name)
+    components = {}
+    for name in resources:
+        components.setdefault(find(name), []).append(name)
+
+    # dependencies first
+    def topological(names):
+        ordered = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dep in sorted(dependencies[name]):
+                visit(dep)
+            ordered.append(name)
+
+        for name in sorted(names):
+            visit(name)
+        return ordered
+
+    partitions = []
+    small = []
+    for component in components.values():
+        component_outputs = count_outputs(component, referrers)
+        if len(component) > size or component_outputs > MAX_OUTPUTS:
+            partition = []
+            for name in topological(component):
+                if partition and (
+                        len(partition) >= size or
+                        count_outputs(partition + [name], referrers) >
+                        MAX_OUTPUTS):
+                    partitions.append(partition)
+                    partition = []
+                partition.append(name)
+            partitions.append(partition)
+        else:
+            small.append((component, component_outputs))
+
+    # first-fit decreasing of the components that don't reference each
+    # other, so their outputs add up
+    bins = []
+    for component, component_outputs in sorted(
+            small,
+            key=lambda c: (-len(c[0]), sorted(c[0]))):
+        for partition in bins:
+            if len(partition[0]) + len(component) <= size and \
+                    partition[1] + component_outputs <= MAX_OUTPUTS:
+                partition[0].extend(component)
+                partition[1] += component_outputs
+                break
+        else:
+            bins.append([list(component), component_outputs])
+    return partitions + [names for names, _ in bins]
+
+
+def forwarded_parameter(parameter):
+    """ Returns the child's definition of a parameter of the parent
+    """
+    parameter = copy.deepcopy(parameter)
+    # SSM parameters are resolved by the parent
+    if parameter.get("Type", "").startswith("AWS::SSM::Parameter::Value<"):
+        parameter["Type"] = "String"
+    return parameter
+
+
+def forwarded_value(name, parameter):
+    """ Returns the value the parent passes for one of its parameters
+
+    Nested stack parameters are strings, so lists are joined with commas.
+    """
+    parameter_type = parameter.get("Type", "")
+    if parameter_type == "CommaDelimitedList" or \
+            parameter_type.startswith("List<") or \
+            parameter_type.startswith("AWS::SSM::Parameter::Value<List<"):
+        return {"Fn::Join": [",", {"Ref": name}]}
+    return {"Ref": name}
+
+
+def split_template(template, size):
+    """ Splits a template into a parent template and nested child templates
+
+    Args:
+        template(dict): The rendered template
+        size(int): The maximum number of resources per child template
+
+    Returns: A tuple with the parent template and a dict mapping the
+        logical IDs of the nested stacks to their templates. The TemplateURL
+        property of the nested stacks must be filled in by the caller.
+    """
+    resources = template.get("Resources", {})
+    parameters = template.get("Parameters", {})
+    partitions = partition_resources(
+        resources,
+        size,
+        template.get("Outputs", {})
+    )
+
+    # the generated parameters, outputs and nested stacks must not take the
+    # logical IDs already in use
+    taken = set()
+    for section in ["Parameters", "Mappings", "Conditions", "Resources",
+                    "Outputs"]:
+        taken.update(template.get(section, {}))
+    carriers = {}
+
+    def carrier(name, attribute):
+        """ Returns the unique name of the parameter/output carrying a
+        reference
+        """
+        if (name, attribute) not in carriers:
+            base = candidate = reference_name(name, attribute)
+            n = 2
+            while candidate in taken:
+                candidate = "{}{}".format(base, n)
+                n += 1
+            taken.add(candidate)
+            carriers[(name, attribute)] = candidate
+        return carriers[(name, attribute)]
+
+    stack_names = []
+    n = 1
+    while len(stack_names) < len(partitions):
+        stack_name = "{}{}".format(NESTED_STACK_PREFIX, n)
+        if stack_name not in taken:
+            stack_names.append(stack_name)
+        n += 1
+    owners = {}
+    for stack_name, partition in zip(stack_names, partitions):
+        for name in partition:
+            owners[name] = stack_name
+
+    children = {}
+    child_parameters = {}
+    child_outputs = {}
+    nested_dependencies = {}
+
+    def child_replace(stack_name):
+        """ Returns the rewrite_references() function for a child
+        """
+        def replace(name, attribute):
+            if name in PARENT_PSEUDO_PARAMETERS:
+                parameter = carrier(name, None)
+                child_parameters[stack_name][parameter] = {
+                    "Value": {"Ref": name},
+                    "Definition": {"Type": "String"}
+                }
+                return parameter
+            if owners.get(name, stack_name) == stack_name:
+                return None
+            parameter = carrier(name, attribute)
+            child_parameters[stack_name][parameter] = {
+                "Value": {"Fn::GetAtt": [
+                    owners[name],
+                    "Outputs.{}".format(parameter)
+                ]},
+                "Definition": {"Type": "String"}
+            }
+            child_outputs.setdefault(owners[name], {})[parameter] = {
+                "Value": {"Fn::GetAtt": [name, attribute]}
+                if attribute else {"Ref": name}
+            }
+            return parameter
+        return replace
+
+    for stack_name, partition in zip(stack_names, partitions):
+        children[stack_name] = {
+            "AWSTemplateFormatVersion": "2010-09-09",
+            "Resources": {}
+        }
+        child_parameters[stack_name] = {}
+        child_outputs.setdefault(stack_name, {})
+        nested_dependencies[stack_name] = set()
+
+        replace = child_replace(stack_name)
+        for name in partition:
+            resource = rewrite_references(resources[name], replace)
+            depends_on = resource.pop("DependsOn", [])
+            if isinstance(depends_on, six.string_types):
+                depends_on = [depends_on]
+            local = [r for r in depends_on if owners.get(r) == stack_name]
+            if local:
+                resource["DependsOn"] = local
+            nested_dependencies[stack_name].update(
+                owners[r] for r in depends_on
+                if r in owners and owners[r] != stack_name
+            )
+            children[stack_name]["Resources"][name] = resource
+
+    # outputs stay in the parent, unless there are too many
+    outputs = {}
+    moved_outputs = 0
+    for name, output in template.get("Outputs", {}).items():
+        referenced = {
+            owners[r] for r, _ in find_references(output, resources)
+        }
+        if len(template.get("Outputs", {})) - moved_outputs > MAX_OUTPUTS \
+                and len(referenced) == 1:
+            owner = referenced.pop()
+            child_outputs[owner][name] = rewrite_references(
+                output,
+                child_replace(owner)
+            )
+            moved_outputs += 1
+            continue
+
+        def replace_in_parent(name, attribute):
+            if name not in owners:
+                return None
+            output_name = carrier(name, attribute)
+            child_outputs[owners[name]][output_name] = {
+                "Value": {"Fn::GetAtt": [name, attribute]}
+                if attribute else {"Ref": name}
+            }
+            return "{}.Outputs.{}".format(owners[name], output_name)
+
+        outputs[name] = rewrite_references(output, replace_in_parent)
+
+    # everything else children need comes from the parent
+    for stack_name, child in children.items():
+        if len(child_outputs[stack_name]) > MAX_OUTPUTS:
+            raise SystemExit("Nested stack {} needs {} outputs, more than "
+                             "the maximum of {}".format(
+                                 stack_name,
+                                 len(child_outputs[stack_name]),
+                                 MAX_OUTPUTS
+                             ))
+        if child_outputs[stack_name]:
+            child["Outputs"] = child_outputs[stack_name]
+        if "Mappings" in template:
+            child["Mappings"] = copy.deepcopy(template["Mappings"])
+        if "Conditions" in template:
+            child["Conditions"] = rewrite_references(
+                template["Conditions"],
+                child_replace(stack_name)
+            )
+        for parameter, _ in find_references(child, parameters):
+            child_parameters[stack_name][parameter] = {
+                "Value": forwarded_value(parameter, parameters[parameter]),
+                "Definition": forwarded_parameter(parameters[parameter])
+            }
+        if child_parameters[stack_name]:
+            child["Parameters"] = {
+                k: v["Definition"]
+                for k, v in child_parameters[stack_name].items()
+            }
+
+    parent = {
+        k: copy.deepcopy(v) for k, v in template.items()
+        if k not in ["Resources", "Outputs"]
+    }
+    parent["Resources"] = {}
+    for stack_name in children:
+        nested_stack = {
+            "Type": "AWS::CloudFormation::Stack",
+            "Properties": {}
+        }
+        if child_parameters[stack_name]:
+            nested_stack["Properties"]["Parameters"] = {
+                k: v["Value"]
+                for k, v in child_parameters[stack_name].items()
+            }
+        if nested_dependencies[stack_name]:
+            nested_stack["DependsOn"] = sorted(
+                nested_dependencies[stack_name]
+            )
+        parent["Resources"][stack_name] = nested_stack
+    if outputs:
+        parent["Outputs"] = outputs
+    return parent, children
@@ -0,0 +1,254 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Client-side rate limiting of the provider API calls
+
+Every API request (including the retries made by botocore) takes a token
+from the bucket of its (provider, service, region). Buckets start at
+RATE_LIMIT requests per second, and adapt to the throttling responses
+of the provider (AIMD): the rate is cut by MULTIPLICATIVE_DECREASE on
+throttling, and grows back by ADDITIVE_INCREASE per successful request.
+
+All API call sites share the buckets, as they're all made through the
+clients of gpwm.utils.get_boto_client() and gpwm.utils.get_gcp_api().
+"""
+
+
+from __future__ import print_function
+import os
+import threading
+import time
+
+import gpwm.metrics
+
+
+# Initial (and maximum) requests per second per bucket. 0 disables rate
+# limiting
+RATE_LIMIT = float(os.getenv("GPWM_RATE_LIMIT", 20))
+
+# Requests that can be made at once after a quiet period. Defaults to
+# RATE_LIMIT
+RATE_LIMIT_BURST = float(os.getenv("GPWM_RATE_LIMIT_BURST", 0))
+
+# The rate never goes below this, however many throttling errors
+RATE_LIMIT_MIN = float(os.getenv("GPWM_RATE_LIMIT_MIN", 0.5))
+
+MULTIPLICATIVE_DECREASE = 0.5
+ADDITIVE_INCREASE = 0.1
+
+# Throttling errors of requests sent before the last decrease were caused
+# by the old rate, so the rate is cut at most once in this many seconds
+DECREASE_COOLDOWN = 1.0
+
+# GCP error reasons meaning the request was throttled
+GCP_THROTTLING_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+BUCKETS = {}
+BUCKETS_LOCK = threading.Lock()
+# The settings the buckets were created with
+BUCKETS_SETTINGS = None
+
+
+class TokenBucket(object):
+    """ A token bucket with an adaptive rate
+
+    Tokens are reserved even when the bucket is empty, so concurrent
+    callers are served in order, each sleeping until its token is due.
+
+    Attributes:
+        rate(float): The current rate, in tokens per second
+        throttles(int): The number of throttling errors seen
+        waited(float): The total time callers slept waiting for tokens
+    """
+    def __init__(self, rate, burst, min_rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.throttles = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Takes a token
+
+        Returns: How long (in seconds) the caller must wait for the token
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            self.requests += 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        """ Takes a token, sleeping until it's available
+        """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE)
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.time()
+            if now - self.last_decrease < DECREASE_COOLDOWN:
+                return
+            self.last_decrease = now
+            self.rate = max(
+                self.min_rate,
+                self.rate * MULTIPLICATIVE_DECREASE
+            )
+
+
+def get_bucket(key):
+    """ Returns the (lazily created) bucket of a key
+
+    The buckets are built according to RATE_LIMIT, RATE_LIMIT_BURST and
+    RATE_LIMIT_MIN, and built again if they change (eg between the requests
+    served by the daemon).
+
+    Args:
+        key(tuple): (provider, service, region), eg
+            ("aws", "cloudformation", "us-east-1")
+
+    Returns: The TokenBucket, or None if rate limiting is disabled
+    """
+    global BUCKETS_SETTINGS
+    if RATE_LIMIT <= 0:
+        return None
+    settings = (RATE_LIMIT, RATE_LIMIT_BURST, RATE_LIMIT_MIN)
+    bucket = BUCKETS.get(key)
+    if bucket is None or BUCKETS_SETTINGS != settings:
+        with BUCKETS_LOCK:
+            if BUCKETS_SETTINGS != settings:
+                BUCKETS.clear()
+                BUCKETS_SETTINGS = settings
+            bucket = BUCKETS.setdefault(key, TokenBucket(
+                RATE_LIMIT,
+                RATE_LIMIT_BURST or RATE_LIMIT,
+                RATE_LIMIT_MIN
+            ))
+    return bucket
+
+
+def instrument_boto_client(client):
+    """ Registers botocore event hooks rate limiting a client
+
+    A token is taken for every attempt, so botocore's retries are rate
+    limited too, and the outcome of every attempt adapts the rate. The
+    bucket is looked up on every attempt, so clients follow the current
+    settings.
+    """
+    key = (
+        "aws",
+        client.meta.service_model.service_name,
+        client.meta.region_name or "global"
+    )
+
+    def request_created(**kwargs):
+        bucket = get_bucket(key)
+        if bucket is not None:
+            bucket.acquire()
+
+    def needs_retry(response, **kwargs):
+        bucket = get_bucket(key)
+        if response is None or bucket is None:
+            return
+        error_code = response[1].get("Error", {}).get("Code")
+        if error_code in gpwm.metrics.THROTTLING_ERROR_CODES:
+            bucket.on_throttle()
+        else:
+            bucket.on_success()
+
+    client.meta.events.register("request-created", request_created)
+    client.meta.events.register("needs-retry", needs_retry)
+    return client
+
+
+def is_gcp_throttle(exc):
+    """ Tells if a googleapiclient HttpError is a throttling error
+    """
+    status = str(exc.resp.get("status", ""))
+    if status == "429":
+        return True
+    return status == "403" and any(
+        reason in str(exc.content) for reason in GCP_THROTTLING_REASONS
+    )
+
+
+def summarize():
+    """ Returns the state of the buckets, sorted by key
+    """
+    with BUCKETS_LOCK:
+        buckets = sorted(BUCKETS.items(), key=lambda i: i[0])
+    return [{
+        "provider": key[0],
+        "service": key[1],
+        "region": key[2],
+        "requests": bucket.requests,
+        "throttles": bucket.throttles,
+        "waited": bucket.waited,
+        "rate": bucket.rate
+    } for key, bucket in buckets]
+
+
+def format_summary():
+    """ Returns the summary of the throttled buckets as text, or an empty
+    string if nothing was throttled
+    """
+    lines = [
+        "{provider} {service} {region}: {throttles} throttled out of "
+        "{requests} requests, {waited:.1f}s waited, rate now "
+        "{rate:.1f}/s".format(**entry)
+        for entry in summarize() if entry["throttles"]
+    ]
+    if not lines:
+        return ""
+    return "Throttling:\n{}\n".format(
+        "\n".join("  - {}".format(line) for line in lines)
+    )
+
+
+def reset():
+    """ Drops all buckets
+    """
+    with BUCKETS_LOCK:
+        BUCKETS.clear()
+
+
+def reset_stats():
+    """ Zeroes the counters of all buckets, keeping their adapted rates
+    """
+    with BUCKETS_LOCK:
+        for bucket in BUCKETS.values():
+            with bucket.lock:
+                bucket.requests = 0
+                bucket.throttles = 0
+                bucket.waited = 0.0
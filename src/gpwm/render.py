@@ -0,0 +1,200 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Batch rendering
+
+Renders all stack files in a directory tree with a pool of processes, so
+the templating and yaml work of many stacks is spread across all cores.
+
+Workers share the on-disk caches: a template is compiled once for all of
+them, and stack outputs looked up by one worker are found in the stack
+cache by the others (unless the cache is memory only).
+
+For every stack file, the stack attributes and the rendered stack are
+written to the output directory, at the path of the stack file relative to
+the rendered directory, with ".attributes.yaml" and ".yaml" appended. A
+manifest with the content hashes of all files is written last.
+"""
+
+
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+
+import gpwm.apply
+import gpwm.cache
+import gpwm.stacks
+import gpwm.utils
+
+
+MANIFEST_FILE = "manifest.json"
+
+# Module settings the worker processes get from the parent, as the command
+# line options are applied to the parent only
+WORKER_SETTINGS = [
+    ("gpwm.utils", "CACHE_DIR"),
+    ("gpwm.utils", "TEMPLATE_CACHE_DIR"),
+    ("gpwm.utils", "MAX_POOL_CONNECTIONS"),
+    ("gpwm.cache", "CACHE_TTL"),
+    ("gpwm.cache", "CACHE_BACKEND"),
+    ("gpwm.cache", "FETCH_CACHE_MAX_SIZE"),
+    ("gpwm.ratelimit", "RATE_LIMIT"),
+    ("gpwm.ratelimit", "RATE_LIMIT_BURST"),
+    ("gpwm.ratelimit", "RATE_LIMIT_MIN"),
+    ("gpwm.stacks.aws", "LOCAL_VALIDATION"),
+    ("gpwm.stacks.aws", "REMOTE_VALIDATION"),
+    ("gpwm.stacks.aws", "TEMPLATE_BUCKET"),
+    ("gpwm.stacks.aws", "NESTED_STACK_SIZE"),
+]
+
+
+def get_worker_settings():
+    """ Returns the values of WORKER_SETTINGS in the loaded modules
+    """
+    return {
+        (module, attribute): getattr(sys.modules[module], attribute)
+        for module, attribute in WORKER_SETTINGS
+        if module in sys.modules
+    }
+
+
+def configure_worker(settings):
+    """ Applies the parent's settings to a worker process
+
+    Workers forked by the daemon inherit the streams of the request, which
+    send messages to the client from the parent process only. The output
+    of the workers goes to the streams of the process instead, so it never
+    corrupts the protocol.
+
+    Forked workers also inherit the stack cache and the provider clients of
+    the parent, with its sqlite connection and open HTTP connections, so
+    they are dropped and every worker creates its own.
+    """
+    streams = [sys.stdout, sys.stderr]
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    for handler in logging.getLogger().handlers:
+        if any(getattr(handler, "stream", None) is s for s in streams):
+            handler.setStream(sys.__stderr__)
+    gpwm.cache.STACK_CACHE = None
+    gpwm.cache.STACK_CACHE_SETTINGS = None
+    gpwm.utils.PROVIDER_CLIENTS.clear()
+    gpwm.utils.PROVIDER_CLIENTS_SETTINGS = None
+    for (module, attribute), value in settings.items():
+        setattr(importlib.import_module(module), attribute, value)
+
+
+def write_output(path, content):
+    """ Writes an output file, creating its directory if needed
+
+    Returns: The sha256 of the content
+    """
+    data = content.encode("utf-8")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def render_stack_file(path, root, out, build_id):
+    """ Renders a stack file and writes the results (runs in the workers)
+
+    Args:
+        path(str): The path to the stack file
+        root(str): The rendered directory
+        out(str): The output directory
+        build_id(str): The build ID
+
+    Returns: The manifest entry of the stack: the sha256 of the stack file,
+        the attributes and the rendered stack
+    """
+    stack_file = gpwm.apply.StackFile(path)
+    source = stack_file.read()
+    attributes = gpwm.utils.render_stack(
+        source,
+        stack_file.templating_engine,
+        build_id
+    )
+    stack = gpwm.stacks.factory(**attributes)
+    base = os.path.join(out, os.path.relpath(path, root))
+    return {
+        "source": hashlib.sha256(source.encode("utf-8")).hexdigest(),
+        "attributes": write_output(
+            base + ".attributes.yaml",
+            gpwm.utils.dump_yaml(attributes)
+        ),
+        "rendered": write_output(base + ".yaml", stack.to_yaml())
+    }
+
+
+def render_all(root, out, build_id, jobs=None):
+    """ Renders all stack files found in a directory tree
+
+    Args:
+        root(str): The directory with the stack files
+        out(str): The output directory. Stack files inside it are ignored,
+            so it can live in the rendered directory
+        build_id(str): The build ID
+        jobs(int): The number of worker processes. Defaults to the number
+            of CPUs
+
+    Raises SystemExit if any stack failed to render, after writing the
+    results and the manifest of the others.
+    """
+    out_prefix = os.path.join(os.path.abspath(out), "")
+    paths = [
+        p for p in gpwm.apply.find_stack_files([root])
+        if not os.path.abspath(p).startswith(out_prefix)
+    ]
+    if not paths:
+        raise SystemExit("No stack files found in: {}".format(root))
+
+    stacks = {}
+    errors = {}
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=configure_worker,
+        initargs=(get_worker_settings(),)
+    ) as executor:
+        futures = [
+            (p, executor.submit(render_stack_file, p, root, out, build_id))
+            for p in paths
+        ]
+        for path, future in futures:
+            try:
+                stacks[os.path.relpath(path, root)] = future.result()
+            except (SystemExit, Exception) as exc:
+                logging.error("Failed to render %s: %s", path, exc)
+                errors[path] = exc
+
+    write_output(
+        os.path.join(out, MANIFEST_FILE),
+        json.dumps(
+            {"build_id": build_id, "stacks": stacks},
+            indent=2,
+            sort_keys=True
+        ) + "\n"
+    )
+    print("===> Rendered {} stacks to {}".format(len(stacks), out))
+    if errors:
+        raise SystemExit("Failed to render: {}".format(
+            " ".join(sorted(errors))
+        ))
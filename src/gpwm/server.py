@@ -0,0 +1,377 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" gpwm daemon
+
+Executes the command lines sent by gpwm.client over a Unix socket in a
+long-running process, so the SDK imports, provider clients, compiled
+templates, fetched templates and stack output indexes stay warm across
+requests.
+
+Every request runs as if gpwm was started in the client: with the client's
+working directory, environment, stdin and command line, and its output and
+exit code are sent back to the client. That process-wide state is swapped
+per request, so requests are executed one at a time: a request arriving
+while another one runs is answered "busy", and the client executes it
+itself.
+"""
+
+
+from __future__ import print_function
+import errno
+import io
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+import gpwm.cli
+import gpwm.client
+import gpwm.metrics
+import gpwm.ratelimit
+import gpwm.utils
+
+
+# Seconds without requests before the daemon exits. 0 means never
+IDLE_TIMEOUT = float(os.getenv("GPWM_IDLE_TIMEOUT", 0))
+
+# Provider clients are created with the credentials in the environment, so
+# they're dropped when the client's variables with these prefixes change
+CREDENTIAL_ENV_PREFIXES = ("AWS_", "GOOGLE_", "CLOUDSDK_")
+
+SERVING = False
+
+# Held while a request is executed
+EXECUTE_LOCK = threading.Lock()
+
+# The credentials the provider clients were created with
+CREDENTIALS = None
+
+
+class StderrProxy(object):
+    """ Writes to whatever sys.stderr is at the time
+
+    Given to the logging handler, so log messages reach the client of the
+    request being served.
+    """
+    def write(self, text):
+        sys.stderr.write(text)
+
+    def flush(self):
+        sys.stderr.flush()
+
+
+class MessageStream(io.TextIOBase):
+    """ A text stream sending what's written to the client, as messages
+    named after the stream ("stdout" or "stderr")
+
+    The command keeps running if the client goes away, and the rest of
+    its output is dropped.
+    """
+    def __init__(self, name, connection, lock):
+        self.name = name
+        self.connection = connection
+        self.lock = lock
+        self.lost = False
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def write(self, text):
+        if not text or self.lost:
+            return len(text)
+        with self.lock:
+            try:
+                gpwm.client.send_message(self.connection, {self.name: text})
+            except (IOError, OSError):
+                self.lost = True
+        return len(text)
+
+
+class StdinStream(io.TextIOWrapper):
+    """ The stdin sent by the client, read from a pipe
+
+    A pipe has a file descriptor, so commands (eg of shell stacks) can
+    inherit it. Named like sys.stdin, as the CLI tells stacks read from
+    stdin by name.
+    """
+    name = "<stdin>"
+
+    def __init__(self, fd, tty=False):
+        super(StdinStream, self).__init__(
+            io.open(fd, "rb"),
+            encoding="utf-8",
+            errors="replace"
+        )
+        self.tty = tty
+
+    def isatty(self):
+        return self.tty
+
+
+def forward_stdin(rfile, fd):
+    """ Writes the stdin messages of the client to a pipe, until the end of
+    the input, or until the command is done and the pipe is closed
+    """
+    try:
+        while True:
+            message = gpwm.client.read_message(rfile)
+            text = message and message.get("stdin")
+            if text is None:
+                break
+            data = text.encode("utf-8")
+            while data:
+                data = data[os.write(fd, data):]
+    except (IOError, OSError, ValueError):
+        pass
+    finally:
+        os.close(fd)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Serves one request (see gpwm.client for the protocol)
+    """
+    def handle(self):
+        request = gpwm.client.read_message(self.rfile)
+        if request is None:
+            return
+        if not EXECUTE_LOCK.acquire(blocking=False):
+            gpwm.client.send_message(self.wfile, {"busy": True})
+            return
+        try:
+            gpwm.client.send_message(self.wfile, {"accepted": True})
+            read_fd, write_fd = os.pipe()
+            threading.Thread(
+                target=forward_stdin,
+                args=(self.rfile, write_fd),
+                daemon=True
+            ).start()
+            lock = threading.Lock()
+            with StdinStream(read_fd, request.get("tty", False)) as stdin:
+                code = execute(
+                    request,
+                    MessageStream("stdout", self.wfile, lock),
+                    MessageStream("stderr", self.wfile, lock),
+                    stdin
+                )
+        finally:
+            EXECUTE_LOCK.release()
+        try:
+            gpwm.client.send_message(self.wfile, {"exit": code})
+        except (IOError, OSError):
+            logging.debug("gpwm client went away before the exit code")
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Accepts requests in threads, so clients arriving while a request is
+    executed are told the daemon is busy right away
+    """
+    def handle_timeout(self):
+        if not EXECUTE_LOCK.locked():
+            self.idle = True
+
+
+def snapshot_settings():
+    """ Returns the settings of the loaded gpwm modules
+
+    Settings are the upper case module attributes holding plain values.
+    The CLI sets them from its options, and the defaults of the options are
+    the current values, so they're restored after every request for the
+    options of one request not to leak into the next. Attributes that were
+    None and now hold an object are lazily created state (eg STACK_CACHE),
+    which restore_settings() keeps.
+    """
+    settings = {}
+    for name, module in list(sys.modules.items()):
+        if module is None or not name.startswith("gpwm"):
+            continue
+        for attribute, value in vars(module).items():
+            if attribute.isupper() and \
+                    isinstance(value, (bool, int, float, str, type(None))):
+                settings[(name, attribute)] = value
+    return settings
+
+
+def restore_settings(settings):
+    plain = (bool, int, float, str, type(None))
+    for (name, attribute), value in settings.items():
+        module = sys.modules[name]
+        if isinstance(getattr(module, attribute, None), plain):
+            setattr(module, attribute, value)
+
+
+def get_credentials_fingerprint(env):
+    return sorted(
+        (key, value) for key, value in env.items()
+        if key.startswith(CREDENTIAL_ENV_PREFIXES)
+    )
+
+
+def reset_run_state():
+    """ Drops what's only valid for a single gpwm run
+
+    Provider clients, compiled templates, the fetched templates and the
+    stack cache are kept, they're why the daemon exists.
+    """
+    with gpwm.utils.CALL_AWS_CACHE_LOCK:
+        gpwm.utils.CALL_AWS_CACHE.clear()
+        gpwm.utils.CALL_AWS_STATS.update(hits=0, misses=0, uncacheable=0)
+    gcp = sys.modules.get("gpwm.stacks.gcp")
+    if gcp is not None:
+        with gcp.IMPORTS_LOCK:
+            gcp.IMPORTS.clear()
+    gpwm.metrics.reset()
+    gpwm.ratelimit.reset_stats()
+
+
+def get_exit_code(exc):
+    """ Returns the exit code of a SystemExit, like the interpreter does
+    """
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    print(exc.code, file=sys.stderr)
+    return 1
+
+
+def execute(request, stdout, stderr, stdin=None):
+    """ Executes a command line as if gpwm was started in the client
+
+    Args:
+        request(dict): The request: argv, cwd and env
+        stdout, stderr: The streams the output is written to
+        stdin: The stream the input is read from. Defaults to an empty
+            input
+
+    Returns: The exit code
+    """
+    global CREDENTIALS
+    saved = (
+        os.getcwd(),
+        dict(os.environ),
+        sys.stdin,
+        sys.stdout,
+        sys.stderr,
+        snapshot_settings()
+    )
+    try:
+        sys.stdout, sys.stderr = stdout, stderr
+        sys.stdin = stdin if stdin is not None else io.StringIO()
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+
+        credentials = get_credentials_fingerprint(request["env"])
+        if credentials != CREDENTIALS:
+            with gpwm.utils.PROVIDER_CLIENTS_LOCK:
+                gpwm.utils.PROVIDER_CLIENTS.clear()
+            CREDENTIALS = credentials
+        reset_run_state()
+
+        try:
+            gpwm.cli.main(request["argv"])
+        except SystemExit as exc:
+            return get_exit_code(exc)
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        cwd, env, sys.stdin, sys.stdout, sys.stderr, settings = saved
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        restore_settings(settings)
+
+
+def remove_stale_socket(path):
+    """ Removes the socket of a daemon that's gone
+
+    Raises SystemExit if a daemon is still listening on it.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError) as exc:
+        if exc.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        if exc.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise SystemExit("A gpwm daemon is already listening on {}".format(path))
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(path=None, idle_timeout=IDLE_TIMEOUT):
+    """ Serves requests until interrupted, or idle for too long
+
+    Args:
+        path(str): The Unix socket to listen on. Defaults to
+            gpwm.client.SOCKET_PATH
+        idle_timeout(float): Seconds without requests before exiting. 0
+            means never
+    """
+    global SERVING, CREDENTIALS
+    if SERVING:
+        raise SystemExit("Already serving")
+    path = path or gpwm.client.SOCKET_PATH
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    remove_stale_socket(path)
+
+    # only the user running the daemon may connect to it: requests are
+    # executed with the daemon's privileges
+    umask = os.umask(0o077)
+    try:
+        server = Server(path, RequestHandler)
+    finally:
+        os.umask(umask)
+    server.timeout = idle_timeout or None
+    server.idle = False
+
+    logging.basicConfig(stream=StderrProxy())
+    signal.signal(signal.SIGTERM, interrupt)
+    SERVING = True
+    CREDENTIALS = get_credentials_fingerprint(os.environ)
+    print("gpwm daemon listening on {}".format(path), file=sys.stderr)
+    try:
+        while not server.idle:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVING = False
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    print("gpwm daemon stopped", file=sys.stderr)
@@ -13,15 +13,309 @@
 # limitations under the License.
 
 from __future__ import print_function
+import hashlib
+import logging
+import os
 from six.moves import input
 from six.moves.urllib.parse import urlparse
 import time
-import yaml
 
 from botocore.exceptions import ClientError
 
+import gpwm.aio
+import gpwm.metrics
+import gpwm.nesting
 import gpwm.stacks
 import gpwm.utils
+import gpwm.validation
+
+
+# Bounds (in seconds) of the adaptive polling interval of the waiters.
+# Polling gets faster when things are happening, and slower when they're not
+WAITER_MIN_DELAY = 1
+WAITER_MAX_DELAY = 15
+WAITER_BACKOFF = 1.5
+WAITER_TIMEOUT = 3600
+
+# Tag holding the hash of the content used to create/update the stack, so
+# updates can be skipped when nothing changed
+CONTENT_HASH_TAG = "gpwm_content_hash"
+
+# Templates are validated locally unless disabled, eg for templates the
+# local validation wrongly rejects
+LOCAL_VALIDATION = os.getenv("GPWM_LOCAL_VALIDATION", "") != "false"
+
+# Also validating templates with Cloudformation's ValidateTemplate API costs
+# a round-trip per stack
+REMOTE_VALIDATION = os.getenv("GPWM_REMOTE_VALIDATION", "") == "true"
+
+# Bucket ("bucket" or "bucket/prefix") where rendered templates are uploaded
+# to, so they are passed to Cloudformation by URL instead of inline. Can be
+# overridden per stack with the TemplateBucket attribute
+TEMPLATE_BUCKET = os.getenv("GPWM_TEMPLATE_BUCKET", "")
+
+# Templates with more resources than this are split into nested stacks of at
+# most this many resources. 0 disables splitting. Can be overridden per stack
+# with the NestedStackSize attribute
+NESTED_STACK_SIZE = int(os.getenv("GPWM_NESTED_STACK_SIZE", 0))
+
+# Stack statuses meaning an operation is over but failed
+STACK_FAILED_STATUSES = [
+    "CREATE_FAILED",
+    "DELETE_FAILED",
+    "ROLLBACK_COMPLETE",
+    "ROLLBACK_FAILED",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "UPDATE_ROLLBACK_FAILED"
+]
+
+
+def get_bucket_region(bucket):
+    """ Returns the (lazily fetched) region of an S3 bucket
+    """
+    def fetch():
+        location = gpwm.utils.get_boto_client("s3").get_bucket_location(
+            Bucket=bucket
+        ).get("LocationConstraint")
+        # buckets created before regions had names
+        return {None: "us-east-1", "": "us-east-1", "EU": "eu-west-1"}.get(
+            location,
+            location
+        )
+    return gpwm.utils.get_provider_client(("aws", "bucket_region", bucket),
+                                          fetch)
+
+
+def get_template_location(template_bucket, body):
+    """ Returns where a template is uploaded to
+
+    The object key is the hash of the template, so identical templates
+    are uploaded only once, no matter how many stacks use them. The URL is
+    path-style, as virtual-hosted URLs of buckets with dots in their names
+    don't match S3's certificate.
+
+    Args:
+        template_bucket(str): "bucket" or "bucket/prefix"
+        body(str): The template
+
+    Returns: A tuple with the bucket, the key, and the URL of the template
+    """
+    bucket, _, prefix = template_bucket.partition("/")
+    prefix = prefix.strip("/")
+    key = "{}{}.yaml".format(
+        prefix + "/" if prefix else "",
+        hashlib.sha256(body.encode("utf-8")).hexdigest()
+    )
+    url = "https://s3.{}.amazonaws.com/{}/{}".format(
+        get_bucket_region(bucket),
+        bucket,
+        key
+    )
+    return bucket, key, url
+
+
+def upload_template(template_bucket, body):
+    """ Uploads a template, unless it was uploaded before
+
+    Returns: The URL of the template
+    """
+    bucket, key, url = get_template_location(template_bucket, body)
+    s3_client = gpwm.utils.get_boto_client(
+        "s3",
+        region=get_bucket_region(bucket)
+    )
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        logging.debug("Template already uploaded: s3://%s/%s", bucket, key)
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+            raise
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+    return url
+
+
+def get_cf_client():
+    """ Returns the (lazily created) Cloudformation client
+    """
+    return gpwm.utils.get_boto_client("cloudformation")
+
+
+def next_delay(delay, progressed):
+    """ Returns the next polling interval of a waiter
+
+    The interval goes back to the minimum when the last probe showed
+    progress, and grows exponentially otherwise.
+    """
+    if progressed:
+        return WAITER_MIN_DELAY
+    return min(delay * WAITER_BACKOFF, WAITER_MAX_DELAY)
+
+
+class StackEventWaiter(object):
+    """ Waits for a stack operation by tailing the stack events
+
+    Unlike boto3's waiters, which poll the stack status at a fixed interval,
+    this waiter only fetches the events newer than the last one seen, prints
+    them as they come, adapts its polling interval to the stack activity,
+    and returns as soon as the stack reaches a final status.
+
+    The waiter must be created before the operation starts, so events
+    of previous operations are ignored.
+    """
+    def __init__(self, stack_name):
+        self.stack_name = stack_name
+        self.stack_id = None
+        self.last_event_id = None
+        try:
+            events = get_cf_client().describe_stack_events(
+                StackName=stack_name
+            )["StackEvents"]
+        except ClientError as exc:
+            if "does not exist" not in exc.response["Error"]["Message"]:
+                raise
+            events = []
+        if events:
+            self.stack_id = events[0]["StackId"]
+            self.last_event_id = events[0]["EventId"]
+
+    def new_events(self):
+        """ Returns the events newer than the last one seen, oldest first
+        """
+        events = []
+        paginator = get_cf_client().get_paginator("describe_stack_events")
+        for page in paginator.paginate(StackName=self.stack_id):
+            for event in page["StackEvents"]:
+                if event["EventId"] == self.last_event_id:
+                    break
+                events.append(event)
+            else:
+                continue
+            break
+        if events:
+            self.last_event_id = events[0]["EventId"]
+        return list(reversed(events))
+
+    def check(self, success_status):
+        """ Prints the new events and tells if the operation is over
+
+        Args:
+            success_status(str): The status meaning the operation succeeded,
+                eg "CREATE_COMPLETE"
+
+        Returns: A (done, progressed) tuple. progressed tells if there were
+            new events
+
+        Raises SystemExit if the operation failed.
+        """
+        events = self.new_events()
+        for event in events:
+            print("{} {} {} {} {}".format(
+                event["Timestamp"],
+                self.stack_name,
+                event["LogicalResourceId"],
+                event["ResourceStatus"],
+                event.get("ResourceStatusReason", "")
+            ).rstrip())
+            # events of the stack itself carry the stack status
+            if event.get("PhysicalResourceId") != event["StackId"]:
+                continue
+            if event["ResourceStatus"] == success_status:
+                return True, True
+            if event["ResourceStatus"] in STACK_FAILED_STATUSES:
+                raise SystemExit("Stack {} failed: {}".format(
+                    self.stack_name,
+                    event["ResourceStatus"]
+                ))
+        return False, bool(events)
+
+    def wait(self, success_status, timeout=WAITER_TIMEOUT):
+        """ Waits for the stack to reach a final status
+
+        Args:
+            success_status(str): The status meaning the operation succeeded,
+                eg "CREATE_COMPLETE"
+            timeout(int): The total wait timeout in seconds
+
+        Raises SystemExit if the operation fails or times out.
+        """
+        # nothing to wait for, eg deleting a stack that doesn't exist
+        if self.stack_id is None:
+            return
+        with gpwm.metrics.phase("wait", stack=self.stack_name):
+            deadline = time.time() + timeout
+            delay = WAITER_MIN_DELAY
+            while True:
+                done, progressed = self.check(success_status)
+                if done:
+                    return
+                if time.time() > deadline:
+                    raise SystemExit("Timed out waiting for stack {}".format(
+                        self.stack_name
+                    ))
+                delay = next_delay(delay, progressed)
+                gpwm.utils.sleep_with_jitter(delay)
+
+    async def async_wait(self, success_status, limiter_key,
+                         timeout=WAITER_TIMEOUT):
+        """ Awaitable counterpart of wait()
+
+        Only the event fetching runs in a thread, the waiting is done by the
+        event loop.
+
+        Args:
+            limiter_key(tuple): The key limiting the API calls (see
+                gpwm.aio.get_limiter())
+        """
+        if self.stack_id is None:
+            return
+        with gpwm.metrics.phase("wait", stack=self.stack_name):
+            deadline = time.time() + timeout
+            delay = WAITER_MIN_DELAY
+            while True:
+                done, progressed = await gpwm.aio.call(
+                    limiter_key,
+                    self.check,
+                    success_status
+                )
+                if done:
+                    return
+                if time.time() > deadline:
+                    raise SystemExit("Timed out waiting for stack {}".format(
+                        self.stack_name
+                    ))
+                delay = next_delay(delay, progressed)
+                await gpwm.aio.sleep_with_jitter(delay)
+
+
+def wait_for_change_set(change_set_name, stack_name, timeout=WAITER_TIMEOUT):
+    """ Waits for a change set to be created
+
+    Returns: The change set, as returned by DescribeChangeSet
+    """
+    with gpwm.metrics.phase("wait", change_set=change_set_name):
+        deadline = time.time() + timeout
+        delay = WAITER_MIN_DELAY
+        status = None
+        while True:
+            change_set = get_cf_client().describe_change_set(
+                ChangeSetName=change_set_name,
+                StackName=stack_name
+            )
+            if change_set["Status"] == "CREATE_COMPLETE":
+                return change_set
+            if change_set["Status"] == "FAILED":
+                raise SystemExit("Change set {} failed: {}".format(
+                    change_set_name,
+                    change_set.get("StatusReason", "")
+                ))
+            if time.time() > deadline:
+                raise SystemExit("Timed out waiting for change set {}".format(
+                    change_set_name
+                ))
+            delay = next_delay(delay, change_set["Status"] != status)
+            status = change_set["Status"]
+            gpwm.utils.sleep_with_jitter(delay)
 
 
 class CloudformationStack(gpwm.stacks.BaseStack):
@@ -31,16 +325,29 @@ class CloudformationStack(gpwm.stacks.BaseStack):
             All Cloudformation supported sections are allowed, plus:
             - BuildId(str): The build ID. This will be merged to the
               parameters dict.
+            - TemplateBucket(str): The bucket ("bucket" or "bucket/prefix")
+              the rendered template is uploaded to. Defaults to
+              TEMPLATE_BUCKET. The template is passed inline if empty.
+            - NestedStackSize(int): The maximum number of resources of the
+              nested stacks the template is split into. Defaults to
+              NESTED_STACK_SIZE. The template isn't split if 0.
 
         All arguments provided will be set as object attributes, but
         the attributes not supported by CNF will be unset after
         initialization so the attributes can be fed to the CNF API
-        wholesale.
+        wholesale (see api_arguments()).
         """
+        self._template_bucket = kwargs.pop("TemplateBucket", TEMPLATE_BUCKET)
+        self._template_url = None
+        self._nested_stack_size = int(
+            kwargs.pop("NestedStackSize", NESTED_STACK_SIZE)
+        )
+        self._nested_templates = {}
+        self._template = None
         super(CloudformationStack, self).__init__(**kwargs)
 
         if isinstance(self.TemplateBody, dict):
-            self.TemplateBody = yaml.safe_dump(self.TemplateBody, indent=2)
+            template = self.TemplateBody
         else:
             template_url = urlparse(self.TemplateBody)
             template_body = gpwm.utils.get_template_body(template_url)
@@ -48,7 +355,8 @@ class CloudformationStack(gpwm.stacks.BaseStack):
             if ".mako" in template_url.path[-5:]:
                 if not hasattr(self, "Parameters"):
                     self.Parameters = {}
-                self.Parameters["build_id"] = self.BuildId
+                # copied, so the stack attributes given are left untouched
+                self.Parameters = dict(self.Parameters, build_id=self.BuildId)
                 args = [self.StackName, template_body, self.Parameters]
                 template = gpwm.utils.parse_mako(*args)
                 # mako doesn't need Parameters as they're available to the
@@ -69,7 +377,13 @@ class CloudformationStack(gpwm.stacks.BaseStack):
             else:
                 raise SystemExit("file extension not supported")
 
-            self.TemplateBody = yaml.safe_dump(template, indent=2)
+        if self._nested_stack_size and \
+                len(template.get("Resources", {})) > self._nested_stack_size:
+            template = self.split_template(template)
+        # the template is kept loaded, so it doesn't need to be parsed
+        # again to be validated or rendered
+        self._template = template
+        self.TemplateBody = gpwm.utils.dump_yaml(template)
 
         # make sure "Tags" is a list of dicts. Making a shallow copy
         # just in case
@@ -77,41 +391,141 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         tags = self.Tags.copy()
         if isinstance(tags, dict):
             self.Tags = [{"Key": k, "Value": v} for k, v in tags.items()]
+        # the content hash covers everything sent to the API except the
+        # build ID, which changes on every build
+        self.Tags.append({
+            "Key": CONTENT_HASH_TAG,
+            "Value": gpwm.utils.content_hash({
+                k: v for k, v in self.__dict__.items()
+                if k != "BuildId" and not k.startswith("_")
+            })
+        })
         self.Tags.append({"Key": "build_id", "Value": self.BuildId})
+        if self._nested_templates:
+            self.Tags.append({
+                "Key": gpwm.nesting.NESTED_STACKS_TAG,
+                "Value": "true"
+            })
 
         # cleanup non-cfn attributes
         del self.BuildId
 
+    @property
+    def content_hash(self):
+        for tag in self.Tags:
+            if tag["Key"] == CONTENT_HASH_TAG:
+                return tag["Value"]
+
+    def api_arguments(self):
+        """ Returns the attributes to be fed to the Cloudformation API
+
+        Private attributes (starting with "_") are left out. The template is
+        passed by URL when there's a template bucket.
+        """
+        arguments = {
+            k: v for k, v in self.__dict__.items() if not k.startswith("_")
+        }
+        if self._template_bucket:
+            del arguments["TemplateBody"]
+            arguments["TemplateURL"] = self.upload_template()
+        return arguments
+
+    def split_template(self, template):
+        """ Splits the template into nested stacks
+
+        The nested templates are only uploaded when the stack is
+        created/updated, but their URLs are known in advance.
+
+        Returns: The parent template
+        """
+        if not self._template_bucket:
+            raise SystemExit(
+                "Stack {} can only be split into nested stacks with a "
+                "template bucket".format(self.StackName)
+            )
+        parent, children = gpwm.nesting.split_template(
+            template,
+            self._nested_stack_size
+        )
+        for name, child in children.items():
+            body = gpwm.utils.dump_yaml(child)
+            self._nested_templates[name] = (child, body)
+            parent["Resources"][name]["Properties"]["TemplateURL"] = \
+                get_template_location(self._template_bucket, body)[2]
+        return parent
+
+    def upload_template(self):
+        """ Uploads the template, and its nested templates, to the
+        template bucket
+
+        Returns: The URL of the template
+        """
+        if self._template_url is None:
+            for _, body in self._nested_templates.values():
+                upload_template(self._template_bucket, body)
+            self._template_url = upload_template(
+                self._template_bucket,
+                self.TemplateBody
+            )
+        return self._template_url
+
+    def is_unchanged(self):
+        """ Tells if the deployed stack was created from the same content
+
+        Stacks whose last operation failed or was rolled back carry the tag
+        of the content that failed, so they are always changed.
+
+        Raises ClientError if the stack doesn't exist.
+        """
+        stack = get_cf_client().describe_stacks(
+            StackName=self.StackName
+        )["Stacks"][0]
+        status = stack["StackStatus"]
+        if not status.endswith("_COMPLETE") or "ROLLBACK" in status:
+            return False
+        for tag in stack.get("Tags", []):
+            if tag["Key"] == CONTENT_HASH_TAG:
+                return tag["Value"] == self.content_hash
+        return False
+
     def create(self, wait=False):
         self.validate()
-        gpwm.utils.BOTO_CF_RESOURCE.create_stack(**self.__dict__)
+        self._create(wait=wait)
+
+    def _create(self, wait=False):
+        waiter = StackEventWaiter(self.StackName) if wait else None
+        response = get_cf_client().create_stack(**self.api_arguments())
         if wait:
-            waiter = gpwm.utils.BOTO_CF_CLIENT.get_waiter(
-                "stack_create_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+            waiter.stack_id = response["StackId"]
+            waiter.wait("CREATE_COMPLETE")
+        gpwm.utils.invalidate_stack_cache(self.StackName)
 
     def delete(self, wait=False):
-        cf_stack = gpwm.utils.BOTO_CF_RESOURCE.Stack(self.StackName)
-        cf_stack.delete()
+        waiter = StackEventWaiter(self.StackName) if wait else None
+        get_cf_client().delete_stack(StackName=self.StackName)
         if wait:
-            waiter = gpwm.utils.BOTO_CF_CLIENT.get_waiter(
-                "stack_delete_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+            waiter.wait("DELETE_COMPLETE")
+        gpwm.utils.invalidate_stack_cache(self.StackName)
 
-    def update(self, wait=False, review=True):
-        self.validate()
+    def update(self, wait=False, review=True, force=False):
+        self._update(wait=wait, review=review, force=force, validate=True)
+
+    def _update(self, wait=False, review=True, force=False, validate=False):
+        if not force and self.is_unchanged():
+            print("Stack {} unchanged, skipping update".format(
+                self.StackName
+            ))
+            return
+        if validate:
+            self.validate()
         if review:
-            self.manage_change_set()
+            self.manage_change_set(wait=wait)
         else:
-            cf_stack = gpwm.utils.BOTO_CF_RESOURCE.Stack(self.StackName)
-            cf_stack.update(**self.__dict__)
-        if wait:
-            waiter = gpwm.utils.BOTO_CF_CLIENT.get_waiter(
-                "stack_update_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+            waiter = StackEventWaiter(self.StackName) if wait else None
+            get_cf_client().update_stack(**self.api_arguments())
+            if wait:
+                waiter.wait("UPDATE_COMPLETE")
+        gpwm.utils.invalidate_stack_cache(self.StackName)
 
     def manage_change_set(self, wait=False):
         # find build ID in tags
@@ -120,49 +534,44 @@ class CloudformationStack(gpwm.stacks.BaseStack):
                 build_id = tag["Value"]
         change_set_name = "{}-{}".format(self.StackName, build_id)
 
-        gpwm.utils.BOTO_CF_CLIENT.create_change_set(
+        get_cf_client().create_change_set(
             ChangeSetName=change_set_name,
             ChangeSetType="UPDATE",
-            **self.__dict__
+            **self.api_arguments()
         )
 
         # wait for change set to be ready
-        time.sleep(2)
-        waiter = gpwm.utils.BOTO_CF_CLIENT.get_waiter(
-            "change_set_create_complete"
-        )
-        waiter.wait(ChangeSetName=change_set_name, StackName=self.StackName)
-
-        change_set = gpwm.utils.BOTO_CF_CLIENT.describe_change_set(
-            ChangeSetName=change_set_name,
-            StackName=self.StackName
-        )
+        change_set = wait_for_change_set(change_set_name, self.StackName)
         change_set.pop("ResponseMetadata")
         print("---------- Change Set ----------")
-        print(yaml.safe_dump(change_set, indent=2))
+        print(gpwm.utils.dump_yaml(change_set))
         print("--------------------------------")
 
+        waiter = StackEventWaiter(self.StackName) if wait else None
         answer = False
         while not answer:
             answer = self.changeset_user_input(change_set_name)
 
-        if wait:
-            waiter = gpwm.utils.BOTO_CF_CLIENT.get_waiter(
-                "stack_update_complete"
-            )
-            waiter.wait(StackName=self.StackName)
+        # only an executed change set changes the stack
+        if wait and answer == "e":
+            waiter.wait("UPDATE_COMPLETE")
 
     def changeset_user_input(self, change_set_name):
+        """ Asks the user what to do with the change set
+
+        Returns: The answer ("e", "d" or "k"), or False if not valid
+        """
         answer = input("Execute(e), Delete (d), or Keep(k) change set? ")
         if answer == "e":
             print("Executing changeset {}...".format(change_set_name))
-            gpwm.utils.BOTO_CF_CLIENT.execute_change_set(
+            get_cf_client().execute_change_set(
                 ChangeSetName=change_set_name,
                 StackName=self.StackName
             )
+            gpwm.utils.invalidate_stack_cache(self.StackName)
         elif answer == "d":
             print("Deleting changeset {}. No changes made to stack {}".format(change_set_name, self.StackName)) # noqa
-            gpwm.utils.BOTO_CF_CLIENT.delete_change_set(
+            get_cf_client().delete_change_set(
                 ChangeSetName=change_set_name,
                 StackName=self.StackName
             )
@@ -171,28 +580,183 @@ class CloudformationStack(gpwm.stacks.BaseStack):
         else:
             print("Valid answers: e, d, k")
             return False
-        return True
+        return answer
 
-    def upsert(self, wait=False):
+    def upsert(self, wait=False, review=True, force=False):
+        # validated once, whether the stack ends up updated or created
         self.validate()
         try:
-            self.update(wait=wait)
+            self._update(wait=wait, review=review, force=force)
+        except ClientError as exc:
+            if "does not exist" in exc.response["Error"]["Message"]:
+                self._create(wait=wait)
+            else:
+                raise
+
+    def limiter_key(self):
+        """ Returns the key limiting the concurrent API calls made for the
+        stack (see gpwm.aio.get_limiter())
+        """
+        return ("aws", get_cf_client().meta.region_name)
+
+    async def async_create(self, wait=False):
+        """ Awaitable counterpart of create()
+        """
+        await gpwm.aio.call(self.limiter_key(), self.validate)
+        await self._async_create(wait=wait)
+
+    async def _async_create(self, wait=False):
+        key = self.limiter_key()
+        waiter = None
+        if wait:
+            waiter = await gpwm.aio.call(key, StackEventWaiter, self.StackName)
+        arguments = await gpwm.aio.call(key, self.api_arguments)
+        response = await gpwm.aio.call(
+            key,
+            get_cf_client().create_stack,
+            **arguments
+        )
+        if wait:
+            waiter.stack_id = response["StackId"]
+            await waiter.async_wait("CREATE_COMPLETE", key)
+        await gpwm.aio.call(
+            key,
+            gpwm.utils.invalidate_stack_cache,
+            self.StackName
+        )
+
+    async def async_delete(self, wait=False):
+        """ Awaitable counterpart of delete()
+        """
+        key = self.limiter_key()
+        waiter = None
+        if wait:
+            waiter = await gpwm.aio.call(key, StackEventWaiter, self.StackName)
+        await gpwm.aio.call(
+            key,
+            get_cf_client().delete_stack,
+            StackName=self.StackName
+        )
+        if wait:
+            await waiter.async_wait("DELETE_COMPLETE", key)
+        await gpwm.aio.call(
+            key,
+            gpwm.utils.invalidate_stack_cache,
+            self.StackName
+        )
+
+    async def async_update(self, wait=False, review=True, force=False):
+        """ Awaitable counterpart of update()
+        """
+        await self._async_update(
+            wait=wait,
+            review=review,
+            force=force,
+            validate=True
+        )
+
+    async def _async_update(self, wait=False, review=True, force=False,
+                            validate=False):
+        key = self.limiter_key()
+        if not force and await gpwm.aio.call(key, self.is_unchanged):
+            print("Stack {} unchanged, skipping update".format(
+                self.StackName
+            ))
+            return
+        if validate:
+            await gpwm.aio.call(key, self.validate)
+        if review:
+            # waits for user input, so it's not counted as an API call in
+            # flight
+            await gpwm.aio.call(None, self.manage_change_set, wait=wait)
+        else:
+            waiter = None
+            if wait:
+                waiter = await gpwm.aio.call(
+                    key,
+                    StackEventWaiter,
+                    self.StackName
+                )
+            arguments = await gpwm.aio.call(key, self.api_arguments)
+            await gpwm.aio.call(
+                key,
+                get_cf_client().update_stack,
+                **arguments
+            )
+            if wait:
+                await waiter.async_wait("UPDATE_COMPLETE", key)
+        await gpwm.aio.call(
+            key,
+            gpwm.utils.invalidate_stack_cache,
+            self.StackName
+        )
+
+    async def async_upsert(self, wait=False, review=True, force=False):
+        """ Awaitable counterpart of upsert()
+        """
+        await gpwm.aio.call(self.limiter_key(), self.validate)
+        try:
+            await self._async_update(wait=wait, review=review, force=force)
         except ClientError as exc:
             if "does not exist" in exc.response["Error"]["Message"]:
-                self.create(wait=wait)
+                await self._async_create(wait=wait)
             else:
                 raise
 
+    def to_yaml(self):
+        """ Returns the rendered stack as a yaml document
+        """
+        # the loaded template displays nicer on screen than the TemplateBody
+        # string
+        template = {
+            k: v for k, v in self.__dict__.items() if not k.startswith("_")
+        }
+        template["TemplateBody"] = self._template
+        return gpwm.utils.dump_yaml(template)
+
     def render(self):
-        # un-stringfy the TemplateBody so it displays nicely on screen
-        template = self.__dict__.copy()
-        template["TemplateBody"] = yaml.load(template["TemplateBody"])
-        print(yaml.safe_dump(template, indent=2))
+        print(self.to_yaml())
 
     def validate(self):
+        """ Validates the template locally if LOCAL_VALIDATION is set, and
+        remotely if REMOTE_VALIDATION is set
+
+        Raises SystemExit if the template is not valid.
+        """
+        with gpwm.metrics.phase("validate", stack=self.StackName):
+            self._validate()
+
+    def _validate(self):
+        if LOCAL_VALIDATION:
+            self._validate_locally()
+        if not REMOTE_VALIDATION:
+            return
+        arguments = self.api_arguments()
         try:
-            gpwm.utils.BOTO_CF_CLIENT.validate_template(
-                TemplateBody=self.TemplateBody
-            )
+            get_cf_client().validate_template(**{
+                k: v for k, v in arguments.items()
+                if k in ["TemplateBody", "TemplateURL"]
+            })
         except ClientError as exc:
             raise SystemExit(exc.response["Error"]["Message"])
+
+    def _validate_locally(self):
+        errors = gpwm.validation.validate_template(
+            self._template,
+            template_body_size=len(self.TemplateBody.encode("utf-8")),
+            inline=not self._template_bucket
+        )
+        for name, (child, body) in sorted(self._nested_templates.items()):
+            errors.extend(
+                "{}: {}".format(name, e)
+                for e in gpwm.validation.validate_template(
+                    child,
+                    template_body_size=len(body.encode("utf-8")),
+                    inline=False
+                )
+            )
+        if errors:
+            raise SystemExit("Template of stack {} is not valid:\n{}".format(
+                self.StackName,
+                "\n".join("  - {}".format(e) for e in errors)
+            ))
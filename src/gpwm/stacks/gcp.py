@@ -14,16 +14,152 @@
 
 
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import threading
 import time
-import yaml
+from six.moves.urllib.parse import urlparse
 
 
 from apiclient.errors import HttpError
 
+import gpwm.aio
+import gpwm.metrics
 import gpwm.stacks
 import gpwm.utils
 
 
+# Label holding the hash of the content used to create/update the
+# deployment, so updates can be skipped when nothing changed
+CONTENT_HASH_LABEL = "gpwm_content_hash"
+
+# Bounds (in seconds) of the exponential backoff used to poll operations
+WAITER_MIN_DELAY = 1
+WAITER_MAX_DELAY = 20
+WAITER_BACKOFF = 2
+WAITER_TIMEOUT = 1800
+
+# Maximum number of imports fetched in parallel
+IMPORT_FETCH_WORKERS = 16
+
+# Imports fetched by this run, as (content, digest) tuples keyed by path.
+# Deployments usually share imports, so each is fetched and hashed once
+IMPORTS = {}
+IMPORTS_LOCK = threading.Lock()
+
+
+def fetch_import(path):
+    """ Fetches an import
+
+    Args:
+        path(str): A local path or URL (see gpwm.utils.get_template_body())
+
+    Returns: A tuple with the content of the import and its digest
+    """
+    fetched = IMPORTS.get(path)
+    if fetched is None:
+        content = gpwm.utils.get_template_body(urlparse(path)).rstrip()
+        fetched = (
+            content,
+            hashlib.sha256(content.encode("utf-8")).hexdigest()
+        )
+        with IMPORTS_LOCK:
+            fetched = IMPORTS.setdefault(path, fetched)
+    return fetched
+
+
+def get_operation(project, name):
+    """ Fetches a DM operation
+    """
+    return gpwm.utils.get_gcp_api().operations().get(
+        project=project,
+        operation=name
+    ).execute()
+
+
+def get_operation_error(operation):
+    """ Returns the error message of a failed DM operation
+    """
+    return "; ".join(
+        e.get("message", str(e))
+        for e in operation["error"].get("errors", [])
+    )
+
+
+def poll_operations(operations, timeout=WAITER_TIMEOUT):
+    """ Waits for many DM operations to finish
+
+    All operations are polled from a single loop with exponential backoff,
+    so any number of deployments can be waited on without a thread or a
+    polling loop per deployment.
+
+    Args:
+        operations(list): (project, operation) tuples, where operation is
+            the operation resource returned by the DM API
+        timeout(int): The total wait timeout in seconds
+
+    Returns: A dict mapping the (project, operation name) of the failed
+        operations to their error message. Operations still running when
+        the timeout expires are reported as failed.
+    """
+    with gpwm.metrics.phase("wait", operations=len(operations)):
+        pending = {(p, op["name"]): op for p, op in operations}
+        errors = {}
+        deadline = time.time() + timeout
+        delay = WAITER_MIN_DELAY
+        while pending:
+            for (project, name), operation in list(pending.items()):
+                if operation["status"] != "DONE":
+                    operation = get_operation(project, name)
+                if operation["status"] == "DONE":
+                    del pending[(project, name)]
+                    if operation.get("error"):
+                        errors[(project, name)] = get_operation_error(
+                            operation
+                        )
+            if pending and time.time() > deadline:
+                for key in pending:
+                    errors[key] = "timed out waiting for operation {}".format(
+                        key[1]
+                    )
+                break
+            if pending:
+                gpwm.utils.sleep_with_jitter(delay)
+                delay = min(delay * WAITER_BACKOFF, WAITER_MAX_DELAY)
+        return errors
+
+
+async def async_poll_operation(project, operation, timeout=WAITER_TIMEOUT):
+    """ Awaitable counterpart of poll_operations(), for a single operation
+
+    Only the operation fetching runs in a thread, the waiting is done by the
+    event loop, so any number of operations can be awaited concurrently.
+
+    Returns: The error message if the operation failed or timed out,
+        otherwise None
+    """
+    with gpwm.metrics.phase("wait", operations=1):
+        deadline = time.time() + timeout
+        delay = WAITER_MIN_DELAY
+        while operation["status"] != "DONE":
+            if time.time() > deadline:
+                return "timed out waiting for operation {}".format(
+                    operation["name"]
+                )
+            await gpwm.aio.sleep_with_jitter(delay)
+            delay = min(delay * WAITER_BACKOFF, WAITER_MAX_DELAY)
+            operation = await gpwm.aio.call(
+                ("gcp", project),
+                get_operation,
+                project,
+                operation["name"]
+            )
+        if operation.get("error"):
+            return get_operation_error(operation)
+        return None
+
+
 class GCPStack(gpwm.stacks.BaseStack):
     GCP_DEPLOYMENT_BODY_KEYS = [
         "description",
@@ -55,8 +191,21 @@ class GCPStack(gpwm.stacks.BaseStack):
         labels = self.labels.copy()
         if isinstance(labels, dict):
             self.labels = [{"key": k, "value": v} for k, v in labels.items()]
-        self.labels.append({"key": "build_id", "value": self.BuildId})
+        self.import_digests = {}
         self.target = self.assemble_target()
+        # the content hash covers everything sent to the API except the
+        # build ID, which changes on every build. Imports are covered by
+        # their digests, so their content isn't hashed again
+        self.labels.append({
+            "key": CONTENT_HASH_LABEL,
+            "value": gpwm.utils.content_hash([
+                self.target["config"],
+                self.import_digests,
+                self.labels,
+                getattr(self, "description", "")
+            ])
+        })
+        self.labels.append({"key": "build_id", "value": self.BuildId})
         self.body = self.assemble_body()
 
     def assemble_target(self):
@@ -66,30 +215,43 @@ class GCPStack(gpwm.stacks.BaseStack):
         the DM's API, so we have to reorder the arguments before feeding them
         to the API.
 
+        Import paths can be local paths or URLs (see
+        gpwm.utils.get_template_body()). Imports are fetched in parallel.
         """
         # build imports
-        imports = []
+        config_imports = []
+        names = []
         for i in getattr(self, "imports", []):
-            with open(i["path"]) as f:
-                content = f.read().rstrip()
-            imports.append(
-                {
-                    "content": content,
-                    "name": i.get("name", i["path"])
-                }
-            )
+            # URLs are imported under their file name by default
+            url = urlparse(i["path"])
+            if url.scheme:
+                name = i.get("name", os.path.basename(url.path))
+                config_imports.append(dict(i, path=name, name=name))
+            else:
+                name = i.get("name", i["path"])
+                config_imports.append(i)
+            names.append(name)
+        paths = [i["path"] for i in getattr(self, "imports", [])]
+        with gpwm.metrics.phase("imports", count=len(paths)):
+            with ThreadPoolExecutor(IMPORT_FETCH_WORKERS) as executor:
+                fetched = list(executor.map(fetch_import, paths))
+        imports = []
+        for name, (content, digest) in zip(names, fetched):
+            imports.append({"content": content, "name": name})
+            self.import_digests[name] = digest
 
         # build config
         config = {}
         for k, v in self.__dict__.items():
-            if k in ["imports", "resources", "outputs"]:
+            if k in ["resources", "outputs"]:
                 config[k] = v
+        if hasattr(self, "imports"):
+            config["imports"] = config_imports
         return {
             "imports": imports,
             "config": {
-                "content": yaml.dump(
+                "content": gpwm.utils.dump_yaml(
                     config,
-                    indent=2,
                     default_flow_style=False
                 )
             }
@@ -117,7 +279,7 @@ class GCPStack(gpwm.stacks.BaseStack):
         """
 
         try:
-            return gpwm.utils.GCP_API.deployments().get(
+            return gpwm.utils.get_gcp_api().deployments().get(
                 project=self.project,
                 deployment=self.name
             ).execute()
@@ -128,58 +290,186 @@ class GCPStack(gpwm.stacks.BaseStack):
                 "HTTP error {}: {}".format(exc.resp["status"], exc.content)
             )
 
-    def wait(self, interval=5, timeout=300):
-        """ A waiter for stack completeness
-
-        GCP SDK doesn't provide a waiter, so improvising a quick on here.
+    def wait(self, timeout=WAITER_TIMEOUT):
+        """ Waits for the last operation on the deployment to finish
 
         Args:
-            interval(int): Interval between probes in seconds
             timeout(int): The total wait timeout in seconds
 
+        Raises SystemExit if the operation fails or times out.
         """
-        n_probes = int(timeout/interval)
-        for i in range(0, n_probes):
-            time.sleep(interval)
-            deployment = self.get()
-            if deployment and deployment["operation"]["status"] == "DONE":
-                break
+        operation = getattr(self, "operation", None)
+        if operation is None:
+            operation = self.get().get("operation")
+            if operation is None:
+                return
+        errors = poll_operations([(self.project, operation)], timeout)
+        if errors:
+            raise SystemExit("Deployment {} failed: {}".format(
+                self.name,
+                "".join(errors.values())
+            ))
 
-    def create(self, wait=False):
-        gpwm.utils.GCP_API.deployments().insert(
+    @property
+    def content_hash(self):
+        for label in self.labels:
+            if label["key"] == CONTENT_HASH_LABEL:
+                return label["value"]
+
+    def is_unchanged(self, deployment):
+        """ Tells if the deployment was created from the same content
+
+        Deployments whose last operation failed carry the label of the
+        content that failed, so they are always changed.
+        """
+        if deployment.get("operation", {}).get("error"):
+            return False
+        for label in deployment.get("labels", []):
+            if label["key"] == CONTENT_HASH_LABEL:
+                return label["value"] == self.content_hash
+        return False
+
+    def invalidate_cache(self):
+        gpwm.utils.invalidate_stack_cache(
+            self.name,
+            provider="gcp",
+            project=self.project
+        )
+
+    def start_create(self):
+        """ Starts the creation of the deployment, without waiting for it
+        """
+        self.operation = gpwm.utils.get_gcp_api().deployments().insert(
             project=self.project,
             body=self.body
         ).execute()
-        if wait:
-            self.wait()
 
-    def delete(self, wait=False):
+    def start_delete(self):
+        """ Starts the deletion of the deployment, without waiting for it
+        """
         if not self.get():
             raise SystemExit("Deployment doesn't exist: {}".format(self.name))
-        gpwm.utils.GCP_API.deployments().delete(
+        self.operation = gpwm.utils.get_gcp_api().deployments().delete(
             project=self.project,
             deployment=self.name
         ).execute()
-        if wait:
-            self.wait()
 
-    def update(self, wait=False, review=False):
-        gpwm.utils.GCP_API.deployments().insert(
+    def start_update(self, force=False):
+        """ Starts the update of the deployment, without waiting for it
+
+        Returns: False if the update was skipped because the deployment
+            didn't change, otherwise True
+        """
+        deployment = self.get()
+        if not deployment:
+            raise SystemExit("Deployment doesn't exist: {}".format(self.name))
+        if not force and self.is_unchanged(deployment):
+            print("Deployment {} unchanged, skipping update".format(
+                self.name
+            ))
+            return False
+        # updates must carry the fingerprint of the current deployment
+        body = dict(self.body, fingerprint=deployment["fingerprint"])
+        self.operation = gpwm.utils.get_gcp_api().deployments().update(
             project=self.project,
-            body=self.body
+            deployment=self.name,
+            body=body
         ).execute()
+        return True
+
+    def create(self, wait=False):
+        self.start_create()
+        if wait:
+            self.wait()
+        self.invalidate_cache()
+
+    def delete(self, wait=False):
+        self.start_delete()
         if wait:
             self.wait()
+        self.invalidate_cache()
 
-    def upsert(self, wait=False):
+    def update(self, wait=False, review=False, force=False):
+        if not self.start_update(force=force):
+            return
+        if wait:
+            self.wait()
+        self.invalidate_cache()
+
+    def upsert(self, wait=False, review=False, force=False):
         if self.get():
-            self.update(wait=wait)
+            self.update(wait=wait, force=force)
         else:
             self.create(wait=wait)
 
-    def render(self):
+    def limiter_key(self):
+        """ Returns the key limiting the concurrent API calls made for the
+        deployment (see gpwm.aio.get_limiter())
+        """
+        return ("gcp", self.project)
+
+    async def async_wait(self, timeout=WAITER_TIMEOUT):
+        """ Awaitable counterpart of wait()
+        """
+        operation = getattr(self, "operation", None)
+        if operation is None:
+            deployment = await gpwm.aio.call(self.limiter_key(), self.get)
+            operation = deployment.get("operation")
+            if operation is None:
+                return
+        error = await async_poll_operation(self.project, operation, timeout)
+        if error:
+            raise SystemExit("Deployment {} failed: {}".format(
+                self.name,
+                error
+            ))
+
+    async def async_create(self, wait=False):
+        """ Awaitable counterpart of create()
+        """
+        await gpwm.aio.call(self.limiter_key(), self.start_create)
+        if wait:
+            await self.async_wait()
+        await gpwm.aio.call(self.limiter_key(), self.invalidate_cache)
+
+    async def async_delete(self, wait=False):
+        """ Awaitable counterpart of delete()
+        """
+        await gpwm.aio.call(self.limiter_key(), self.start_delete)
+        if wait:
+            await self.async_wait()
+        await gpwm.aio.call(self.limiter_key(), self.invalidate_cache)
+
+    async def async_update(self, wait=False, review=False, force=False):
+        """ Awaitable counterpart of update()
+        """
+        started = await gpwm.aio.call(
+            self.limiter_key(),
+            self.start_update,
+            force=force
+        )
+        if not started:
+            return
+        if wait:
+            await self.async_wait()
+        await gpwm.aio.call(self.limiter_key(), self.invalidate_cache)
+
+    async def async_upsert(self, wait=False, review=False, force=False):
+        """ Awaitable counterpart of upsert()
+        """
+        if await gpwm.aio.call(self.limiter_key(), self.get):
+            await self.async_update(wait=wait, force=force)
+        else:
+            await self.async_create(wait=wait)
+
+    def to_yaml(self):
+        """ Returns the rendered deployment as a yaml document
+        """
         deployment = {"project": self.project, "body": self.body}
-        print(yaml.safe_dump(deployment, indent=2))
+        return gpwm.utils.dump_yaml(deployment)
+
+    def render(self):
+        print(self.to_yaml())
 
     def validate(self):
         pass
@@ -14,12 +14,400 @@
 
 
 from __future__ import print_function
+import asyncio
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import io
 import logging
 import os
+import signal
 import subprocess
-import yaml
+import sys
+import threading
+import time
 
+import gpwm.metrics
 import gpwm.stacks
+import gpwm.utils
+
+
+# Maximum number of command groups of an action running in parallel. Can be
+# overridden per stack with the Jobs attribute
+SHELL_JOBS = int(os.getenv("GPWM_SHELL_JOBS", 4))
+
+# Time (in seconds) a command group can run before being terminated. 0
+# means no timeout. Can be overridden per stack or per command group with
+# the Timeout attribute
+SHELL_TIMEOUT = int(os.getenv("GPWM_SHELL_TIMEOUT", 0))
+
+# Directory where the output of every action is logged. Defaults to the
+# "shell" directory inside the cache directory. Can be overridden per stack
+# with the LogDir attribute
+SHELL_LOG_DIR = os.getenv("GPWM_SHELL_LOG_DIR")
+
+# Time (in seconds) a terminated command has to exit before being killed
+TERMINATE_TIMEOUT = 5
+
+# How often (in seconds) running commands check for timeouts and
+# cancellation
+POLL_INTERVAL = 0.2
+
+# Size (in bytes) of the reads of the output of commands
+READ_SIZE = 65536
+
+# Serializes the output of commands running in parallel, so lines are never
+# interleaved
+OUTPUT_LOCK = threading.Lock()
+
+
+class CommandGroup(object):
+    """ Commands of an action executed by a single process
+
+    Attributes:
+        name(str): Identifies the group in the output and the logs
+        commands(str|list): A shell script, or the args of a command
+            executed without a shell
+        environment(dict): The environment variables
+        timeout(int): Seconds before the process is terminated. 0 means
+            no timeout
+        parallel(bool): If the group can run side by side with the
+            adjacent parallel groups. Parallel groups get no stdin, the
+            others get the stdin of gpwm (eg for commands prompting the
+            user)
+        terminal(bool): If the group gets the standard output and error of
+            gpwm, rather than having its output prefixed and logged (eg for
+            commands needing a terminal). Parallel groups can't
+        returncode(int): The return code of the process, when the commands
+            failed (rather than being terminated)
+    """
+    def __init__(self, name, commands, environment, timeout, parallel,
+                 terminal=False):
+        self.name = name
+        self.commands = commands
+        self.environment = environment
+        self.timeout = timeout
+        self.parallel = parallel
+        self.terminal = terminal
+        self.returncode = None
+
+
+def terminate(process):
+    """ Terminates a process and all its children, killing them if they
+    don't exit in TERMINATE_TIMEOUT seconds
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            return
+        try:
+            process.wait(timeout=TERMINATE_TIMEOUT)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def get_fileno(stream):
+    """ Returns the file descriptor of a stream, or None if it has none (eg
+    the streams of the daemon, sending the output to its client)
+    """
+    try:
+        return stream.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def get_streams(group):
+    """ Returns the stdin, stdout and stderr of the process of a group
+
+    Groups that aren't parallel get the stdin of gpwm, so the commands can
+    prompt the user. Their output is piped and copied by an OutputWriter,
+    like the output of parallel groups, unless the group asked for the
+    terminal: then it gets the standard output and error of gpwm, when they
+    are files.
+    """
+    if group.parallel:
+        return subprocess.DEVNULL, subprocess.PIPE, subprocess.PIPE
+    stdin = get_fileno(sys.stdin)
+    if stdin is None:
+        stdin = subprocess.DEVNULL
+    stdout, stderr = get_fileno(sys.stdout), get_fileno(sys.stderr)
+    if not group.terminal or stdout is None or stderr is None:
+        return stdin, subprocess.PIPE, subprocess.PIPE
+    # what gpwm wrote so far must come before the output of the commands
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return stdin, stdout, stderr
+
+
+class OutputWriter(object):
+    """ Copies the output of a command to an output stream and a log file,
+    as it comes, prefixing every line
+
+    Parallel groups write whole lines only, so the lines of the groups
+    running side by side are never interleaved. The other groups write the
+    output as it's read, so a prompt without a trailing newline shows up
+    before the command waits for the answer.
+    """
+    def __init__(self, prefix, output, log, lines):
+        self.prefix = prefix
+        self.output = output
+        self.log = log
+        self.lines = lines
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.pending = ""
+        self.line_start = True
+
+    def write(self, data):
+        """ Writes a chunk of output. An empty chunk ends the output
+        """
+        text = self.decoder.decode(data, final=not data)
+        if self.lines:
+            text = self.pending + text
+            end = text.rfind("\n") + 1 if data else len(text)
+            text, self.pending = text[:end], text[end:]
+        chunks = []
+        for line in text.splitlines(True):
+            if self.line_start:
+                chunks.append(self.prefix)
+            chunks.append(line)
+            self.line_start = line.endswith("\n")
+        if not data and not self.line_start:
+            chunks.append("\n")
+            self.line_start = True
+        if chunks:
+            text = "".join(chunks)
+            with OUTPUT_LOCK:
+                self.output.write(text)
+                self.output.flush()
+                self.log.write(text)
+                self.log.flush()
+
+
+def stream(pipe, writer):
+    """ Copies the output of a pipe with an OutputWriter, as it comes
+    """
+    for data in iter(functools.partial(pipe.read1, READ_SIZE), b""):
+        writer.write(data)
+    writer.write(b"")
+    pipe.close()
+
+
+def run_group(group, shell, log, cancelled):
+    """ Runs a command group, streaming its output
+
+    The group is terminated when it times out, or when cancelled is set
+    (eg another group failed). A failing group sets cancelled itself.
+
+    Returns: An error message if the group failed, otherwise None
+    """
+    if cancelled.is_set():
+        return "{}: cancelled".format(group.name)
+    if isinstance(group.commands, str):
+        args = {"shell": True, "executable": shell or None}
+    else:
+        args = {}
+    prefix = "[{}] ".format(group.name)
+    stdin, stdout, stderr = get_streams(group)
+    with gpwm.metrics.phase("shell", group=group.name):
+        process = subprocess.Popen(
+            group.commands,
+            env=group.environment,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+            # own process group, so children are terminated too
+            start_new_session=True,
+            **args
+        )
+        readers = []
+        if stdout == subprocess.PIPE:
+            readers = [
+                threading.Thread(target=stream, args=(
+                    process.stdout,
+                    OutputWriter(prefix, sys.stdout, log, group.parallel)
+                )),
+                threading.Thread(target=stream, args=(
+                    process.stderr,
+                    OutputWriter(prefix, sys.stderr, log, group.parallel)
+                ))
+            ]
+        else:
+            log_unattached(group, log)
+        for reader in readers:
+            reader.start()
+
+        deadline = time.time() + group.timeout if group.timeout else None
+        error = None
+        while True:
+            try:
+                process.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if cancelled.is_set():
+                error = "{}: cancelled".format(group.name)
+            elif deadline and time.time() > deadline:
+                error = "{}: timed out after {} seconds".format(
+                    group.name,
+                    group.timeout
+                )
+            else:
+                continue
+            terminate(process)
+            break
+        for reader in readers:
+            reader.join()
+
+    if error is None and process.returncode:
+        group.returncode = process.returncode
+        error = "{}: command {} exited with return code {}".format(
+            group.name,
+            group.commands,
+            process.returncode
+        )
+    if error is not None:
+        cancelled.set()
+    return error
+
+
+def log_unattached(group, log):
+    """ Notes in the log that the output of a group went straight to the
+    standard streams of gpwm, so it isn't logged
+    """
+    with OUTPUT_LOCK:
+        log.write("[{}] (output not logged: sent to the standard output "
+                  "and error of gpwm)\n".format(group.name))
+        log.flush()
+
+
+async def async_terminate(process):
+    """ Awaitable counterpart of terminate()
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+async def async_stream(reader, writer):
+    """ Awaitable counterpart of stream()
+
+    Reads chunks rather than lines, as StreamReader.readline() fails on
+    lines longer than the reader's limit.
+    """
+    while True:
+        data = await reader.read(READ_SIZE)
+        writer.write(data)
+        if not data:
+            break
+
+
+async def async_run_group(group, shell, log, cancelled, jobs):
+    """ Awaitable counterpart of run_group()
+
+    Args:
+        cancelled(asyncio.Event): Set to cancel the group
+        jobs(asyncio.Semaphore): Limits the groups running at once
+    """
+    async with jobs:
+        if cancelled.is_set():
+            return "{}: cancelled".format(group.name)
+        # the shell is started explicitly, like subprocess.Popen() does
+        # with shell=True
+        if isinstance(group.commands, str):
+            args = [shell or "/bin/sh", "-c", group.commands]
+        else:
+            args = group.commands
+        prefix = "[{}] ".format(group.name)
+        stdin, stdout, stderr = get_streams(group)
+        with gpwm.metrics.phase("shell", group=group.name):
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                env=group.environment,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr,
+                # own process group, so children are terminated too
+                start_new_session=True
+            )
+            if stdout == subprocess.PIPE:
+                readers = asyncio.gather(
+                    async_stream(process.stdout, OutputWriter(
+                        prefix, sys.stdout, log, group.parallel
+                    )),
+                    async_stream(process.stderr, OutputWriter(
+                        prefix, sys.stderr, log, group.parallel
+                    ))
+                )
+            else:
+                log_unattached(group, log)
+                readers = asyncio.gather()
+            exited = asyncio.ensure_future(process.wait())
+            cancel = asyncio.ensure_future(cancelled.wait())
+            try:
+                done, _ = await asyncio.wait(
+                    [exited, cancel],
+                    timeout=group.timeout or None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                cancel.cancel()
+            error = None
+            if exited not in done:
+                if cancelled.is_set():
+                    error = "{}: cancelled".format(group.name)
+                else:
+                    error = "{}: timed out after {} seconds".format(
+                        group.name,
+                        group.timeout
+                    )
+                await async_terminate(process)
+            await exited
+            await readers
+
+    if error is None and process.returncode:
+        group.returncode = process.returncode
+        error = "{}: command {} exited with return code {}".format(
+            group.name,
+            group.commands,
+            process.returncode
+        )
+    if error is not None:
+        cancelled.set()
+    return error
+
+
+def raise_errors(action, log_path, groups, errors):
+    """ Raises SystemExit if any command group of an action failed
+
+    The exit code is the return code of the first commands that failed,
+    like when executing them directly. Timeouts exit with 1.
+
+    Args:
+        groups(list): The command groups executed
+        errors(list): The results of the command groups: error messages,
+            or None for groups that succeeded
+    """
+    errors = [e for e in errors if e]
+    if errors:
+        for error in errors:
+            logging.error(error)
+        message = "Action {} failed (output in {})".format(action, log_path)
+        returncodes = [
+            g.returncode for g in groups if g.returncode is not None
+        ]
+        if returncodes and returncodes[0] > 0:
+            logging.error(message)
+            raise SystemExit(returncodes[0])
+        raise SystemExit(message)
 
 
 class ShellStack(gpwm.stacks.BaseStack):
@@ -33,13 +421,25 @@ class ShellStack(gpwm.stacks.BaseStack):
     def __init__(self, **kwargs):
         """
         Args:
-            Actions(dict): Actions allowed in for the stack. For each
-                action, these dict keys are available:
+            Actions(dict): Actions allowed in for the stack. Each action is
+                a command group, or a list of command groups executed in
+                order. For each command group, these dict keys are
+                available:
                 - Commands(str|list): Required. Represents the shell
                 commands to be executed for the action, and works
                 similarly to the "args" option in "subprocess.Popen()"
-                - Environments(dict): Optional. Represents environment
-                variables specific to the action
+                - Environment(dict): Optional. Represents environment
+                variables specific to the action (or command group)
+                - Name(str): Optional. Identifies the command group in the
+                output. Defaults to the action name, plus the position of
+                the group in the list
+                - Timeout(int): Optional. Seconds before the commands are
+                terminated. Defaults to the stack Timeout
+                - Parallel(bool): Optional. Adjacent parallel command groups
+                run side by side. Defaults to false
+                - Terminal(bool): Optional. The output of the commands goes
+                straight to the output of gpwm, so it's neither prefixed nor
+                logged. Not allowed for parallel groups. Defaults to false
             BuildId(str): The build ID. It will be exported as an
                 environment BUILD_ID.
             Shell(str): The shell do be used. Defaults to system shell,
@@ -49,6 +449,12 @@ class ShellStack(gpwm.stacks.BaseStack):
             Environment(dict): Stack-wide environment variables. These
                 variables will be set in all actions, unless overridden
                 by action-specific variables.
+            Timeout(int): Seconds before commands are terminated. Defaults
+                to SHELL_TIMEOUT. 0 means no timeout
+            Jobs(int): Maximum number of command groups running in
+                parallel. Defaults to SHELL_JOBS
+            LogDir(str): Directory where the output of the actions is
+                logged. Defaults to SHELL_LOG_DIR
 
         Example Stack:
             StackType: Shell
@@ -62,6 +468,15 @@ class ShellStack(gpwm.stacks.BaseStack):
                 Commands: |
                   cmd1
                   cmd2
+              Update:
+                - Name: images
+                  Parallel: true
+                  Timeout: 600
+                  Commands: build-images
+                - Name: docs
+                  Parallel: true
+                  Commands: build-docs
+                - Commands: publish
               Delete:
                 Commands: cmd3
         """
@@ -69,50 +484,170 @@ class ShellStack(gpwm.stacks.BaseStack):
 
         self.Shell = getattr(self, "Shell", "/bin/bash")
         self.Environment = getattr(self, "Environment", {})
+        self.Timeout = int(getattr(self, "Timeout", SHELL_TIMEOUT))
+        self.Jobs = int(getattr(self, "Jobs", SHELL_JOBS))
+        self.LogDir = getattr(self, "LogDir", SHELL_LOG_DIR)
 
         # Expands shell variables if command is a string
         for k, v in self.Actions.items():
-            if isinstance(v["Commands"], str):
-                self.Actions[k]["Commands"] = os.path.expandvars(v["Commands"])
+            for group in v if isinstance(v, list) else [v]:
+                if isinstance(group.get("Commands"), str):
+                    group["Commands"] = os.path.expandvars(group["Commands"])
 
-    def _execute(self, action):
-        """ Executes local commands in the system
+        # Merge global and stack-wide environment variables once. Stack
+        # variables win. It's only copied again for actions (or command
+        # groups) with their own variables
+        self._environment = dict(os.environ, **self.Environment)
+        self._environment["BUILD_ID"] = self.BuildId
+
+    def get_command_groups(self, action):
+        """ Returns the command groups of an action, in execution order
         """
         if action not in self.Actions.keys():
             raise SystemExit("Action not available: {}".format(action))
 
-        action_params = self.Actions[action]
+        groups = self.Actions[action]
+        if not isinstance(groups, list):
+            groups = [groups]
+        command_groups = []
+        for i, group in enumerate(groups):
+            commands = group.get("Commands")
+            if not commands:
+                raise SystemExit(
+                    "At least one command must be specified in a shell stack"
+                )
+            if not isinstance(commands, (str, list)):
+                raise SystemExit(
+                    "commands must be non a empty list or str: {}".format(
+                        commands
+                    )
+                )
+            parallel = bool(group.get("Parallel", False))
+            terminal = bool(group.get("Terminal", False))
+            if parallel and terminal:
+                raise SystemExit(
+                    "Parallel command groups can't get the terminal"
+                )
+            # Action specific variables win
+            environment = self._environment
+            if group.get("Environment"):
+                environment = dict(environment, **group["Environment"])
+                environment["BUILD_ID"] = self.BuildId
+            command_groups.append(CommandGroup(
+                name=group.get("Name") or (
+                    action if len(groups) == 1 else "{}-{}".format(action, i)
+                ),
+                commands=commands,
+                environment=environment,
+                timeout=int(group.get("Timeout", self.Timeout)),
+                parallel=parallel,
+                terminal=terminal
+            ))
+        return command_groups
 
-        commands = action_params.get("Commands")
-        if not commands:
-            raise SystemExit(
-                "At least one command must be specified in a shell stack"
-            )
+    def get_stages(self, action):
+        """ Returns the command groups of an action, split in stages
+
+        Stages run in order. Groups in a stage run side by side: adjacent
+        parallel groups share a stage, other groups have their own.
+        """
+        stages = []
+        for group in self.get_command_groups(action):
+            if group.parallel and stages and stages[-1][-1].parallel:
+                stages[-1].append(group)
+            else:
+                stages.append([group])
+        return stages
+
+    def get_log_path(self, action):
+        """ Returns the path of the log file of an action
 
-        if isinstance(commands, str):
-            args = {"shell": True, "executable": self.Shell or None}
-        elif isinstance(commands, list):
-            args = {}
+        Shell stacks have no name, so the file is named after the action,
+        the build ID and the hash of the actions.
+        """
+        if self.LogDir:
+            log_dir = self.LogDir
+            os.makedirs(log_dir, exist_ok=True)
         else:
-            raise SystemExit(
-                "commands must be non a empty list or str: {}".format(commands)
-            )
-        # Merge global and action specific environment variables.
-        # Action specific variables win.
-        environment = dict(os.environ.copy(), **self.Environment)
-        environment.update(action_params.get("Environment", {}))
-        environment["BUILD_ID"] = self.BuildId
-
-        process = subprocess.Popen(commands, env=environment, **args)
-        process.wait()
-        if process.returncode:
-            logging.error(
-                "Command {} exited with return code {}".format(
-                    commands,
-                    process.returncode
-                )
-            )
-            raise SystemExit(process.returncode)
+            log_dir = gpwm.utils.get_cache_dir("shell")
+        return os.path.join(log_dir, "{}-{}-{}.log".format(
+            action.lower(),
+            self.BuildId,
+            gpwm.utils.content_hash(self.Actions)[:12]
+        ))
+
+    def _execute(self, action):
+        """ Executes local commands in the system
+
+        Command groups run in order, except adjacent parallel groups, which
+        run side by side (up to Jobs processes at a time). The threads of
+        the pool only supervise the processes of the groups: they stream
+        their output and enforce the timeouts. When a group fails or times
+        out, the running groups are terminated and the remaining ones are
+        skipped.
+        """
+        stages = self.get_stages(action)
+        log_path = self.get_log_path(action)
+        cancelled = threading.Event()
+        errors = []
+        with open(log_path, "a") as log:
+            for stage in stages:
+                if cancelled.is_set():
+                    break
+                jobs = max(1, min(self.Jobs, len(stage)))
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    futures = [
+                        executor.submit(
+                            run_group,
+                            group,
+                            self.Shell,
+                            log,
+                            cancelled
+                        ) for group in stage
+                    ]
+                    try:
+                        errors.extend(f.result() for f in futures)
+                    except BaseException:
+                        # eg KeyboardInterrupt: stop everything running
+                        cancelled.set()
+                        raise
+        raise_errors(
+            action,
+            log_path,
+            [g for stage in stages for g in stage],
+            errors
+        )
+
+    async def _async_execute(self, action):
+        """ Awaitable counterpart of _execute()
+
+        Commands run as asyncio subprocesses, so no thread is needed per
+        command group.
+        """
+        stages = self.get_stages(action)
+        log_path = self.get_log_path(action)
+        cancelled = asyncio.Event()
+        jobs = asyncio.Semaphore(max(1, self.Jobs))
+        errors = []
+        with open(log_path, "a") as log:
+            for stage in stages:
+                if cancelled.is_set():
+                    break
+                tasks = [
+                    async_run_group(group, self.Shell, log, cancelled, jobs)
+                    for group in stage
+                ]
+                try:
+                    errors.extend(await asyncio.gather(*tasks))
+                except BaseException:
+                    cancelled.set()
+                    raise
+        raise_errors(
+            action,
+            log_path,
+            [g for stage in stages for g in stage],
+            errors
+        )
 
     def create(self, wait=False):
         self._execute(action="Create")
@@ -120,8 +655,22 @@ class ShellStack(gpwm.stacks.BaseStack):
     def delete(self, wait=False):
         self._execute(action="Delete")
 
-    def update(self, wait=False, review=False):
+    def update(self, wait=False, review=False, force=False):
         self._execute(action="Update")
 
+    async def async_create(self, wait=False):
+        await self._async_execute(action="Create")
+
+    async def async_delete(self, wait=False):
+        await self._async_execute(action="Delete")
+
+    async def async_update(self, wait=False, review=False, force=False):
+        await self._async_execute(action="Update")
+
+    def to_yaml(self):
+        """ Returns the rendered actions as a yaml document
+        """
+        return gpwm.utils.dump_yaml(self.Actions)
+
     def render(self, wait=False):
-        print(yaml.dump(self.Actions, indent=2))
+        print(self.to_yaml())
@@ -18,48 +18,473 @@
 
 
 from __future__ import print_function
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import copy
+import errno
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
 from six.moves.urllib.parse import parse_qs
 from six.moves.urllib.parse import urlunparse
 import yaml
 
-import apiclient.discovery  # GCP API
-import boto3
 import jinja2
 import jmespath
 import mako.exceptions
 import mako.template
 
+import gpwm.cache
+import gpwm.metrics
+import gpwm.nesting
+import gpwm.ratelimit
+import gpwm.validation
 
-STACK_CACHE = {}
-CF_STACK_RESOURCE_CACHE = {}
 
-# CFN API objects
-BOTO_CF_RESOURCE = boto3.resource("cloudformation")
-BOTO_CF_CLIENT = boto3.client("cloudformation")
+# Local directory where gpwm keeps its on-disk caches
+CACHE_DIR = os.getenv(
+    "GPWM_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "gpwm")
+)
 
-# GCP API objects
-GCP_API = apiclient.discovery.build("deploymentmanager", "v2")
+# How long (in seconds) a cached GCP discovery document is trusted before
+# being fetched again
+DISCOVERY_CACHE_TTL = 86400
+
+# libyaml based loader and dumper, much faster than the pure python ones,
+# which are only used when PyYAML is built without libyaml. Stack files and
+# templates are loaded with the full loader (the custom tags are registered
+# on it), everything else is loaded and dumped safely
+YAML_LOADER = getattr(yaml, "CLoader", yaml.Loader)
+YAML_SAFE_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Maximum number of yaml tags resolved in parallel
+TAG_RESOLUTION_WORKERS = 16
+
+# Maximum number of names per SSM GetParameters call
+SSM_GET_PARAMETERS_MAX_NAMES = 10
+
+# Prefixes of AWS actions that don't change anything, so call_aws() can
+# memoize their results for the run
+READ_ONLY_ACTION_PREFIXES = ("describe_", "get_", "list_")
+CALL_AWS_CACHE = {}
+CALL_AWS_CACHE_LOCK = threading.Lock()
+CALL_AWS_STATS = {"hits": 0, "misses": 0, "uncacheable": 0}
+
+# Compiled jmespath expressions used as result filters, keyed by expression
+JMESPATH_EXPRESSIONS = {}
+
+# Directory for compiled templates. Defaults to the "templates" directory
+# inside CACHE_DIR
+TEMPLATE_CACHE_DIR = os.getenv("GPWM_TEMPLATE_CACHE_DIR")
+
+# Compiled Mako/Jinja templates, keyed by engine and hash of the source.
+# Compiled templates are also kept on disk, so a template is compiled once
+# per machine, not once per render. Only the most recently used ones are kept
+# in memory, as a daemon renders any number of templates.
+COMPILED_TEMPLATES = collections.OrderedDict()
+COMPILED_TEMPLATES_MAX_SIZE = int(
+    os.getenv("GPWM_COMPILED_TEMPLATES_MAX_SIZE", 256)
+)
+COMPILED_TEMPLATES_LOCK = threading.Lock()
+JINJA_ENVIRONMENT = None
+JINJA_SOURCES = {}
+
+# Maximum number of HTTP connections kept alive per provider client
+MAX_POOL_CONNECTIONS = int(os.getenv("GPWM_MAX_POOL_CONNECTIONS", 20))
+
+# Provider API objects (boto3 clients/resources, GCP APIs) are only created
+# the first time a stack or yaml tag needs them, so stacks that never talk to
+# a provider (eg shell stacks) don't pay for SDK imports, session setup or
+# GCP API discovery
+PROVIDER_CLIENTS = {}
+PROVIDER_CLIENTS_LOCK = threading.RLock()
+# The settings the registered clients were created with
+PROVIDER_CLIENTS_SETTINGS = None
+
+
+class DiscoveryFileCache(object):
+    """ On-disk cache for GCP API discovery documents
+
+    Implements the same interface as googleapiclient's
+    discovery_cache.base.Cache, so it can be given to
+    apiclient.discovery.build() as the "cache" argument.
+    """
+    def __init__(self, directory, ttl=DISCOVERY_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "{}.json".format(key))
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, url, content):
+        try:
+            write_cache_file(self._path(url), content)
+        except (IOError, OSError):
+            pass
+
+
+def sleep_with_jitter(delay):
+    """ Sleeps for a random time between half and the full delay
+
+    Jitter keeps many waiters running in parallel from polling in lockstep.
+    """
+    time.sleep(random.uniform(delay / 2.0, delay))
+
+
+def content_hash(obj):
+    """ Returns a stable hash of any JSON serializable object
+
+    Dicts are hashed with sorted keys, so the hash doesn't depend on the
+    order keys were added.
+    """
+    return hashlib.sha1(
+        json.dumps(obj, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def get_cache_dir(*subdirs):
+    """ Returns (and creates if needed) a directory inside CACHE_DIR
+    """
+    path = os.path.join(CACHE_DIR, *subdirs)
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def get_template_cache_dir(*subdirs):
+    """ Returns (and creates if needed) a directory for compiled templates
+    """
+    if TEMPLATE_CACHE_DIR:
+        path = os.path.join(TEMPLATE_CACHE_DIR, *subdirs)
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        return path
+    return get_cache_dir("templates", *subdirs)
+
+
+def write_cache_file(path, content):
+    """ Atomically writes content to a cache file
+
+    The content is written to a temp file first, so concurrent gpwm runs
+    never read a partially written file.
+    """
+    tmp_path = "{}.{}.{}.tmp".format(
+        path,
+        os.getpid(),
+        threading.current_thread().ident
+    )
+    with open(tmp_path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def get_compiled_template(engine, template_body, compile_template):
+    """ Returns a compiled template from the in-memory cache
+
+    Args:
+        engine(str): The templating engine
+        template_body(str): The template source
+        compile_template(callable): Compiles the template. Takes the hash of
+            the template source as argument. Only called on cache misses
+
+    Returns: The compiled template
+    """
+    digest = hashlib.sha256(template_body.encode("utf-8")).hexdigest()
+    key = (engine, digest)
+    with COMPILED_TEMPLATES_LOCK:
+        template = COMPILED_TEMPLATES.get(key)
+        if template is not None:
+            COMPILED_TEMPLATES.move_to_end(key)
+            return template
+    with gpwm.metrics.phase("compile", engine=engine):
+        template = compile_template(digest)
+    with COMPILED_TEMPLATES_LOCK:
+        template = COMPILED_TEMPLATES.setdefault(key, template)
+        while len(COMPILED_TEMPLATES) > COMPILED_TEMPLATES_MAX_SIZE:
+            (evicted_engine, evicted_digest), _ = \
+                COMPILED_TEMPLATES.popitem(last=False)
+            if evicted_engine == "jinja":
+                JINJA_SOURCES.pop(evicted_digest, None)
+    return template
+
+
+def get_mako_template(template_body):
+    """ Returns a compiled Mako template
+
+    The template source is stored on disk under its hash, so Mako can keep
+    the compiled python module in its module_directory and reuse it across
+    gpwm runs.
+    """
+    def compile_template(digest):
+        path = os.path.join(
+            get_template_cache_dir("mako"),
+            "{}.mako".format(digest)
+        )
+        if not os.path.exists(path):
+            write_cache_file(path, template_body.encode("utf-8"))
+        # The default for strict_undefined is False. Change to True to
+        # troubleshoot pesky templates
+        return mako.template.Template(
+            filename=path,
+            uri="{}.mako".format(digest),
+            module_directory=get_template_cache_dir("mako_modules"),
+            input_encoding="utf-8",
+            strict_undefined=False
+        )
+    return get_compiled_template("mako", template_body, compile_template)
+
+
+def get_jinja_template(template_body):
+    """ Returns a compiled Jinja template
+
+    The template is loaded by its hash from an environment with a bytecode
+    cache on disk, so the compiled template is reused across gpwm runs.
+    """
+    global JINJA_ENVIRONMENT
+    if JINJA_ENVIRONMENT is None:
+        with COMPILED_TEMPLATES_LOCK:
+            if JINJA_ENVIRONMENT is None:
+                JINJA_ENVIRONMENT = jinja2.Environment(
+                    loader=jinja2.FunctionLoader(
+                        lambda digest: JINJA_SOURCES.get(digest)
+                    ),
+                    bytecode_cache=jinja2.FileSystemBytecodeCache(
+                        get_template_cache_dir("jinja")
+                    )
+                )
+
+    def compile_template(digest):
+        JINJA_SOURCES[digest] = template_body
+        return JINJA_ENVIRONMENT.get_template(digest)
+    return get_compiled_template("jinja", template_body, compile_template)
+
+
+def get_provider_client(key, factory):
+    """ Returns the provider API object registered under key
+
+    Args:
+        key(tuple): The registry key, eg ("aws", "client", "cloudformation")
+        factory(callable): Creates the API object. Only called the first
+            time the key is requested
+
+    The registry is dropped when MAX_POOL_CONNECTIONS changes (eg between
+    the requests served by the daemon), as clients are created with it.
+
+    Returns: The API object
+    """
+    global PROVIDER_CLIENTS_SETTINGS
+    settings = (MAX_POOL_CONNECTIONS,)
+    client = PROVIDER_CLIENTS.get(key)
+    if client is None or PROVIDER_CLIENTS_SETTINGS != settings:
+        with PROVIDER_CLIENTS_LOCK:
+            if PROVIDER_CLIENTS_SETTINGS != settings:
+                PROVIDER_CLIENTS.clear()
+                PROVIDER_CLIENTS_SETTINGS = settings
+            client = PROVIDER_CLIENTS.get(key)
+            if client is None:
+                client = factory()
+                PROVIDER_CLIENTS[key] = client
+    return client
+
+
+def get_boto_session(profile=None):
+    """ Returns a (lazily created) boto3 session for the AWS profile
+    """
+    def factory():
+        import boto3
+        return boto3.session.Session(profile_name=profile)
+    return get_provider_client(("aws", "session", profile), factory)
+
+
+def get_boto_config():
+    """ Returns the botocore config shared by all clients
+    """
+    import botocore.config
+    return botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+
+def get_boto_client(service, region=None, profile=None):
+    """ Returns a (lazily created) boto3 client for the AWS service
+
+    Clients are shared by all callers (boto3 clients are thread safe), so
+    their HTTP connections are kept alive and reused.
+
+    Args:
+        service(str): The AWS service, eg "ec2"
+        region(str): The AWS region. Defaults to the profile's region
+        profile(str): The AWS profile. Defaults to the default profile
+    """
+    def factory():
+        client = get_boto_session(profile).client(
+            service,
+            region_name=region,
+            config=get_boto_config()
+        )
+        gpwm.metrics.instrument_boto_client(client)
+        gpwm.ratelimit.instrument_boto_client(client)
+        return client
+    return get_provider_client(
+        ("aws", "client", service, region, profile),
+        factory
+    )
+
+
+def get_boto_resource(service, region=None, profile=None):
+    """ Returns a (lazily created) boto3 resource for the AWS service
+    """
+    def factory():
+        resource = get_boto_session(profile).resource(
+            service,
+            region_name=region,
+            config=get_boto_config()
+        )
+        gpwm.metrics.instrument_boto_client(resource.meta.client)
+        gpwm.ratelimit.instrument_boto_client(resource.meta.client)
+        return resource
+    return get_provider_client(
+        ("aws", "resource", service, region, profile),
+        factory
+    )
+
+
+def get_http_session():
+    """ Returns a (lazily created) requests session
+
+    The session keeps HTTP connections alive across template fetches.
+    """
+    def factory():
+        import requests
+        import requests.adapters
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=MAX_POOL_CONNECTIONS
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    return get_provider_client(("http", "session"), factory)
+
+
+def get_gcp_api(api="deploymentmanager", version="v2"):
+    """ Returns a (lazily created) GCP API object
+
+    The discovery document describing the API is kept in a local cache, so
+    building the API object doesn't hit the network. Every request executed
+    is timed (see gpwm.metrics) and rate limited (see gpwm.ratelimit).
+    """
+    def factory():
+        import apiclient.discovery
+        import apiclient.errors
+        import apiclient.http
+
+        class HttpRequest(apiclient.http.HttpRequest):
+            def execute(self, *args, **kwargs):
+                bucket = gpwm.ratelimit.get_bucket(("gcp", api, "global"))
+                if bucket is not None:
+                    bucket.acquire()
+                try:
+                    with gpwm.metrics.api_call(api, self.methodId):
+                        response = super(HttpRequest, self).execute(
+                            *args,
+                            **kwargs
+                        )
+                except apiclient.errors.HttpError as exc:
+                    if bucket is not None and \
+                            gpwm.ratelimit.is_gcp_throttle(exc):
+                        bucket.on_throttle()
+                    raise
+                if bucket is not None:
+                    bucket.on_success()
+                return response
+
+        return apiclient.discovery.build(
+            api,
+            version,
+            cache=DiscoveryFileCache(get_cache_dir("discovery")),
+            requestBuilder=HttpRequest
+        )
+    return get_provider_client(("gcp", api, version), factory)
+
+
+class TagPlaceholder(object):
+    """ A yaml tag waiting to be resolved
+
+    Tags are not resolved while PyYAML builds the document. Constructors
+    return placeholders instead, so all tags of a document can be resolved
+    at once, in parallel and without duplicate calls (see resolve_tags()).
+
+    Attributes:
+        tag(str): The yaml tag, eg "!SSM"
+        arguments(dict): The tag arguments
+    """
+    def __init__(self, tag, arguments):
+        self.tag = tag
+        self.arguments = arguments
+
+    def __repr__(self):
+        return "{} {}".format(self.tag, self.arguments)
+
+    @property
+    def key(self):
+        """ Identifies tags that resolve to the same value
+        """
+        return (self.tag, json.dumps(self.arguments, sort_keys=True,
+                                     default=str))
 
 
 def yaml_cloudformation_constructor(loader, node):
     """ Implements the yaml tag !Cloudformation
 
     The tag takes a dict {stack: $stack_name, output: output_key}
-    as node (argument).
+    as node (argument), or {export: $export_name} to resolve an export
+    like Fn::ImportValue does.
 
     Example:
       VpcId: !Cloudformation {stack: ${vpc_stack}, output: VPC}
       VpcId: !Cloudformation {stack: ${vpc_stack}, resource_id: VPC}
+      VpcId: !Cloudformation {export: ${vpc_stack}-VPC}
     """
-    output_dict = loader.construct_mapping(node)
-    stack_name = output_dict["stack"]
-    if "output" in output_dict.keys():
-        return get_stack_output(stack_name, output_dict["output"])
-    elif "resource_id" in output_dict.keys():
-        return get_stack_resource(stack_name, output_dict["resource_id"])
+    return TagPlaceholder(
+        "!Cloudformation",
+        loader.construct_mapping(node, deep=True)
+    )
+
+
+def resolve_cloudformation_tag(arguments):
+    if "export" in arguments.keys():
+        return get_export_value(arguments["export"])
+    stack_name = arguments["stack"]
+    if "output" in arguments.keys():
+        return get_stack_output(stack_name, arguments["output"])
+    elif "resource_id" in arguments.keys():
+        return get_stack_resource(stack_name, arguments["resource_id"])
     else:
-        raise SystemExit("Either 'output' or 'resource_id' must be provided")
+        raise SystemExit(
+            "Either 'output', 'resource_id' or 'export' must be provided"
+        )
 
 
 def yaml_ssm_constructor(loader, node):
@@ -73,14 +498,58 @@ def yaml_ssm_constructor(loader, node):
       SomeValue: !SSM {Name: /some/parameter/name}
       SomePassword: !SSM {Name: /some/name, WithDecryption: true}
     """
-    args = loader.construct_mapping(node)
+    return TagPlaceholder("!SSM", loader.construct_mapping(node, deep=True))
+
+
+def resolve_ssm_tag(arguments):
     return call_aws(
         service="ssm",
         action="get_parameter",
-        arguments=args
+        arguments=arguments
     )["Parameter"]["Value"]
 
 
+def resolve_ssm_tags(placeholders):
+    """ Resolves many !SSM tags with batched GetParameters calls
+
+    Args:
+        placeholders(list): TagPlaceholder objects sharing the same
+            WithDecryption argument
+
+    Returns: A dict mapping the placeholder keys to the parameter values
+    """
+    placeholders = list(placeholders)
+    with_decryption = placeholders[0].arguments.get("WithDecryption", False)
+    names = sorted({p.arguments["Name"] for p in placeholders})
+    values = {}
+    for i in range(0, len(names), SSM_GET_PARAMETERS_MAX_NAMES):
+        result = call_aws(
+            service="ssm",
+            action="get_parameters",
+            arguments={
+                "Names": names[i:i + SSM_GET_PARAMETERS_MAX_NAMES],
+                "WithDecryption": with_decryption
+            }
+        )
+        for parameter in result["Parameters"]:
+            values[parameter["Name"] + parameter.get("Selector", "")] = \
+                parameter["Value"]
+        if result.get("InvalidParameters"):
+            raise SystemExit("SSM parameters not found: {}".format(
+                ", ".join(result["InvalidParameters"])
+            ))
+
+    resolved = {}
+    for placeholder in placeholders:
+        name = placeholder.arguments["Name"]
+        # names not echoed back verbatim (eg parameter ARNs) are looked up
+        # one by one
+        if name not in values:
+            values[name] = resolve_ssm_tag(placeholder.arguments)
+        resolved[placeholder.key] = values[name]
+    return resolved
+
+
 def yaml_aws_constructor(loader, node):
     """ Implements the yaml tag !AWS
 
@@ -97,8 +566,26 @@ def yaml_aws_constructor(loader, node):
           result_filter: "Vpcs[].VpcId"
       }
     """
-    args_dict = loader.construct_mapping(node, deep=True)
-    return call_aws(**args_dict)
+    return TagPlaceholder("!AWS", loader.construct_mapping(node, deep=True))
+
+
+def resolve_aws_tag(arguments):
+    """ Resolves an !AWS tag
+
+    The value of the tag must be complete, so paginated results are
+    collected in a list, memoized like the results of single calls.
+    """
+    if not arguments.get("paginate"):
+        return call_aws(**arguments)
+    if not is_read_only_action(arguments["action"]):
+        return list(call_aws(**arguments))
+    key = (
+        arguments["service"],
+        arguments["action"],
+        "paginated",
+        json.dumps(arguments, sort_keys=True, default=str)
+    )
+    return memoize_aws_call(key, lambda: list(call_aws(**arguments)))
 
 
 def yaml_gcp_dm_constructor(loader, node):
@@ -110,22 +597,358 @@ def yaml_gcp_dm_constructor(loader, node):
     Example:
       VpcId: !GCPDM {deployment: ${vpc_stack}, output: VPC}
     """
-    output_dict = loader.construct_mapping(node)
-    if "output" in output_dict.keys():
+    return TagPlaceholder("!GCPDM", loader.construct_mapping(node, deep=True))
+
+
+def resolve_gcp_dm_tag(arguments):
+    if "output" in arguments.keys():
         return get_stack_output(
-            stack_name=output_dict["deployment"],
-            output_key=output_dict["output"],
+            stack_name=arguments["deployment"],
+            output_key=arguments["output"],
             provider="gcp",
-            project=output_dict["project"]
+            project=arguments["project"]
         )
     else:
         raise SystemExit("Either 'output' or 'resource' must be provided")
 
 
-yaml.add_constructor(u'!Cloudformation', yaml_cloudformation_constructor)
-yaml.add_constructor(u'!AWS', yaml_aws_constructor)
-yaml.add_constructor(u'!SSM', yaml_ssm_constructor)
-yaml.add_constructor(u'!GCPDM', yaml_gcp_dm_constructor)
+yaml.add_constructor(
+    u'!Cloudformation',
+    yaml_cloudformation_constructor,
+    Loader=YAML_LOADER
+)
+yaml.add_constructor(u'!AWS', yaml_aws_constructor, Loader=YAML_LOADER)
+yaml.add_constructor(u'!SSM', yaml_ssm_constructor, Loader=YAML_LOADER)
+yaml.add_constructor(u'!GCPDM', yaml_gcp_dm_constructor, Loader=YAML_LOADER)
+
+TAG_RESOLVERS = {
+    "!Cloudformation": resolve_cloudformation_tag,
+    "!AWS": resolve_aws_tag,
+    "!SSM": resolve_ssm_tag,
+    "!GCPDM": resolve_gcp_dm_tag
+}
+
+
+def find_placeholders(obj, found=None):
+    """ Finds all tag placeholders in a loaded yaml document
+
+    Returns: A dict of placeholders keyed by TagPlaceholder.key
+    """
+    if found is None:
+        found = {}
+    if isinstance(obj, TagPlaceholder):
+        found.setdefault(obj.key, obj)
+        find_placeholders(obj.arguments, found)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            find_placeholders(k, found)
+            find_placeholders(v, found)
+    elif isinstance(obj, list):
+        for i in obj:
+            find_placeholders(i, found)
+    return found
+
+
+def replace_placeholders(obj, values):
+    """ Replaces the resolved placeholders in a loaded yaml document
+
+    Args:
+        obj: The yaml document
+        values(dict): The resolved values, keyed by TagPlaceholder.key
+
+    Returns: The document with placeholders replaced by their values
+    """
+    if isinstance(obj, TagPlaceholder):
+        if obj.key in values:
+            return values[obj.key]
+        return TagPlaceholder(
+            obj.tag,
+            replace_placeholders(obj.arguments, values)
+        )
+    elif isinstance(obj, dict):
+        return {
+            replace_placeholders(k, values): replace_placeholders(v, values)
+            for k, v in obj.items()
+        }
+    elif isinstance(obj, list):
+        return [replace_placeholders(i, values) for i in obj]
+    return obj
+
+
+def resolve_placeholders(placeholders):
+    """ Resolves tag placeholders in parallel
+
+    Identical tags are resolved only once, and !SSM tags are resolved with
+    batched GetParameters calls.
+
+    Returns: A dict mapping the placeholder keys to the resolved values
+    """
+    jobs = []
+    ssm_groups = {}
+    for placeholder in placeholders:
+        if placeholder.tag == "!SSM" and \
+                set(placeholder.arguments.keys()) <= \
+                {"Name", "WithDecryption"}:
+            decrypt = bool(placeholder.arguments.get("WithDecryption"))
+            ssm_groups.setdefault(decrypt, []).append(placeholder)
+        else:
+            jobs.append(placeholder)
+
+    values = {}
+    with ThreadPoolExecutor(max_workers=TAG_RESOLUTION_WORKERS) as executor:
+        futures = {
+            p.key: executor.submit(TAG_RESOLVERS[p.tag], p.arguments)
+            for p in jobs
+        }
+        ssm_futures = [
+            executor.submit(resolve_ssm_tags, group)
+            for group in ssm_groups.values()
+        ]
+        for key, future in futures.items():
+            values[key] = future.result()
+        for future in ssm_futures:
+            values.update(future.result())
+    return values
+
+
+def resolve_tags(document):
+    """ Resolves all yaml tags of a loaded document
+
+    Tags used as arguments of other tags are resolved first.
+
+    Returns: The document with tags replaced by their values
+    """
+    placeholders = find_placeholders(document)
+    while placeholders:
+        ready = [
+            p for p in placeholders.values()
+            if not find_placeholders(p.arguments)
+        ]
+        document = replace_placeholders(document, resolve_placeholders(ready))
+        placeholders = find_placeholders(document)
+    return document
+
+
+def load_yaml(text):
+    """ Loads a yaml document and resolves its tags
+
+    Loading happens in two phases: the document is built with placeholders
+    for the tags, then all tags are resolved concurrently and replaced in
+    the document.
+    """
+    with gpwm.metrics.phase("yaml.load"):
+        document = yaml.load(text, Loader=YAML_LOADER)
+    with gpwm.metrics.phase("tags"):
+        return resolve_tags(document)
+
+
+def dump_yaml(data, **kwargs):
+    """ Dumps data as a yaml document, with the libyaml dumper if available
+
+    Args:
+        data: The data. Only plain python types are supported
+        kwargs: Passed to yaml.dump(). The indentation defaults to 2
+
+    Returns: The yaml document as a string
+    """
+    kwargs.setdefault("indent", 2)
+    with gpwm.metrics.phase("yaml.dump"):
+        return yaml.dump(data, Dumper=YAML_DUMPER, **kwargs)
+
+
+def get_aws_account_id():
+    """ Returns the (lazily fetched) ID of the AWS account in use
+    """
+    return get_provider_client(
+        ("aws", "account_id"),
+        lambda: get_boto_client("sts").get_caller_identity()["Account"]
+    )
+
+
+def get_stack_cache_prefix(stack_name, provider="cloudformation", **kwargs):
+    """ Returns the prefix of the cache keys for all data of a stack
+
+    Cloudformation stacks are keyed by region, account and stack name,
+    and GCP deployments by project and deployment name.
+    """
+    if provider == "cloudformation":
+        parts = [
+            get_boto_client("cloudformation").meta.region_name,
+            get_aws_account_id(),
+            stack_name
+        ]
+    elif provider == "gcp":
+        parts = [kwargs["project"], stack_name]
+    else:
+        raise SystemExit("Provider not supported: {}".format(provider))
+    return gpwm.cache.stack_cache_key(provider, *parts) + ":"
+
+
+def invalidate_stack_cache(stack_name, provider="cloudformation", **kwargs):
+    """ Drops all cached data of a stack
+
+    Must be called whenever a stack is created, updated or deleted. The
+    exports of Cloudformation stacks are indexed per region, so the index
+    is dropped too.
+    """
+    cache = gpwm.cache.get_stack_cache()
+    cache.invalidate(get_stack_cache_prefix(stack_name, provider, **kwargs))
+    if provider == "cloudformation":
+        cache.invalidate(get_exports_cache_key())
+
+
+def get_stack_data(key, fetch, lookup, name):
+    """ Looks up a value in the cached data of a stack
+
+    The stack data is fetched in bulk and cached on a cache miss. If the
+    value isn't in the cached data (eg the stack was changed outside gpwm),
+    the data is fetched again before giving up. Values still not found are
+    cached as missing, so looking them up again doesn't fetch the data
+    until the cache entries expire.
+
+    Args:
+        key(str): The cache key of the stack data
+        fetch(callable): Fetches the stack data from the provider API
+        lookup(callable): Finds the value in the stack data, returns None
+            if not found
+        name(str): The name of the value, eg the output key
+
+    Returns: The value, or None if not found
+    """
+    cache = gpwm.cache.get_stack_cache()
+    data = cache.get(key)
+    if data is not None:
+        value = lookup(data)
+        if value is not None:
+            return value
+    # starts with the key, so it's invalidated with the stack data
+    missing_key = "{}:missing:{}".format(key, name)
+    if data is not None and cache.get(missing_key):
+        return None
+    data = fetch()
+    cache.set(key, data)
+    value = lookup(data)
+    if value is None:
+        cache.set(missing_key, True)
+    return value
+
+
+def fetch_cf_stack_outputs(stack_name):
+    """ Fetches all outputs of a Cloudformation stack with one API call
+
+    Outputs of stacks split into nested stacks by gpwm can live in the
+    nested stacks, so these are fetched too.
+
+    Returns: An index of the outputs, so any number of them can be looked
+        up in constant time: {"outputs": {key: value},
+        "exports": {export name: value}}
+    """
+    client = get_boto_client("cloudformation")
+    stack = client.describe_stacks(StackName=stack_name)["Stacks"][0]
+    outputs = stack.get("Outputs", [])
+    tags = {t["Key"]: t["Value"] for t in stack.get("Tags", [])}
+    if tags.get(gpwm.nesting.NESTED_STACKS_TAG) == "true":
+        for nested_stack_id in list_nested_stacks(stack_name):
+            outputs.extend(client.describe_stacks(
+                StackName=nested_stack_id
+            )["Stacks"][0].get("Outputs", []))
+    return {
+        "outputs": {o["OutputKey"]: o["OutputValue"] for o in outputs},
+        "exports": {
+            o["ExportName"]: o["OutputValue"] for o in outputs
+            if o.get("ExportName")
+        }
+    }
+
+
+def fetch_cf_exports():
+    """ Fetches all Cloudformation exports of the region
+
+    Returns: A dict mapping the export names to their values
+    """
+    paginator = get_boto_client("cloudformation").get_paginator(
+        "list_exports"
+    )
+    exports = {}
+    for page in paginator.paginate():
+        for export in page["Exports"]:
+            exports[export["Name"]] = export["Value"]
+    return exports
+
+
+def list_stack_resources(stack_name):
+    """ Returns the resource summaries of a Cloudformation stack
+    """
+    paginator = get_boto_client("cloudformation").get_paginator(
+        "list_stack_resources"
+    )
+    resources = []
+    for page in paginator.paginate(StackName=stack_name):
+        resources.extend(page["StackResourceSummaries"])
+    return resources
+
+
+def is_nested_stack(resource):
+    """ Tells if a resource summary is a nested stack created by gpwm
+    """
+    return resource["ResourceType"] == "AWS::CloudFormation::Stack" and \
+        resource["LogicalResourceId"].startswith(
+            gpwm.nesting.NESTED_STACK_PREFIX
+        ) and bool(resource.get("PhysicalResourceId"))
+
+
+def list_nested_stacks(stack_name):
+    """ Returns the IDs of the nested stacks gpwm split a stack into
+    """
+    return [
+        r["PhysicalResourceId"] for r in list_stack_resources(stack_name)
+        if is_nested_stack(r)
+    ]
+
+
+def fetch_cf_stack_resources(stack_name):
+    """ Fetches the physical IDs of all resources of a Cloudformation stack
+
+    Resources of the nested stacks gpwm split the stack into are included,
+    as if they were resources of the stack itself.
+
+    Returns: A dict mapping logical to physical resource IDs
+    """
+    resources = {}
+    for resource in list_stack_resources(stack_name):
+        if is_nested_stack(resource):
+            resources.update(
+                fetch_cf_stack_resources(resource["PhysicalResourceId"])
+            )
+        resources[resource["LogicalResourceId"]] = \
+            resource.get("PhysicalResourceId", "")
+    return resources
+
+
+def fetch_gcp_deployment_outputs(stack_name, project):
+    """ Fetches all outputs of a GCP deployment
+
+    The outputs live in the layout of the deployment's manifest, which is
+    parsed once here rather than on every output lookup.
+
+    Returns: An index of the outputs: {"outputs": {name: final value}}
+    """
+    gcp_api = get_gcp_api()
+    deployment = gcp_api.deployments().get(
+        project=project,
+        deployment=stack_name
+    ).execute()
+    manifest = gcp_api.manifests().get(
+        project=project,
+        deployment=stack_name,
+        manifest=deployment["manifest"].split("/")[-1]
+        ).execute()
+    layout = yaml.load(manifest.get("layout") or "{}", Loader=YAML_SAFE_LOADER)
+    return {
+        "outputs": {
+            o["name"]: o.get("finalValue") for o in layout.get("outputs", [])
+        }
+    }
 
 
 def get_stack_output(
@@ -133,52 +956,278 @@ def get_stack_output(
         output_key,
         provider="cloudformation",
         **kwargs):
+    prefix = get_stack_cache_prefix(stack_name, provider, **kwargs)
     if provider == "cloudformation":
-        # caching results of calls to clouformation API
-        if not STACK_CACHE.get(stack_name):
-            STACK_CACHE[stack_name] = BOTO_CF_RESOURCE.Stack(stack_name)
-
-        for output in STACK_CACHE[stack_name].outputs:
-            if output["OutputKey"] == output_key:
-                return output["OutputValue"]
+        def fetch():
+            return fetch_cf_stack_outputs(stack_name)
     elif provider == "gcp":
-        if not STACK_CACHE.get(stack_name):
-            deployment = GCP_API.deployments().get(
-                project=kwargs["project"],
-                deployment=stack_name
-            ).execute()
-            manifest = GCP_API.manifests().get(
-                project=kwargs["project"],
-                deployment=stack_name,
-                manifest=deployment["manifest"].split("/")[-1]
-                ).execute()
-            STACK_CACHE[stack_name] = {
-                "deployment": deployment,
-                "manifest": manifest
-            }
-        layout = yaml.load(STACK_CACHE[stack_name]["manifest"]["layout"])
-        for output in layout.get("outputs", []):
-            if output["name"] == output_key:
-                return output["finalValue"]
-    return ""
+        def fetch():
+            return fetch_gcp_deployment_outputs(stack_name, kwargs["project"])
+    value = get_stack_data(
+        prefix + "output_index",
+        fetch,
+        lambda index: index["outputs"].get(output_key),
+        output_key
+    )
+    return "" if value is None else value
+
+
+def get_exports_cache_key():
+    """ Returns the cache key of the Cloudformation exports of the region
+
+    Stack names can't be empty, so the key can't clash with stack data.
+    """
+    return gpwm.cache.stack_cache_key(
+        "cloudformation",
+        get_boto_client("cloudformation").meta.region_name,
+        get_aws_account_id(),
+        "",
+        "exports"
+    )
+
+
+def get_export_value(export_name):
+    """ Returns the value of a Cloudformation export
+
+    Works like Fn::ImportValue, but the value is resolved when the stack is
+    rendered, from an index of all exports of the region fetched once.
+    """
+    value = get_stack_data(
+        get_exports_cache_key(),
+        fetch_cf_exports,
+        lambda exports: exports.get(export_name),
+        export_name
+    )
+    if value is None:
+        raise SystemExit("Export {} not found".format(export_name))
+    return value
 
 
 def get_stack_resource(stack_name, resource_id):
-    # caching results of calls to clouformation API
-    if not CF_STACK_RESOURCE_CACHE.get(stack_name):
-        CF_STACK_RESOURCE_CACHE[stack_name] = {}
-    if not CF_STACK_RESOURCE_CACHE[stack_name].get(resource_id):
-        CF_STACK_RESOURCE_CACHE[stack_name][resource_id] = \
-            BOTO_CF_RESOURCE.StackResource(stack_name, resource_id)
-    return CF_STACK_RESOURCE_CACHE[stack_name][resource_id].physical_resource_id # noqa
-
-
-def call_aws(service, action, arguments={}, result_filter=None):
-    client = boto3.client(service)
-    result = getattr(client, action)(**arguments)
+    value = get_stack_data(
+        get_stack_cache_prefix(stack_name) + "resources",
+        lambda: fetch_cf_stack_resources(stack_name),
+        lambda resources: resources.get(resource_id),
+        resource_id
+    )
+    if value is None:
+        raise SystemExit("Resource {} not found in stack {}".format(
+            resource_id,
+            stack_name
+        ))
+    return value
+
+
+def get_jmespath_expression(expression):
+    """ Returns a compiled (and cached) jmespath expression
+    """
+    compiled = JMESPATH_EXPRESSIONS.get(expression)
+    if compiled is None:
+        compiled = jmespath.compile(expression)
+        JMESPATH_EXPRESSIONS[expression] = compiled
+    return compiled
+
+
+def is_read_only_action(action):
+    """ Tells if an AWS action can't change anything, so it can be memoized
+    """
+    return action.startswith(READ_ONLY_ACTION_PREFIXES)
+
+
+def log_call_aws_stats():
+    """ Logs the hit/miss statistics of call_aws() memoization
+    """
+    logging.debug(
+        "call_aws memoization: %(hits)d hits, %(misses)d misses, "
+        "%(uncacheable)d uncacheable calls",
+        CALL_AWS_STATS
+    )
+
+
+def memoize_aws_call(key, fetch):
+    """ Returns the memoized result for key, calling fetch on a miss
+
+    Callers get a copy of the result: templates are free to modify what they
+    get back, which must not change the memoized result.
+    """
+    with CALL_AWS_CACHE_LOCK:
+        result = CALL_AWS_CACHE.get(key)
+        CALL_AWS_STATS["misses" if result is None else "hits"] += 1
+    if result is None:
+        logging.debug("call_aws cache miss: %s.%s", key[0], key[1])
+        result = fetch()
+        with CALL_AWS_CACHE_LOCK:
+            CALL_AWS_CACHE[key] = result
+    else:
+        logging.debug("call_aws cache hit: %s.%s", key[0], key[1])
+    return copy.deepcopy(result)
+
+
+def paginate_aws(
+        service,
+        action,
+        arguments={},
+        result_filter=None,
+        region=None,
+        profile=None,
+        pagination_config=None):
+    """ Calls a paginated AWS API action, streaming the results
+
+    Pages are fetched as the generator is consumed, and the result filter
+    is applied to each page, so only the filtered results are kept in
+    memory. Templates needing only the first matches can stop consuming the
+    generator early (or set MaxItems in pagination_config).
+
+    Args:
+        pagination_config(dict): botocore's PaginationConfig, eg
+            {"MaxItems": 10, "PageSize": 100}
+        All other arguments are the same as call_aws()
+
+    Yields: Each element of the filtered page if the filtered page is a
+        list, otherwise the filtered page itself (None is skipped)
+    """
+    client = get_boto_client(service, region=region, profile=profile)
+    paginator = client.get_paginator(action)
+    pages = paginator.paginate(
+        PaginationConfig=pagination_config or {},
+        **arguments
+    )
+    for page in pages:
+        if result_filter is not None:
+            page = get_jmespath_expression(result_filter).search(page)
+        if isinstance(page, list):
+            for item in page:
+                yield item
+        elif page is not None:
+            yield page
+
+
+def call_aws(
+        service,
+        action,
+        arguments={},
+        result_filter=None,
+        region=None,
+        profile=None,
+        paginate=False,
+        pagination_config=None):
+    """ Calls any AWS API action
+
+    Results of read-only actions (describe_*, get_*, list_*) are memoized
+    for the run, so identical calls made by templates only hit the API once.
+
+    Args:
+        service(str): The AWS service, eg "ec2"
+        action(str): The boto3 client method, eg "describe_vpcs"
+        arguments(dict): The action arguments
+        result_filter(str): A jmespath expression applied to the result
+        region(str): The AWS region. Defaults to the profile's region
+        profile(str): The AWS profile. Defaults to the default profile
+        paginate(bool): Fetches the pages of the result with a botocore
+            paginator as the result is iterated over (see paginate_aws()).
+            Pages aren't memoized, so they're never all kept in memory
+        pagination_config(dict): botocore's PaginationConfig, eg
+            {"MaxItems": 10}. Only used when paginate is set
+
+    Returns: The (filtered) result of the call, or an iterator over the
+        filtered results when paginate is set
+    """
+    if paginate:
+        return paginate_aws(
+            service,
+            action,
+            arguments,
+            result_filter=result_filter,
+            region=region,
+            profile=profile,
+            pagination_config=pagination_config
+        )
+
+    canonical_arguments = json.dumps(arguments, sort_keys=True, default=str)
+
+    def fetch():
+        client = get_boto_client(service, region=region, profile=profile)
+        return getattr(client, action)(**arguments)
+
+    if is_read_only_action(action):
+        key = (service, action, region, profile, canonical_arguments)
+        result = memoize_aws_call(key, fetch)
+    else:
+        with CALL_AWS_CACHE_LOCK:
+            CALL_AWS_STATS["uncacheable"] += 1
+        result = fetch()
+
     if result_filter is None:
         return result
-    return jmespath.search(result_filter, result)
+    return get_jmespath_expression(result_filter).search(result)
+
+
+def fetch_http_template(url):
+    """ Fetches a template over http(s), revalidating the cached copy
+
+    Returns: The text of the template
+    """
+    key = urlunparse(url)
+    fetch_cache = gpwm.cache.get_fetch_cache()
+    cached = fetch_cache.get(key) if fetch_cache else None
+    headers = {}
+    if cached:
+        if cached[1].get("etag"):
+            headers["If-None-Match"] = cached[1]["etag"]
+        if cached[1].get("last_modified"):
+            headers["If-Modified-Since"] = cached[1]["last_modified"]
+    response = get_http_session().get(key, headers=headers)
+    if cached and response.status_code == 304:
+        logging.debug("Template not modified: %s", key)
+        return cached[0]
+    if fetch_cache and response.ok and (
+            response.headers.get("ETag") or
+            response.headers.get("Last-Modified")):
+        fetch_cache.set(key, response.text, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        })
+    return response.text
+
+
+def fetch_s3_template(url):
+    """ Fetches a template from S3, revalidating the cached copy
+
+    Versions of an object never change, so templates fetched by VersionId
+    are served from the cache without calling S3.
+
+    Returns: The text of the template
+    """
+    from botocore.exceptions import ClientError
+    key = urlunparse(url)
+    extra_args = {k: v[0] for k, v in parse_qs(url.query).items()}
+    fetch_cache = gpwm.cache.get_fetch_cache()
+    cached = fetch_cache.get(key) if fetch_cache else None
+    if cached and "VersionId" in extra_args:
+        return cached[0]
+    if cached:
+        if cached[1].get("etag"):
+            extra_args["IfNoneMatch"] = cached[1]["etag"]
+        elif cached[1].get("last_modified"):
+            extra_args["IfModifiedSince"] = cached[1]["last_modified"]
+    try:
+        obj = get_boto_client("s3").get_object(
+            Bucket=url.netloc,
+            Key=url.path[1:],
+            **extra_args
+        )
+    except ClientError as exc:
+        if cached and exc.response["Error"]["Code"] in ["304", "NotModified"]:
+            logging.debug("Template not modified: %s", key)
+            return cached[0]
+        raise
+    body = obj["Body"].read().decode("utf-8")
+    if fetch_cache:
+        fetch_cache.set(key, body, {
+            "etag": obj.get("ETag"),
+            "last_modified": obj.get("LastModified")
+        })
+    return body
 
 
 def get_template_body(url):
@@ -189,39 +1238,47 @@ def get_template_body(url):
 
     Returns: The text of the target URL
 
-    This function supports 3 different schemes:
+    This function supports 4 different schemes:
         - http/https
         - s3
+        - gs
         - path
+
+    http(s) and s3 templates are cached on disk (see gpwm.cache.FetchCache),
+    and only downloaded again when they change.
     """
-    if "http" in url.scheme:
-        return requests.get(urlunparse(url)).text
-    elif "s3" in url.scheme:
-        s3_client = boto3.client("s3")
-        extra_args = {k: v[0] for k, v in parse_qs(url.query).items()}
-        obj = s3_client.get_object(
-            Bucket=url.netloc,
-            Key=url.path[1:],
-            **extra_args
-        )
-        return obj["Body"].read()
-    return open(url.path).read()
+    with gpwm.metrics.phase("fetch", url=urlunparse(url)):
+        if "http" in url.scheme:
+            return fetch_http_template(url)
+        elif "s3" in url.scheme:
+            return fetch_s3_template(url)
+        elif url.scheme == "gs":
+            return get_gcp_api("storage", "v1").objects().get_media(
+                bucket=url.netloc,
+                object=url.path[1:]
+            ).execute().decode("utf-8")
+        with open(url.path) as f:
+            return f.read()
 
 
 def parse_mako(stack_name, template_body, parameters):
     """ Parses Mako templates
     """
-    # The default for strict_undefined is False. Change to True to
-    # troubleshoot pesky templates
-    mako_template = mako.template.Template(
-        template_body,
-        strict_undefined=False
+    mako_template = get_mako_template(template_body)
+    # the functions are added to a copy, so the parameters given (eg the
+    # stack attributes) are left untouched
+    parameters = dict(
+        parameters,
+        get_stack_output=get_stack_output,
+        get_stack_resource=get_stack_resource,
+        get_export_value=get_export_value,
+        call_aws=call_aws,
+        paginate_aws=paginate_aws
     )
-    parameters["get_stack_output"] = get_stack_output
-    parameters["get_stack_resource"] = get_stack_resource
-    parameters["call_aws"] = call_aws
     try:
-        template = yaml.load(mako_template.render(**parameters))
+        with gpwm.metrics.phase("render", engine="mako"):
+            rendered = mako_template.render(**parameters)
+        template = load_yaml(rendered)
     except Exception:
         raise SystemExit(
             mako.exceptions.text_error_template().render()
@@ -230,12 +1287,14 @@ def parse_mako(stack_name, template_body, parameters):
     # Automatically adds and merges outputs for every resource in the
     # template - outputs are automatically exported.
     # An existing output in the template will not be overriden by an
-    # automatic output.
+    # automatic output. Fn::ForEach loops aren't resources, so they get no
+    # output.
     outputs = {
         k: {
             "Value": {"Ref": k},
             "Export": {"Name": "{}-{}".format(stack_name, k)}
         } for k in template.get("Resources", {}).keys()
+        if not gpwm.validation.is_for_each(k)
     }
     outputs.update(template.get("Outputs", {}))
     template["Outputs"] = outputs
@@ -245,21 +1304,32 @@ def parse_mako(stack_name, template_body, parameters):
 def parse_jinja(stack_name, template_body, parameters):
     """ Parses Jinja templates
     """
-    jinja_template = jinja2.Template(template_body)
-    parameters["get_stack_output"] = get_stack_output
-    parameters["get_stack_resource"] = get_stack_resource
-    parameters["call_aws"] = call_aws
-    template = yaml.load(jinja_template.render(**parameters))
+    jinja_template = get_jinja_template(template_body)
+    # the functions are added to a copy, so the parameters given (eg the
+    # stack attributes) are left untouched
+    parameters = dict(
+        parameters,
+        get_stack_output=get_stack_output,
+        get_stack_resource=get_stack_resource,
+        get_export_value=get_export_value,
+        call_aws=call_aws,
+        paginate_aws=paginate_aws
+    )
+    with gpwm.metrics.phase("render", engine="jinja"):
+        rendered = jinja_template.render(**parameters)
+    template = load_yaml(rendered)
 
     # Automatically adds and merges outputs for every resource in the
     # template - outputs are automatically exported.
     # An existing output in the template will not be overriden by an
-    # automatic output.
+    # automatic output. Fn::ForEach loops aren't resources, so they get no
+    # output.
     outputs = {
         k: {
             "Value": {"Ref": k},
             "Export": {"Name": "{}-{}".format(stack_name, k)}}
         for k in template.get("Resources", {}).keys()
+        if not gpwm.validation.is_for_each(k)
     }
     outputs.update(template.get("Outputs", {}))
     template["Outputs"] = outputs
@@ -276,3 +1346,66 @@ def parse_yaml(stack_name, template_body, parameters):
     """ Parses YAML templates
     """
     raise SystemExit("yaml templates not yet supported")
+
+
+def get_templating_engine(path):
+    """ Figures out the templating engine from the stack file extension
+
+    Args:
+        path(str): The path to the stack file
+
+    Returns: "mako", "jinja", "yaml", or None if the extension is unknown
+    """
+    if ".mako" in path[-5:]:
+        return "mako"
+    elif ".jinja" in path[-6:]:
+        return "jinja"
+    elif ".yaml" in path[-5:]:
+        return "yaml"
+    return None
+
+
+def render_stack(stack_file, templating_engine, build_id):
+    """ Renders a stack file into the stack attributes
+
+    Args:
+        stack_file(str): The content of the stack file
+        templating_engine(str): "mako", "jinja" or "yaml"
+        build_id(str): The build ID
+
+    Returns: A dict with the stack attributes, ready to be fed to
+        gpwm.stacks.factory()
+    """
+    template_params = {
+        "build_id": build_id,
+        "call_aws": call_aws,
+        "paginate_aws": paginate_aws,
+        "get_stack_output": get_stack_output,
+        "get_stack_resource": get_stack_resource,
+        "get_export_value": get_export_value
+    }
+
+    # try rendering stack with mako first, if fails try jinja,
+    # so we get all the goodies on the stack level as well,
+    # not just the on the template
+
+    if templating_engine == "mako":
+        logging.debug("Trying to render mako input file...")
+        stack_template = get_mako_template(stack_file)
+        try:
+            with gpwm.metrics.phase("render", engine="mako"):
+                rendered_template = stack_template.render(**template_params)
+        # mako wraps the exception where the real information is, so we unwrap
+        # and display only the part that matters to the user
+        except Exception:
+            raise SystemExit(mako.exceptions.text_error_template().render())
+    elif templating_engine == "jinja":
+        stack_template = get_jinja_template(stack_file)
+        with gpwm.metrics.phase("render", engine="jinja"):
+            rendered_template = stack_template.render(**template_params)
+    else:
+        rendered_template = stack_file
+
+    stack_attributes = load_yaml(rendered_template)
+    stack_attributes["BuildId"] = build_id
+    return stack_attributes
@@ -0,0 +1,400 @@
+# Copyright 2017 Gustavo Baratto. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Offline validation of rendered Cloudformation templates
+
+Catches the mistakes templating usually introduces (broken references,
+malformed intrinsic functions, duplicate exports, etc) without a round-trip
+to Cloudformation's ValidateTemplate API.
+
+Templates with a Transform (eg SAM) are only valid once transformed by
+Cloudformation, so their sections, resources and references aren't checked.
+"""
+
+
+import re
+
+import six
+
+
+TEMPLATE_SECTIONS = [
+    "AWSTemplateFormatVersion",
+    "Conditions",
+    "Description",
+    "Hooks",
+    "Mappings",
+    "Metadata",
+    "Outputs",
+    "Parameters",
+    "Resources",
+    "Rules",
+    "Transform"
+]
+
+RESOURCE_ATTRIBUTES = [
+    "Condition",
+    "CreationPolicy",
+    "DeletionPolicy",
+    "DependsOn",
+    "Metadata",
+    "Properties",
+    "Type",
+    "UpdatePolicy",
+    "UpdateReplacePolicy"
+]
+
+PSEUDO_PARAMETERS = [
+    "AWS::AccountId",
+    "AWS::NotificationARNs",
+    "AWS::NoValue",
+    "AWS::Partition",
+    "AWS::Region",
+    "AWS::StackId",
+    "AWS::StackName",
+    "AWS::URLSuffix"
+]
+
+# Cloudformation limits
+MAX_TEMPLATE_BODY_SIZE = 51200
+MAX_TEMPLATE_URL_SIZE = 1048576
+MAX_RESOURCES = 500
+MAX_OUTPUTS = 200
+MAX_PARAMETERS = 200
+MAX_MAPPINGS = 200
+
+# Prefix of the loops of the AWS::LanguageExtensions transform, which can
+# take the place of resources, outputs and conditions
+FOR_EACH_PREFIX = "Fn::ForEach::"
+
+LOGICAL_ID_REGEX = re.compile(r"^[A-Za-z0-9]{1,255}$")
+SUB_VARIABLE_REGEX = re.compile(r"\$\{([^!][^}]*)\}")
+
+
+def is_for_each(name):
+    """ Tells if a template key is a Fn::ForEach loop
+    """
+    return isinstance(name, six.string_types) and \
+        name.startswith(FOR_EACH_PREFIX)
+
+
+class TemplateValidator(object):
+    """ Validates a rendered Cloudformation template
+
+    Usage:
+        errors = TemplateValidator(template).validate()
+    """
+    def __init__(self, template, template_body_size=None, inline=True):
+        """
+        Args:
+            template(dict): The rendered template
+            template_body_size(int): The size in bytes of the serialized
+                template
+            inline(bool): If the template is sent inline to the API, as
+                opposed to uploaded to S3
+        """
+        self.template = template
+        self.transformed = isinstance(template, dict) and \
+            "Transform" in template
+        self.template_body_size = template_body_size
+        self.inline = inline
+        self.errors = []
+
+    def error(self, path, message):
+        self.errors.append("{}: {}".format(path, message))
+
+    def section(self, name):
+        section = self.template.get(name, {})
+        if not isinstance(section, dict):
+            self.error(name, "must be a mapping")
+            return {}
+        return section
+
+    def validate(self):
+        """ Runs all checks
+
+        Returns: A list of error messages. Empty if the template is valid
+        """
+        if not isinstance(self.template, dict):
+            return ["Template: must be a mapping"]
+
+        for name in self.template:
+            if name not in TEMPLATE_SECTIONS and not self.transformed:
+                self.error(name, "unknown template section")
+
+        self.parameters = self.section("Parameters")
+        self.mappings = self.section("Mappings")
+        self.conditions = self.section("Conditions")
+        self.resources = self.section("Resources")
+        self.outputs = self.section("Outputs")
+
+        self.validate_limits()
+        self.validate_parameters()
+        self.validate_conditions()
+        self.validate_resources()
+        self.validate_outputs()
+        return self.errors
+
+    def validate_limits(self):
+        if self.inline and self.template_body_size and \
+                self.template_body_size > MAX_TEMPLATE_BODY_SIZE:
+            self.error("Template", "body is {} bytes, larger than the {} "
+                       "bytes allowed inline. Use a template "
+                       "bucket".format(
+                           self.template_body_size,
+                           MAX_TEMPLATE_BODY_SIZE
+                       ))
+        elif self.template_body_size and \
+                self.template_body_size > MAX_TEMPLATE_URL_SIZE:
+            self.error("Template", "body is {} bytes, larger than the {} "
+                       "bytes allowed".format(
+                           self.template_body_size,
+                           MAX_TEMPLATE_URL_SIZE
+                       ))
+        for name, maximum in [
+                ("Resources", MAX_RESOURCES),
+                ("Outputs", MAX_OUTPUTS),
+                ("Parameters", MAX_PARAMETERS),
+                ("Mappings", MAX_MAPPINGS)]:
+            if len(self.section(name)) > maximum:
+                self.error(name, "{} entries, more than the maximum of "
+                           "{}".format(len(self.section(name)), maximum))
+
+    def validate_logical_id(self, path, logical_id):
+        if is_for_each(logical_id):
+            return
+        if not isinstance(logical_id, six.string_types) or \
+                not LOGICAL_ID_REGEX.match(logical_id):
+            self.error(path, "logical ID must be alphanumeric")
+
+    def validate_parameters(self):
+        for name, parameter in self.parameters.items():
+            path = "Parameters.{}".format(name)
+            self.validate_logical_id(path, name)
+            if not isinstance(parameter, dict) or "Type" not in parameter:
+                self.error(path, "must be a mapping with a Type")
+
+    def validate_conditions(self):
+        for name, condition in self.conditions.items():
+            path = "Conditions.{}".format(name)
+            self.validate_logical_id(path, name)
+            self.validate_value(path, condition, in_conditions=True)
+
+    def validate_resources(self):
+        if not self.resources:
+            self.error("Resources", "at least one resource is required")
+        for name, resource in self.resources.items():
+            path = "Resources.{}".format(name)
+            self.validate_logical_id(path, name)
+            if is_for_each(name):
+                self.validate_value(path, resource)
+                continue
+            if not isinstance(resource, dict):
+                self.error(path, "must be a mapping")
+                continue
+            if not isinstance(resource.get("Type"), six.string_types):
+                self.error(path, "Type is required")
+            for attribute in resource:
+                if attribute not in RESOURCE_ATTRIBUTES and \
+                        not self.transformed:
+                    self.error(path, "unknown resource attribute {}".format(
+                        attribute
+                    ))
+            depends_on = resource.get("DependsOn", [])
+            if isinstance(depends_on, six.string_types):
+                depends_on = [depends_on]
+            if not isinstance(depends_on, list):
+                self.error(path, "DependsOn must be a string or a list")
+                depends_on = []
+            for dependency in depends_on:
+                if not isinstance(dependency, six.string_types):
+                    self.error(path, "DependsOn must list resource names")
+                elif (dependency not in self.resources or
+                        is_for_each(dependency)) and not self.transformed:
+                    self.error(path, "DependsOn unknown resource {}".format(
+                        dependency
+                    ))
+            if "Condition" in resource:
+                self.validate_condition_name(path, resource["Condition"])
+            self.validate_value(path, resource.get("Properties", {}))
+
+    def validate_outputs(self):
+        exports = {}
+        for name, output in self.outputs.items():
+            path = "Outputs.{}".format(name)
+            self.validate_logical_id(path, name)
+            if is_for_each(name):
+                self.validate_value(path, output)
+                continue
+            if not isinstance(output, dict) or "Value" not in output:
+                self.error(path, "must be a mapping with a Value")
+                continue
+            if "Condition" in output:
+                self.validate_condition_name(path, output["Condition"])
+            self.validate_value(path, output)
+            export_name = output.get("Export", {}).get("Name")
+            if isinstance(export_name, six.string_types):
+                if export_name in exports:
+                    self.error(path, "export name {} already used by "
+                               "Outputs.{}".format(
+                                   export_name,
+                                   exports[export_name]
+                               ))
+                exports[export_name] = name
+
+    def validate_condition_name(self, path, name):
+        """ Checks a reference to a condition
+        """
+        if not isinstance(name, six.string_types):
+            self.error(path, "condition must be a string")
+        elif name not in self.conditions or is_for_each(name):
+            self.error(path, "unknown condition {}".format(name))
+
+    def validate_value(self, path, value, in_conditions=False):
+        """ Walks a value checking all intrinsic functions found
+        """
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                self.validate_value(
+                    "{}[{}]".format(path, i),
+                    item,
+                    in_conditions
+                )
+        elif isinstance(value, dict):
+            if len(value) == 1:
+                function, arguments = list(value.items())[0]
+                if isinstance(function, six.string_types) and (
+                        function == "Ref" or function.startswith("Fn::") or
+                        (in_conditions and function == "Condition")):
+                    self.validate_function(
+                        "{}.{}".format(path, function),
+                        function,
+                        arguments
+                    )
+                    self.validate_value(path, arguments, in_conditions)
+                    return
+            for k, v in value.items():
+                self.validate_value(
+                    "{}.{}".format(path, k),
+                    v,
+                    in_conditions
+                )
+
+    def validate_function(self, path, function, arguments):
+        """ Checks the shape and targets of an intrinsic function
+
+        Transforms add resources and parameters, so the targets aren't
+        checked in transformed templates.
+        """
+        def is_list(minimum, maximum=None):
+            maximum = maximum or minimum
+            if not isinstance(arguments, list) or \
+                    not minimum <= len(arguments) <= maximum:
+                if minimum == maximum:
+                    expected = "a list of {} elements".format(minimum)
+                else:
+                    expected = "a list of {} to {} elements".format(
+                        minimum,
+                        maximum
+                    )
+                self.error(path, "arguments must be {}".format(expected))
+                return False
+            return True
+
+        if function == "Ref":
+            # loops aren't resources, not even in transformed templates
+            if is_for_each(arguments):
+                self.error(path, "can't reference the Fn::ForEach loop "
+                           "{}".format(arguments))
+                return
+            # eg AWS::LanguageExtensions resolves functions inside Ref
+            if self.transformed:
+                return
+            if not isinstance(arguments, six.string_types):
+                self.error(path, "argument must be a string")
+            elif arguments not in self.parameters and \
+                    arguments not in self.resources and \
+                    arguments not in PSEUDO_PARAMETERS:
+                self.error(path, "unknown parameter or resource {}".format(
+                    arguments
+                ))
+        elif function == "Fn::GetAtt":
+            if isinstance(arguments, six.string_types):
+                arguments = arguments.split(".", 1)
+            if not is_list(2):
+                return
+            if is_for_each(arguments[0]):
+                self.error(path, "can't reference the Fn::ForEach loop "
+                           "{}".format(arguments[0]))
+            elif isinstance(arguments[0], six.string_types) \
+                    and arguments[0] not in self.resources \
+                    and not self.transformed:
+                self.error(path, "unknown resource {}".format(arguments[0]))
+        elif function == "Fn::Sub":
+            variables = {}
+            if isinstance(arguments, list):
+                if not is_list(2):
+                    return
+                arguments, variables = arguments
+                if not isinstance(variables, dict):
+                    self.error(path, "variables must be a mapping")
+                    variables = {}
+            if not isinstance(arguments, six.string_types):
+                self.error(path, "string must be a string")
+                return
+            for variable in SUB_VARIABLE_REGEX.findall(arguments):
+                name = variable.split(".", 1)[0]
+                if not self.transformed and \
+                        name not in variables and \
+                        name not in self.parameters and \
+                        name not in self.resources and \
+                        variable not in PSEUDO_PARAMETERS:
+                    self.error(path, "unknown variable {}".format(variable))
+        elif function == "Fn::If":
+            if is_list(3):
+                self.validate_condition_name(path, arguments[0])
+        elif function == "Condition":
+            self.validate_condition_name(path, arguments)
+        elif function == "Fn::FindInMap":
+            if is_list(3) and isinstance(arguments[0], six.string_types) \
+                    and arguments[0] not in self.mappings:
+                self.error(path, "unknown mapping {}".format(arguments[0]))
+        elif function in ["Fn::Join", "Fn::Select", "Fn::Split",
+                          "Fn::Equals"]:
+            is_list(2)
+        elif function in ["Fn::And", "Fn::Or"]:
+            is_list(2, 10)
+        elif function == "Fn::Not":
+            is_list(1)
+        elif function == "Fn::Cidr":
+            is_list(3)
+
+
+def validate_template(template, template_body_size=None, inline=True):
+    """ Validates a rendered Cloudformation template
+
+    Args:
+        template(dict): The rendered template
+        template_body_size(int): The size in bytes of the serialized
+            template
+        inline(bool): If the template is sent inline to the API, as
+            opposed to uploaded to S3
+
+    Returns: A list of error messages. Empty if the template is valid
+    """
+    return TemplateValidator(
+        template,
+        template_body_size,
+        inline
+    ).validate()
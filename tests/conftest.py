@@ -0,0 +1,12 @@
+import pytest
+
+import gpwm.cache
+import gpwm.utils
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """ Keeps the on-disk caches of the tests away from the user's
+    """
+    monkeypatch.setattr(gpwm.utils, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(gpwm.cache, "CACHE_BACKEND", "memory")
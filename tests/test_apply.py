@@ -0,0 +1,177 @@
+import pytest
+
+import gpwm.apply
+
+
+def stack_file(path, reference=None, dependencies=(), exports=()):
+    stack = gpwm.apply.StackFile(path)
+    stack.reference = reference
+    stack.dependencies = set(dependencies)
+    stack.exports = set(exports)
+    return stack
+
+
+def paths(waves):
+    return [[s.path for s in wave] for wave in waves]
+
+
+def test_build_waves_orders_dependencies():
+    vpc = stack_file("vpc.mako", ("cloudformation", "vpc"))
+    subnet = stack_file(
+        "subnet.mako",
+        ("cloudformation", "subnet"),
+        [("cloudformation", "vpc")]
+    )
+    app = stack_file(
+        "app.mako",
+        ("cloudformation", "app"),
+        [("cloudformation", "subnet"), ("cloudformation", "vpc")]
+    )
+    other = stack_file("other.mako", ("cloudformation", "other"))
+
+    waves = gpwm.apply.build_waves([app, subnet, other, vpc])
+
+    assert paths(waves) == [
+        ["other.mako", "vpc.mako"],
+        ["subnet.mako"],
+        ["app.mako"]
+    ]
+    assert app.upstream == {subnet, vpc}
+
+
+def test_build_waves_ignores_stacks_outside_the_execution():
+    app = stack_file(
+        "app.mako",
+        ("cloudformation", "app"),
+        [("cloudformation", "existing"), ("export", "existing-VPC")]
+    )
+    assert paths(gpwm.apply.build_waves([app])) == [["app.mako"]]
+    assert app.upstream == set()
+
+
+def test_build_waves_orders_importers_after_exporters():
+    vpc = stack_file(
+        "vpc.mako",
+        ("cloudformation", "vpc"),
+        exports=["vpc-VPC"]
+    )
+    app = stack_file(
+        "app.mako",
+        ("cloudformation", "app"),
+        [("export", "vpc-VPC")]
+    )
+    waves = gpwm.apply.build_waves([app, vpc])
+    assert paths(waves) == [["vpc.mako"], ["app.mako"]]
+    assert app.upstream == {vpc}
+
+
+def test_build_waves_detects_cycles():
+    a = stack_file(
+        "a.mako",
+        ("cloudformation", "a"),
+        [("cloudformation", "b")]
+    )
+    b = stack_file("b.mako", ("cloudformation", "b"), [("export", "a-X")])
+    a.exports = {"a-X"}
+    c = stack_file("c.mako", ("cloudformation", "c"))
+    with pytest.raises(SystemExit) as exc:
+        gpwm.apply.build_waves([a, b, c])
+    assert "Circular dependency between stacks: a.mako, b.mako" in \
+        str(exc.value)
+
+
+def test_build_waves_rejects_duplicates():
+    with pytest.raises(SystemExit):
+        gpwm.apply.build_waves([
+            stack_file("a.mako", ("cloudformation", "a")),
+            stack_file("b.mako", ("cloudformation", "a"))
+        ])
+    with pytest.raises(SystemExit):
+        gpwm.apply.build_waves([
+            stack_file("a.mako", ("cloudformation", "a"), exports=["X"]),
+            stack_file("b.mako", ("cloudformation", "b"), exports=["X"])
+        ])
+
+
+def test_discover_dependencies(tmp_path):
+    (tmp_path / "vpc.mako").write_text(
+        "StackName: vpc\n"
+        "TemplateBody:\n"
+        "  Resources:\n"
+        "    VPC: {Type: 'AWS::EC2::VPC'}\n"
+        "  Outputs:\n"
+        "    VPC:\n"
+        "      Value: {Ref: VPC}\n"
+        "      Export: {Name: vpc-VPC}\n"
+    )
+    (tmp_path / "app.mako").write_text(
+        "StackName: app\n"
+        "TemplateBody:\n"
+        "  Resources:\n"
+        "    Subnet:\n"
+        "      Type: 'AWS::EC2::Subnet'\n"
+        "      Properties:\n"
+        "        VpcId: !Cloudformation {export: vpc-VPC}\n"
+        "        CidrBlock: !Cloudformation {stack: net, output: Cidr}\n"
+    )
+    stack_files = [
+        gpwm.apply.StackFile(p)
+        for p in gpwm.apply.find_stack_files([str(tmp_path)])
+    ]
+    app, vpc = stack_files
+
+    gpwm.apply.discover_dependencies(stack_files, "1")
+
+    assert vpc.reference == ("cloudformation", "vpc")
+    assert vpc.exports == {"vpc-VPC"}
+    assert app.dependencies == {
+        ("export", "vpc-VPC"),
+        ("cloudformation", "net")
+    }
+    # the references of app were rendered as blanks, so only vpc's render
+    # can be reused for the execution
+    assert vpc.stack is not None
+    assert app.stack is None
+    assert paths(gpwm.apply.build_waves(stack_files)) == [
+        [vpc.path],
+        [app.path]
+    ]
+
+
+def test_discover_dependencies_of_imports(tmp_path):
+    (tmp_path / "vpc.mako").write_text(
+        "StackName: vpc\n"
+        "TemplateBody:\n"
+        "  Resources:\n"
+        "    VPC: {Type: 'AWS::EC2::VPC'}\n"
+        "  Outputs:\n"
+        "    VPC:\n"
+        "      Value: {Ref: VPC}\n"
+        "      Export: {Name: vpc-VPC}\n"
+    )
+    (tmp_path / "app.mako").write_text(
+        "StackName: app\n"
+        "TemplateBody:\n"
+        "  Resources:\n"
+        "    Subnet:\n"
+        "      Type: 'AWS::EC2::Subnet'\n"
+        "      Properties:\n"
+        "        VpcId: {'Fn::ImportValue': vpc-VPC}\n"
+        "        CidrBlock:\n"
+        "          'Fn::ImportValue': {'Fn::Join': ['-', [net, Cidr]]}\n"
+    )
+    stack_files = [
+        gpwm.apply.StackFile(p)
+        for p in gpwm.apply.find_stack_files([str(tmp_path)])
+    ]
+    app, vpc = stack_files
+
+    gpwm.apply.discover_dependencies(stack_files, "1")
+
+    assert app.dependencies == {("export", "vpc-VPC")}
+    # imports are left to Cloudformation, so the render can be reused
+    assert app.stack is not None
+    assert paths(gpwm.apply.build_waves(stack_files)) == [
+        [vpc.path],
+        [app.path]
+    ]
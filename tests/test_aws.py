@@ -0,0 +1,209 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import gpwm.stacks.aws
+import gpwm.utils
+
+
+class Cloudformation(object):
+    def __init__(self, stacks=None, events=None):
+        self.stacks = stacks or {}
+        # what describe_stack_events returns at every poll, newest first
+        self.events = events or [[]]
+        self.polls = 0
+
+    def describe_stacks(self, StackName):
+        return {"Stacks": [self.stacks[StackName]]}
+
+    def describe_stack_events(self, StackName):
+        return {"StackEvents": self.events[0]}
+
+    def get_paginator(self, action):
+        return self
+
+    def paginate(self, StackName):
+        self.polls += 1
+        events = self.events[min(self.polls, len(self.events) - 1)]
+        # two events per page
+        for i in range(0, len(events), 2):
+            yield {"StackEvents": events[i:i + 2]}
+
+
+class S3(object):
+    def __init__(self, location="us-west-2"):
+        self.objects = {}
+        self.location = location
+        self.location_calls = 0
+
+    def get_bucket_location(self, Bucket):
+        self.location_calls += 1
+        return {"LocationConstraint": self.location}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def event(n, resource, status, stack=False):
+    return {
+        "EventId": "event-{}".format(n),
+        "StackId": "stack-id",
+        "PhysicalResourceId": "stack-id" if stack else resource,
+        "LogicalResourceId": resource,
+        "ResourceStatus": status,
+        "Timestamp": n
+    }
+
+
+def cloudformation_stack():
+    return gpwm.stacks.aws.CloudformationStack(
+        StackName="app",
+        TemplateBody={"Resources": {"Bucket": {"Type": "AWS::S3::Bucket"}}},
+        BuildId="1",
+        TemplateBucket=""
+    )
+
+
+@pytest.mark.parametrize("status, unchanged", [
+    ("CREATE_COMPLETE", True),
+    ("UPDATE_COMPLETE", True),
+    ("ROLLBACK_COMPLETE", False),
+    ("UPDATE_ROLLBACK_COMPLETE", False),
+    ("CREATE_FAILED", False),
+    ("UPDATE_IN_PROGRESS", False)
+])
+def test_is_unchanged(monkeypatch, status, unchanged):
+    stack = cloudformation_stack()
+    client = Cloudformation({"app": {
+        "StackName": "app",
+        "StackStatus": status,
+        "Tags": stack.Tags
+    }})
+    monkeypatch.setattr(gpwm.stacks.aws, "get_cf_client", lambda: client)
+    assert stack.is_unchanged() is unchanged
+
+
+def test_is_unchanged_compares_content(monkeypatch):
+    stack = cloudformation_stack()
+    client = Cloudformation({"app": {
+        "StackName": "app",
+        "StackStatus": "UPDATE_COMPLETE",
+        "Tags": [{"Key": gpwm.stacks.aws.CONTENT_HASH_TAG, "Value": "x"}]
+    }})
+    monkeypatch.setattr(gpwm.stacks.aws, "get_cf_client", lambda: client)
+    assert not stack.is_unchanged()
+
+
+def test_validate(monkeypatch):
+    stack = gpwm.stacks.aws.CloudformationStack(
+        StackName="app",
+        TemplateBody={"Resources": {"Bucket": {
+            "Type": "AWS::S3::Bucket",
+            "Properties": {"BucketName": {"Ref": "Name"}}
+        }}},
+        BuildId="1",
+        TemplateBucket=""
+    )
+    monkeypatch.setattr(gpwm.stacks.aws, "REMOTE_VALIDATION", False)
+    with pytest.raises(SystemExit) as exc:
+        stack.validate()
+    assert "unknown parameter or resource Name" in str(exc.value)
+    monkeypatch.setattr(gpwm.stacks.aws, "LOCAL_VALIDATION", False)
+    stack.validate()
+
+
+def test_template_url(monkeypatch):
+    s3 = S3(location=None)
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    monkeypatch.setattr(
+        gpwm.utils,
+        "get_boto_client",
+        lambda service, region=None: s3
+    )
+    stacks = [
+        gpwm.stacks.aws.CloudformationStack(
+            StackName=name,
+            TemplateBody={"Resources": {"Bucket": {
+                "Type": "AWS::S3::Bucket"
+            }}},
+            BuildId="1",
+            TemplateBucket="templates/gpwm/"
+        )
+        for name in ["app", "other-app"]
+    ]
+    arguments = [stack.api_arguments() for stack in stacks]
+    assert "TemplateBody" not in arguments[0]
+    assert arguments[0]["TemplateURL"] == arguments[1]["TemplateURL"]
+    assert arguments[0]["TemplateURL"].startswith(
+        "https://s3.us-east-1.amazonaws.com/templates/gpwm/"
+    )
+    # identical templates are uploaded only once
+    assert list(s3.objects.values()) == [stacks[0].TemplateBody]
+    assert s3.location_calls == 1
+
+
+def test_template_url_of_dotted_bucket(monkeypatch):
+    s3 = S3(location="eu-central-1")
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    monkeypatch.setattr(
+        gpwm.utils,
+        "get_boto_client",
+        lambda service, region=None: s3
+    )
+    bucket, key, url = gpwm.stacks.aws.get_template_location(
+        "templates.example.com/gpwm/stacks",
+        "Resources: {}"
+    )
+    assert bucket == "templates.example.com"
+    assert key.startswith("gpwm/stacks/")
+    assert url == "https://s3.eu-central-1.amazonaws.com/" \
+        "templates.example.com/" + key
+
+
+def test_stack_event_waiter(monkeypatch, capsys):
+    old = [event(1, "app", "CREATE_COMPLETE", stack=True)]
+    started = [event(2, "app", "UPDATE_IN_PROGRESS", stack=True)] + old
+    bucket = [
+        event(4, "Bucket", "UPDATE_COMPLETE"),
+        event(3, "Bucket", "UPDATE_IN_PROGRESS")
+    ] + started
+    done = [event(5, "app", "UPDATE_COMPLETE", stack=True)] + bucket
+    client = Cloudformation(events=[old, started, started, bucket, done])
+    monkeypatch.setattr(gpwm.stacks.aws, "get_cf_client", lambda: client)
+    delays = []
+    monkeypatch.setattr(gpwm.utils, "sleep_with_jitter", delays.append)
+
+    gpwm.stacks.aws.StackEventWaiter("app").wait("UPDATE_COMPLETE")
+
+    # only the events of this operation, oldest first
+    assert capsys.readouterr().out.splitlines() == [
+        "2 app app UPDATE_IN_PROGRESS",
+        "3 app Bucket UPDATE_IN_PROGRESS",
+        "4 app Bucket UPDATE_COMPLETE",
+        "5 app app UPDATE_COMPLETE"
+    ]
+    # backs off while nothing happens
+    minimum = gpwm.stacks.aws.WAITER_MIN_DELAY
+    assert delays == [
+        minimum,
+        minimum * gpwm.stacks.aws.WAITER_BACKOFF,
+        minimum
+    ]
+
+
+def test_stack_event_waiter_failures(monkeypatch, capsys):
+    old = [event(1, "app", "CREATE_COMPLETE", stack=True)]
+    failed = [
+        event(3, "app", "UPDATE_ROLLBACK_COMPLETE", stack=True),
+        event(2, "Bucket", "UPDATE_FAILED")
+    ] + old
+    client = Cloudformation(events=[old, failed])
+    monkeypatch.setattr(gpwm.stacks.aws, "get_cf_client", lambda: client)
+    monkeypatch.setattr(gpwm.utils, "sleep_with_jitter", lambda delay: None)
+    with pytest.raises(SystemExit) as exc:
+        gpwm.stacks.aws.StackEventWaiter("app").wait("UPDATE_COMPLETE")
+    assert str(exc.value) == "Stack app failed: UPDATE_ROLLBACK_COMPLETE"
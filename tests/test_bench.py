@@ -0,0 +1,21 @@
+import boto3.session
+
+import gpwm.bench
+import gpwm.utils
+
+
+def test_run_offline(monkeypatch):
+    def session(*args, **kwargs):
+        raise AssertionError("real provider client created")
+    monkeypatch.setattr(boto3.session, "Session", session)
+    # eg a fresh process, where no client was created yet
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS_SETTINGS", None)
+
+    results = gpwm.bench.run(["cloudformation-mako"], [5], iterations=1)
+
+    result, = results["results"]
+    assert result["case"] == "cloudformation-mako"
+    assert result["api_calls"]["cloudformation.describe_stacks"] == 1
+    assert gpwm.utils.PROVIDER_CLIENTS == {}
+    assert gpwm.utils.PROVIDER_CLIENTS_SETTINGS is None
@@ -0,0 +1,78 @@
+import os
+
+import gpwm.cache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_cache_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gpwm.cache.time, "time", clock)
+    cache = gpwm.cache.MemoryCache(ttl=10)
+    cache.set("cloudformation:vpc:outputs", {"VpcId": "vpc-1"})
+    clock.now += 10
+    assert cache.get("cloudformation:vpc:outputs") == {"VpcId": "vpc-1"}
+    clock.now += 1
+    assert cache.get("cloudformation:vpc:outputs") is None
+
+
+def test_sqlite_cache(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gpwm.cache.time, "time", clock)
+    path = str(tmp_path / "stacks.sqlite")
+    cache = gpwm.cache.SqliteCache(path, ttl=10)
+    cache.set("cloudformation:vpc:outputs", {"VpcId": "vpc-1"})
+    cache.set("cloudformation:vpc2:outputs", {"VpcId": "vpc-2"})
+    # eg another gpwm process
+    other = gpwm.cache.SqliteCache(path, ttl=10)
+    assert other.get("cloudformation:vpc:outputs") == {"VpcId": "vpc-1"}
+    other.invalidate("cloudformation:vpc:")
+    assert cache.get("cloudformation:vpc:outputs") is None
+    assert cache.get("cloudformation:vpc2:outputs") == {"VpcId": "vpc-2"}
+    clock.now += 11
+    assert cache.get("cloudformation:vpc2:outputs") is None
+
+
+def test_tiered_cache(tmp_path):
+    backend = gpwm.cache.SqliteCache(str(tmp_path / "stacks.sqlite"))
+    backend.set("key", "value")
+    cache = gpwm.cache.TieredCache(backend=backend)
+    assert cache.get("key") == "value"
+    # kept in memory once read from the backend
+    assert cache.memory.get("key") == "value"
+    cache.invalidate("k")
+    assert cache.get("key") is None
+    assert backend.get("key") is None
+
+
+def test_get_stack_cache_follows_the_settings(monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE", None)
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE_SETTINGS", None)
+    monkeypatch.setattr(gpwm.cache, "CACHE_TTL", 10)
+    cache = gpwm.cache.get_stack_cache()
+    assert cache.backend is None
+    assert cache.memory.ttl == 10
+    assert gpwm.cache.get_stack_cache() is cache
+    monkeypatch.setattr(gpwm.cache, "CACHE_TTL", 20)
+    assert gpwm.cache.get_stack_cache().memory.ttl == 20
+
+
+def test_fetch_cache_evicts_the_least_recently_used(tmp_path):
+    cache = gpwm.cache.FetchCache(str(tmp_path), max_size=10)
+    cache.set("a", "aaaa", {"etag": "1"})
+    cache.set("b", "bbbb", {"etag": "2"})
+    a, b = (cache._path(k) + ".body" for k in "ab")
+    os.utime(a, (1, 1))
+    os.utime(b, (2, 2))
+    # reading marks a as recently used
+    assert cache.get("a") == ("aaaa", {"etag": "1", "key": "a"})
+    cache.set("c", "cccc", {"etag": "3"})
+    assert cache.get("b") is None
+    assert cache.get("a")[0] == "aaaa"
+    assert cache.get("c")[0] == "cccc"
@@ -0,0 +1,118 @@
+import gpwm.stacks.gcp
+import gpwm.utils
+
+
+def gcp_stack():
+    return gpwm.stacks.gcp.GCPStack(
+        name="network",
+        project="project",
+        resources=[{"name": "network", "type": "compute.v1.network"}],
+        BuildId="1"
+    )
+
+
+def test_is_unchanged():
+    stack = gcp_stack()
+    deployment = {
+        "labels": stack.labels,
+        "operation": {"status": "DONE"}
+    }
+    assert stack.is_unchanged(deployment)
+    deployment["labels"] = [
+        {"key": gpwm.stacks.gcp.CONTENT_HASH_LABEL, "value": "x"}
+    ]
+    assert not stack.is_unchanged(deployment)
+
+
+def test_is_unchanged_after_failures():
+    stack = gcp_stack()
+    deployment = {
+        "labels": stack.labels,
+        "operation": {
+            "status": "DONE",
+            "error": {"errors": [{"message": "quota exceeded"}]}
+        }
+    }
+    assert not stack.is_unchanged(deployment)
+
+
+def test_poll_operations(monkeypatch):
+    calls = []
+    responses = {
+        "op-1": [{"name": "op-1", "status": "DONE"}],
+        "op-2": [
+            {"name": "op-2", "status": "RUNNING"},
+            {
+                "name": "op-2",
+                "status": "DONE",
+                "error": {"errors": [{"message": "quota exceeded"}]}
+            }
+        ]
+    }
+    delays = []
+
+    def get_operation(project, name):
+        calls.append(name)
+        return responses[name].pop(0)
+
+    monkeypatch.setattr(gpwm.stacks.gcp, "get_operation", get_operation)
+    monkeypatch.setattr(gpwm.utils, "sleep_with_jitter", delays.append)
+    errors = gpwm.stacks.gcp.poll_operations([
+        ("project", {"name": "op-1", "status": "RUNNING"}),
+        ("project", {"name": "op-2", "status": "PENDING"})
+    ])
+    assert errors == {("project", "op-2"): "quota exceeded"}
+    assert calls == ["op-1", "op-2", "op-2"]
+    assert delays == [gpwm.stacks.gcp.WAITER_MIN_DELAY]
+
+
+def test_poll_operations_timeout(monkeypatch):
+    monkeypatch.setattr(
+        gpwm.stacks.gcp,
+        "get_operation",
+        lambda project, name: {"name": name, "status": "RUNNING"}
+    )
+    monkeypatch.setattr(gpwm.utils, "sleep_with_jitter", lambda delay: None)
+    errors = gpwm.stacks.gcp.poll_operations(
+        [("project", {"name": "op-1", "status": "RUNNING"})],
+        timeout=-1
+    )
+    assert errors == {
+        ("project", "op-1"): "timed out waiting for operation op-1"
+    }
+
+
+def test_imports_are_fetched_once(monkeypatch):
+    fetched = []
+
+    def get_template_body(url):
+        fetched.append(url.geturl())
+        return "content of {}\n".format(url.path)
+
+    monkeypatch.setattr(gpwm.stacks.gcp, "IMPORTS", {})
+    monkeypatch.setattr(gpwm.utils, "get_template_body", get_template_body)
+    stacks = [
+        gpwm.stacks.gcp.GCPStack(
+            name=name,
+            project="project",
+            imports=[
+                {"path": "https://example.com/templates/network.jinja"},
+                {"path": "templates/firewall.py", "name": "firewall.py"}
+            ],
+            resources=[{"name": name, "type": "network.jinja"}],
+            BuildId="1"
+        )
+        for name in ["network", "other-network"]
+    ]
+    assert sorted(fetched) == [
+        "https://example.com/templates/network.jinja",
+        "templates/firewall.py"
+    ]
+    assert stacks[0].target["imports"] == [
+        {
+            "name": "network.jinja",
+            "content": "content of /templates/network.jinja"
+        },
+        {"name": "firewall.py", "content": "content of templates/firewall.py"}
+    ]
+    assert stacks[0].import_digests == stacks[1].import_digests
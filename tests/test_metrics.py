@@ -0,0 +1,78 @@
+import json
+
+import boto3
+from botocore.stub import Stubber
+import pytest
+
+import gpwm.metrics
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    monkeypatch.setattr(gpwm.metrics, "ENABLED", True)
+    monkeypatch.setattr(gpwm.metrics, "SPANS", [])
+    yield gpwm.metrics
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(gpwm.metrics, "SPANS", [])
+    with gpwm.metrics.phase("render"):
+        pass
+    assert gpwm.metrics.SPANS == []
+
+
+def test_summarize(metrics):
+    for _ in range(2):
+        with metrics.phase("render", engine="mako"):
+            pass
+    metrics.record("api", "s3.HeadObject", 0, 1.0, retries=2, throttles=1)
+    metrics.record("api", "s3.HeadObject", 0, 3.0, error="404")
+    summary = metrics.summarize()
+    assert [(e["category"], e["name"], e["count"]) for e in summary] == [
+        ("api", "s3.HeadObject", 2),
+        ("phase", "render", 2)
+    ]
+    assert summary[0]["total"] == 4.0
+    assert summary[0]["mean"] == 2.0
+    assert summary[0]["max"] == 3.0
+    assert summary[0]["retries"] == 2
+    assert summary[0]["throttles"] == 1
+    assert summary[0]["errors"] == 1
+    assert metrics.SPANS[0]["args"] == {"engine": "mako"}
+
+
+def test_instrument_boto_client(metrics):
+    client = boto3.client(
+        "cloudformation",
+        region_name="us-east-1",
+        aws_access_key_id="key",
+        aws_secret_access_key="secret"
+    )
+    metrics.instrument_boto_client(client)
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_stacks", {"Stacks": []})
+        client.describe_stacks()
+    assert [span["name"] for span in metrics.SPANS] == [
+        "cloudformation.DescribeStacks"
+    ]
+
+
+@pytest.mark.parametrize("metrics_format", ["table", "json", "chrome"])
+def test_write(metrics, tmp_path, metrics_format):
+    with metrics.phase("render"):
+        pass
+    path = str(tmp_path / "metrics")
+    metrics.write(path, metrics_format)
+    with open(path) as f:
+        content = f.read()
+    if metrics_format == "table":
+        assert content.splitlines()[1].startswith("phase  render")
+    elif metrics_format == "json":
+        assert json.loads(content)["summary"][0]["name"] == "render"
+    else:
+        assert json.loads(content)["traceEvents"][0]["ph"] == "X"
+
+
+def test_write_unknown_format(metrics):
+    with pytest.raises(SystemExit):
+        metrics.write("-", "csv")
@@ -0,0 +1,138 @@
+import gpwm.nesting
+
+
+def bucket(name="Bucket"):
+    return {"Type": "AWS::S3::Bucket", "Properties": {"BucketName": name}}
+
+
+def queue(reference):
+    return {"Type": "AWS::SQS::Queue", "Properties": {"QueueName": reference}}
+
+
+def child_resources(children):
+    return {
+        name: sorted(child["Resources"]) for name, child in children.items()
+    }
+
+
+def test_split_template_references_across_children():
+    template = {
+        "Resources": {
+            "Bucket": bucket(),
+            "Queue": queue({"Fn::GetAtt": ["Bucket", "Arn"]}),
+        },
+        "Outputs": {"Queue": {"Value": {"Ref": "Queue"}}}
+    }
+    parent, children = gpwm.nesting.split_template(template, 1)
+
+    assert child_resources(children) == {
+        "NestedStack1": ["Bucket"],
+        "NestedStack2": ["Queue"]
+    }
+    assert children["NestedStack1"]["Outputs"] == {
+        "BucketArn": {"Value": {"Fn::GetAtt": ["Bucket", "Arn"]}}
+    }
+    assert children["NestedStack2"]["Resources"]["Queue"]["Properties"] == {
+        "QueueName": {"Ref": "BucketArn"}
+    }
+    nested = parent["Resources"]["NestedStack2"]
+    assert nested["Properties"]["Parameters"] == {
+        "BucketArn": {"Fn::GetAtt": ["NestedStack1", "Outputs.BucketArn"]}
+    }
+    assert parent["Outputs"]["Queue"]["Value"] == {
+        "Fn::GetAtt": ["NestedStack2", "Outputs.QueueRef"]
+    }
+
+
+def test_split_template_passes_the_parent_stack_name():
+    template = {
+        "Resources": {
+            "Bucket": bucket({"Fn::Sub": "${AWS::StackName}-bucket"}),
+            "Queue": queue({"Ref": "AWS::StackId"}),
+        }
+    }
+    parent, children = gpwm.nesting.split_template(template, 1)
+
+    assert children["NestedStack1"]["Resources"]["Bucket"]["Properties"] == {
+        "BucketName": {"Fn::Sub": "${ParentStackName}-bucket"}
+    }
+    assert children["NestedStack2"]["Resources"]["Queue"]["Properties"] == {
+        "QueueName": {"Ref": "ParentStackId"}
+    }
+    parameters = {
+        name: resource["Properties"]["Parameters"]
+        for name, resource in parent["Resources"].items()
+    }
+    assert parameters == {
+        "NestedStack1": {"ParentStackName": {"Ref": "AWS::StackName"}},
+        "NestedStack2": {"ParentStackId": {"Ref": "AWS::StackId"}}
+    }
+
+
+def test_split_template_avoids_taken_names():
+    template = {
+        "Parameters": {"BucketRef": {"Type": "String"}},
+        "Resources": {
+            "NestedStack1": bucket(),
+            "Queue": queue({"Ref": "NestedStack1"}),
+            "Topic": {
+                "Type": "AWS::SNS::Topic",
+                "Properties": {"TopicName": {"Ref": "BucketRef"}}
+            }
+        }
+    }
+    parent, children = gpwm.nesting.split_template(template, 2)
+
+    assert sorted(children) == ["NestedStack2", "NestedStack3"]
+    assert "NestedStack1" not in parent["Resources"]
+    assert len(parent["Resources"]) == 2
+
+    template["Resources"]["Bucket"] = template["Resources"].pop(
+        "NestedStack1"
+    )
+    template["Resources"]["Queue"]["Properties"]["QueueName"] = {
+        "Ref": "Bucket"
+    }
+    parent, children = gpwm.nesting.split_template(template, 1)
+    outputs = set()
+    for child in children.values():
+        outputs.update(child.get("Outputs", {}))
+    assert outputs == {"BucketRef2"}
+
+
+def test_split_template_output_limit():
+    size = gpwm.nesting.MAX_OUTPUTS + 10
+    resources = {
+        "Bucket{}".format(i): bucket("bucket{}".format(i))
+        for i in range(size)
+    }
+    template = {
+        "Resources": resources,
+        "Outputs": {
+            name: {"Value": {"Ref": name}} for name in resources
+        }
+    }
+    parent, children = gpwm.nesting.split_template(template, size)
+
+    assert len(children) == 2
+    for child in children.values():
+        assert len(child["Outputs"]) <= gpwm.nesting.MAX_OUTPUTS
+    # the outputs over the limit are moved to the children
+    assert len(parent["Outputs"]) == gpwm.nesting.MAX_OUTPUTS
+
+
+def test_partition_resources_splits_components_over_the_output_limit():
+    resources = {"Bucket": bucket()}
+    for i in range(gpwm.nesting.MAX_OUTPUTS + 1):
+        resources["Queue{}".format(i)] = queue({"Ref": "Bucket"})
+    outputs = {
+        name: {"Value": {"Ref": name}}
+        for name in resources if name != "Bucket"
+    }
+    partitions = gpwm.nesting.partition_resources(
+        resources,
+        len(resources),
+        outputs
+    )
+    assert len(partitions) == 2
+    assert [len(p) for p in partitions] == [gpwm.nesting.MAX_OUTPUTS, 2]
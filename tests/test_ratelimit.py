@@ -0,0 +1,64 @@
+import pytest
+
+import gpwm.ratelimit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(gpwm.ratelimit.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    monkeypatch.setattr(gpwm.ratelimit, "BUCKETS", {})
+    monkeypatch.setattr(gpwm.ratelimit, "BUCKETS_SETTINGS", None)
+
+
+def test_token_bucket_reserve(clock):
+    bucket = gpwm.ratelimit.TokenBucket(rate=2, burst=2, min_rate=0.5)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # the bucket is empty: callers are served in order, every half second
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    clock[0] += 10
+    # refilled, up to the burst
+    assert bucket.reserve() == 0
+    assert bucket.tokens == pytest.approx(1)
+    assert bucket.requests == 5
+    assert bucket.waited == pytest.approx(1.5)
+
+
+def test_token_bucket_adapts_the_rate(clock):
+    bucket = gpwm.ratelimit.TokenBucket(rate=4, burst=4, min_rate=1.5)
+    bucket.on_throttle()
+    assert bucket.rate == 2
+    # throttles during the cooldown were caused by the previous rate
+    bucket.on_throttle()
+    assert bucket.rate == 2
+    clock[0] += gpwm.ratelimit.DECREASE_COOLDOWN
+    bucket.on_throttle()
+    assert bucket.rate == 1.5
+    assert bucket.throttles == 3
+
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 4
+
+
+def test_get_bucket_follows_the_settings(monkeypatch):
+    key = ("aws", "cloudformation", "us-east-1")
+    monkeypatch.setattr(gpwm.ratelimit, "RATE_LIMIT", 10)
+    monkeypatch.setattr(gpwm.ratelimit, "RATE_LIMIT_BURST", 0)
+    bucket = gpwm.ratelimit.get_bucket(key)
+    assert gpwm.ratelimit.get_bucket(key) is bucket
+    assert (bucket.rate, bucket.burst) == (10, 10)
+
+    monkeypatch.setattr(gpwm.ratelimit, "RATE_LIMIT", 5)
+    bucket = gpwm.ratelimit.get_bucket(key)
+    assert (bucket.rate, bucket.burst) == (5, 5)
+
+    monkeypatch.setattr(gpwm.ratelimit, "RATE_LIMIT", 0)
+    assert gpwm.ratelimit.get_bucket(key) is None
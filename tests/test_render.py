@@ -0,0 +1,85 @@
+import hashlib
+import io
+import json
+import logging
+import sys
+
+import gpwm.cache
+import gpwm.render
+import gpwm.utils
+
+
+def test_configure_worker(monkeypatch):
+    # eg the warm caches and clients of the daemon
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE", object())
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE_SETTINGS", ("memory",))
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {"client": object()})
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS_SETTINGS", (20,))
+    streams = sys.stdout, sys.stderr
+    # eg the streams sending the output of a request to a daemon client
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    handler = logging.StreamHandler(sys.stderr)
+    logging.getLogger().addHandler(handler)
+    try:
+        gpwm.render.configure_worker({("gpwm.utils", "CACHE_DIR"): "/x"})
+        assert sys.stdout is sys.__stdout__
+        assert sys.stderr is sys.__stderr__
+        assert handler.stream is sys.__stderr__
+    finally:
+        logging.getLogger().removeHandler(handler)
+        sys.stdout, sys.stderr = streams
+    assert gpwm.utils.CACHE_DIR == "/x"
+    assert gpwm.cache.STACK_CACHE is None
+    assert gpwm.utils.PROVIDER_CLIENTS == {}
+    assert gpwm.utils.PROVIDER_CLIENTS_SETTINGS is None
+
+
+def test_render_all(tmp_path):
+    templates = tmp_path / "templates"
+    templates.mkdir()
+    (templates / "bucket.mako").write_text(
+        "Resources:\n"
+        "  Bucket:\n"
+        "    Type: AWS::S3::Bucket\n"
+        "    Properties:\n"
+        "      BucketName: ${name}-${build_id}\n"
+    )
+    (templates / "bucket.jinja").write_text(
+        "Resources:\n"
+        "  Bucket:\n"
+        "    Type: AWS::S3::Bucket\n"
+        "    Properties:\n"
+        "      BucketName: {{ name }}\n"
+    )
+    stacks = tmp_path / "stacks"
+    stacks.mkdir()
+    for engine in ["mako", "jinja"]:
+        (stacks / "{}.mako".format(engine)).write_text(
+            "StackName: {engine}\n"
+            "TemplateBody: {path}\n"
+            "Parameters:\n"
+            "  name: {engine}-bucket\n".format(
+                engine=engine,
+                path=templates / "bucket.{}".format(engine)
+            )
+        )
+    out = tmp_path / "out"
+
+    gpwm.render.render_all(str(stacks), str(out), "1", jobs=1)
+
+    manifest = json.loads((out / "manifest.json").read_text())
+    assert manifest["build_id"] == "1"
+    assert sorted(manifest["stacks"]) == ["jinja.mako", "mako.mako"]
+    for engine in ["mako", "jinja"]:
+        attributes = gpwm.utils.load_yaml(
+            (out / "{}.mako.attributes.yaml".format(engine)).read_text()
+        )
+        # only the parameters of the stack file, not the template functions
+        assert attributes["Parameters"] == {"name": engine + "-bucket"}
+        rendered = (out / "{}.mako.yaml".format(engine)).read_text()
+        assert "{}-bucket".format(engine) in rendered
+        entry = manifest["stacks"]["{}.mako".format(engine)]
+        assert entry["rendered"] == hashlib.sha256(
+            rendered.encode("utf-8")
+        ).hexdigest()
+    assert "mako-bucket-1" in (out / "mako.mako.yaml").read_text()
@@ -0,0 +1,164 @@
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+import gpwm.cache
+import gpwm.cli
+import gpwm.client
+import gpwm.server
+import gpwm.utils
+
+
+def request(tmp_path, argv=()):
+    return {
+        "argv": list(argv),
+        "cwd": str(tmp_path),
+        "env": {"PATH": os.environ.get("PATH", ""), "GPWM_TEST": "1"}
+    }
+
+
+def test_execute_restores_the_process_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "CACHE_TTL", 300)
+    cwd, env = os.getcwd(), dict(os.environ)
+    seen = {}
+
+    def main(argv):
+        seen.update(
+            argv=argv,
+            cwd=os.getcwd(),
+            env=os.environ.get("GPWM_TEST"),
+            stdin=sys_stdin()
+        )
+        # eg options of the command line
+        gpwm.cache.CACHE_TTL = 5
+        os.environ["LEAKED"] = "1"
+        print("out")
+        raise SystemExit(3)
+
+    monkeypatch.setattr(gpwm.cli, "main", main)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    code = gpwm.server.execute(
+        request(tmp_path, ["render"]),
+        stdout,
+        stderr,
+        io.StringIO("input")
+    )
+
+    assert code == 3
+    assert stdout.getvalue() == "out\n"
+    assert seen == {
+        "argv": ["render"],
+        "cwd": str(tmp_path),
+        "env": "1",
+        "stdin": "input"
+    }
+    assert gpwm.cache.CACHE_TTL == 300
+    assert os.getcwd() == cwd
+    assert dict(os.environ) == env
+
+
+def sys_stdin():
+    return sys.stdin.read()
+
+
+def test_execute_drops_clients_when_credentials_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpwm.cli, "main", lambda argv: None)
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {"client": object()})
+    monkeypatch.setattr(gpwm.server, "CREDENTIALS", None)
+    first = request(tmp_path)
+    first["env"]["AWS_PROFILE"] = "dev"
+    gpwm.server.execute(first, io.StringIO(), io.StringIO())
+    assert gpwm.utils.PROVIDER_CLIENTS == {}
+
+    gpwm.utils.PROVIDER_CLIENTS["client"] = object()
+    gpwm.server.execute(first, io.StringIO(), io.StringIO())
+    assert "client" in gpwm.utils.PROVIDER_CLIENTS
+
+    second = request(tmp_path)
+    second["env"]["AWS_PROFILE"] = "prod"
+    gpwm.server.execute(second, io.StringIO(), io.StringIO())
+    assert gpwm.utils.PROVIDER_CLIENTS == {}
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / "gpwm.sock")
+    server = gpwm.server.Server(path, gpwm.server.RequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield path
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_daemon_forwards_stdin(tmp_path, monkeypatch, daemon):
+    def main(argv):
+        print("got {}".format(sys_stdin()))
+
+    monkeypatch.setattr(gpwm.cli, "main", main)
+    # the output is written to the process' streams while the request is
+    # executed, so the protocol is spoken here rather than by gpwm.client
+    sock = gpwm.client.connect(daemon)
+    with sock, sock.makefile("rb") as stream, sock.makefile("wb") as output:
+        gpwm.client.send_message(output, request(tmp_path, ["render"]))
+        assert gpwm.client.read_message(stream) == {"accepted": True}
+        gpwm.client.send_message(output, {"stdin": "a" * 100000})
+        gpwm.client.send_message(output, {"stdin": "é"})
+        gpwm.client.send_message(output, {"stdin": None})
+        messages = []
+        while not messages or "exit" not in messages[-1]:
+            messages.append(gpwm.client.read_message(stream))
+    assert messages[-1] == {"exit": 0}
+    assert "".join(m.get("stdout", "") for m in messages) == \
+        "got {}é\n".format("a" * 100000)
+
+
+def test_forward_stdin(tmp_path, monkeypatch):
+    stdin = tmp_path / "stdin"
+    stdin.write_bytes("é".encode("utf-8") * 50000)
+    output = io.BytesIO()
+    monkeypatch.setattr(gpwm.client, "READ_SIZE", 1001)
+    with open(str(stdin)) as f:
+        monkeypatch.setattr("sys.stdin", f)
+        gpwm.client.forward_stdin(output)
+    output.seek(0)
+    messages = []
+    while True:
+        message = gpwm.client.read_message(output)
+        if message is None:
+            break
+        messages.append(message["stdin"])
+    assert messages[-1] is None
+    # characters split between reads are kept whole
+    assert "".join(messages[:-1]) == "é" * 50000
+
+
+def test_request_to_a_busy_daemon(daemon):
+    with gpwm.server.EXECUTE_LOCK:
+        with gpwm.client.connect(daemon) as sock:
+            assert gpwm.client.request(sock, ["render"]) is None
+
+
+@pytest.mark.parametrize("argv, command", [
+    (["render", "stack.mako"], ("render", False)),
+    (["update", "-r", "stack.mako"], ("update", True)),
+    (["update", "-wr", "stack.mako"], ("update", True)),
+    (["update", "-b", "-r", "stack.mako"], ("update", False)),
+    (["update", "-tr", "-"], ("update", False)),
+    (["upsert", "stack.mako"], ("upsert", True)),
+    (["upsert", "--no-review", "stack.mako"], ("upsert", False)),
+    (["--loglevel", "-r", "render", "-r"], ("render", False)),
+    (["--cache-dir", "serve", "render", "serve"], ("render", False)),
+    (["--dry", "--no-cache", "apply", "-r"], ("apply", False)),
+    (["-ldebug", "serve"], ("serve", False)),
+    (["--metrics-out=-", "update", "--review", "-"], ("update", True)),
+    ([], (None, False))
+])
+def test_parse_command(argv, command):
+    assert gpwm.client.parse_command(argv) == command
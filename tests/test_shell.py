@@ -0,0 +1,118 @@
+import asyncio
+import io
+import sys
+
+import pytest
+
+import gpwm.stacks.shell
+import gpwm.utils
+
+
+def shell_stack(tmp_path, actions):
+    return gpwm.stacks.shell.ShellStack(
+        Actions=actions,
+        BuildId="1",
+        LogDir=str(tmp_path)
+    )
+
+
+def test_output_writer_lines():
+    output, log = io.StringIO(), io.StringIO()
+    writer = gpwm.stacks.shell.OutputWriter("[a] ", output, log, lines=True)
+    writer.write(b"one\ntw")
+    assert output.getvalue() == "[a] one\n"
+    writer.write(b"o\nthree")
+    writer.write(b"")
+    assert output.getvalue() == "[a] one\n[a] two\n[a] three\n"
+    assert log.getvalue() == output.getvalue()
+
+
+def test_output_writer_chunks():
+    output, log = io.StringIO(), io.StringIO()
+    writer = gpwm.stacks.shell.OutputWriter("[a] ", output, log, lines=False)
+    # a prompt shows up before the answer, and split characters are kept
+    writer.write(b"Continue? [y/N] \xc3")
+    assert output.getvalue() == "[a] Continue? [y/N] "
+    writer.write(b"\xa9\nok")
+    writer.write(b"")
+    assert output.getvalue() == "[a] Continue? [y/N] é\n[a] ok\n"
+
+
+def test_serial_groups_get_stdin(tmp_path, monkeypatch):
+    answer = tmp_path / "answer"
+    answer.write_text("y\n")
+    stdout = io.StringIO()
+    with open(str(answer)) as stdin:
+        monkeypatch.setattr("sys.stdin", stdin)
+        monkeypatch.setattr("sys.stdout", stdout)
+        monkeypatch.setattr("sys.stderr", io.StringIO())
+        stack = shell_stack(tmp_path, {"Create": [
+            {"Name": "ask", "Commands": "printf 'Continue? '; read a; "
+                                        "echo got $a"},
+            {"Name": "build", "Parallel": True, "Commands": "cat; echo done"}
+        ]})
+        stack.create()
+    assert stdout.getvalue() == (
+        "[ask] Continue? got y\n"
+        "[build] done\n"
+    )
+
+
+def test_serial_groups_are_logged(tmp_path, monkeypatch):
+    out = tmp_path / "out"
+    with open(str(out), "w") as stdout:
+        monkeypatch.setattr("sys.stdin", io.StringIO())
+        monkeypatch.setattr("sys.stdout", stdout)
+        monkeypatch.setattr("sys.stderr", stdout)
+        stack = shell_stack(tmp_path, {"Create": {"Commands": "echo hi"}})
+        stack.create()
+    assert out.read_text() == "[Create] hi\n"
+    assert open(stack.get_log_path("Create")).read() == "[Create] hi\n"
+
+
+def test_terminal_groups_inherit_the_streams(tmp_path, monkeypatch):
+    out = tmp_path / "out"
+    with open(str(out), "w") as stdout:
+        monkeypatch.setattr("sys.stdin", io.StringIO())
+        monkeypatch.setattr("sys.stdout", stdout)
+        monkeypatch.setattr("sys.stderr", stdout)
+        stack = shell_stack(tmp_path, {"Create": {
+            "Terminal": True,
+            "Commands": "echo hi"
+        }})
+        stack.create()
+    # straight from the commands, so no prefix, and nothing to log
+    assert out.read_text() == "hi\n"
+    assert "output not logged" in open(stack.get_log_path("Create")).read()
+
+
+def test_parallel_terminal_groups(tmp_path):
+    stack = shell_stack(tmp_path, {"Create": {
+        "Parallel": True,
+        "Terminal": True,
+        "Commands": "true"
+    }})
+    with pytest.raises(SystemExit):
+        stack.get_command_groups("Create")
+
+
+def test_async_long_lines(tmp_path, monkeypatch):
+    stdout = io.StringIO()
+    monkeypatch.setattr("sys.stdout", stdout)
+    stack = shell_stack(tmp_path, {"Create": {
+        "Parallel": True,
+        "Commands": [sys.executable, "-c", "print('x' * 200000)"]
+    }})
+    asyncio.run(stack.async_create())
+    assert stdout.getvalue() == "[Create] {}\n".format("x" * 200000)
+
+
+def test_no_upsert(tmp_path):
+    stack = shell_stack(tmp_path, {"Create": {"Commands": "true"}})
+    assert not hasattr(stack, "upsert")
+    assert not hasattr(stack, "async_upsert")
+
+
+def test_to_yaml(tmp_path):
+    stack = shell_stack(tmp_path, {"Create": {"Commands": "true"}})
+    assert stack.to_yaml() == gpwm.utils.dump_yaml(stack.Actions)
@@ -0,0 +1,490 @@
+import collections
+import io
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.parse import urlunparse
+
+import gpwm.cache
+import gpwm.utils
+
+
+def test_get_stack_data(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(gpwm.cache.time, "time", lambda: clock[0])
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE", None)
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE_SETTINGS", None)
+    monkeypatch.setattr(gpwm.cache, "CACHE_TTL", 300)
+    outputs = {"VpcId": "vpc-1"}
+    fetches = []
+
+    def get(name):
+        def fetch():
+            fetches.append(name)
+            return dict(outputs)
+        return gpwm.utils.get_stack_data(
+            "cloudformation:vpc:outputs",
+            fetch,
+            lambda data: data.get(name),
+            name
+        )
+
+    assert get("VpcId") == "vpc-1"
+    assert get("VpcId") == "vpc-1"
+    assert fetches == ["VpcId"]
+
+    # not in the cached data, so fetched again, then cached as missing
+    outputs["SubnetId"] = "subnet-1"
+    assert get("SubnetId") == "subnet-1"
+    assert get("Missing") is None
+    assert get("Missing") is None
+    assert fetches == ["VpcId", "SubnetId", "Missing"]
+
+    clock[0] += 301
+    outputs["Missing"] = "found"
+    assert get("Missing") == "found"
+    assert fetches == ["VpcId", "SubnetId", "Missing", "Missing"]
+
+
+def test_invalidating_stack_data_drops_missing_values(monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE", None)
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE_SETTINGS", None)
+    outputs = {}
+
+    def get():
+        return gpwm.utils.get_stack_data(
+            "cloudformation:vpc:outputs",
+            lambda: dict(outputs),
+            lambda data: data.get("VpcId"),
+            "VpcId"
+        )
+
+    assert get() is None
+    outputs["VpcId"] = "vpc-1"
+    assert get() is None
+    gpwm.cache.get_stack_cache().invalidate("cloudformation:vpc:")
+    assert get() == "vpc-1"
+
+
+class Paginator(object):
+    def __init__(self, pages, fetched):
+        self.pages = pages
+        self.fetched = fetched
+
+    def paginate(self, PaginationConfig, **kwargs):
+        for page in self.pages:
+            self.fetched.append(page)
+            yield page
+
+
+class EC2(object):
+    def __init__(self):
+        self.fetched = []
+
+    def get_paginator(self, action):
+        return Paginator([
+            {"Vpcs": [{"VpcId": "vpc-1"}, {"VpcId": "vpc-2"}]},
+            {"Vpcs": [{"VpcId": "vpc-3"}]}
+        ], self.fetched)
+
+
+def test_call_aws_streams_pages(monkeypatch):
+    ec2 = EC2()
+    monkeypatch.setattr(gpwm.utils, "get_boto_client", lambda *a, **k: ec2)
+    vpcs = gpwm.utils.call_aws(
+        "ec2",
+        "describe_vpcs",
+        result_filter="Vpcs[].VpcId",
+        paginate=True
+    )
+    assert ec2.fetched == []
+    assert next(vpcs) == "vpc-1"
+    assert len(ec2.fetched) == 1
+    assert list(vpcs) == ["vpc-2", "vpc-3"]
+
+
+def test_aws_tag_collects_pages(monkeypatch):
+    ec2 = EC2()
+    monkeypatch.setattr(gpwm.utils, "get_boto_client", lambda *a, **k: ec2)
+    monkeypatch.setattr(gpwm.utils, "CALL_AWS_CACHE", {})
+    arguments = {
+        "service": "ec2",
+        "action": "describe_vpcs",
+        "result_filter": "Vpcs[].VpcId",
+        "paginate": True
+    }
+    assert gpwm.utils.resolve_aws_tag(arguments) == [
+        "vpc-1", "vpc-2", "vpc-3"
+    ]
+    assert gpwm.utils.resolve_aws_tag(arguments) == [
+        "vpc-1", "vpc-2", "vpc-3"
+    ]
+    assert len(ec2.fetched) == 2
+
+
+def test_load_yaml_resolves_nested_tags_once(monkeypatch):
+    calls = []
+
+    def resolve(tag):
+        def resolver(arguments):
+            calls.append((tag, arguments))
+            return "{}({})".format(tag, ",".join(
+                str(v) for _, v in sorted(arguments.items())
+            ))
+        return resolver
+
+    monkeypatch.setitem(gpwm.utils.TAG_RESOLVERS, "!AWS", resolve("aws"))
+    monkeypatch.setitem(
+        gpwm.utils.TAG_RESOLVERS,
+        "!Cloudformation",
+        resolve("cf")
+    )
+    document = gpwm.utils.load_yaml(
+        "a: !Cloudformation {stack: vpc, output: VpcId}\n"
+        "b: !Cloudformation {stack: vpc, output: VpcId}\n"
+        "c: !AWS {service: ec2, action: describe_vpcs, arguments: {\n"
+        "  VpcIds: [!Cloudformation {stack: vpc, output: VpcId}]}}\n"
+    )
+    assert document == {
+        "a": "cf(VpcId,vpc)",
+        "b": "cf(VpcId,vpc)",
+        "c": "aws(describe_vpcs,{'VpcIds': ['cf(VpcId,vpc)']},ec2)"
+    }
+    # identical tags are resolved once, before the tags using them
+    assert calls == [
+        ("cf", {"stack": "vpc", "output": "VpcId"}),
+        ("aws", {
+            "service": "ec2",
+            "action": "describe_vpcs",
+            "arguments": {"VpcIds": ["cf(VpcId,vpc)"]}
+        })
+    ]
+
+
+def test_load_yaml_batches_ssm_tags(monkeypatch):
+    calls = []
+
+    def call_aws(service, action, arguments):
+        calls.append((action, arguments))
+        names = arguments["Names"]
+        return {
+            "Parameters": [
+                {"Name": n, "Value": n.upper()} for n in names
+                if n != "/missing"
+            ],
+            "InvalidParameters": [n for n in names if n == "/missing"]
+        }
+
+    monkeypatch.setattr(gpwm.utils, "call_aws", call_aws)
+    lines = ["p{0}: !SSM {{Name: /p{0}}}".format(i) for i in range(12)]
+    lines.append("again: !SSM {Name: /p0}")
+    lines.append("secret: !SSM {Name: /secret, WithDecryption: true}")
+    document = gpwm.utils.load_yaml("\n".join(lines))
+
+    assert document["p11"] == "/P11"
+    assert document["again"] == "/P0"
+    assert document["secret"] == "/SECRET"
+    assert sorted(
+        (len(a["Names"]), a["WithDecryption"]) for _, a in calls
+    ) == [(1, True), (2, False), (10, False)]
+    assert {action for action, _ in calls} == {"get_parameters"}
+
+    with pytest.raises(SystemExit) as exc:
+        gpwm.utils.load_yaml("a: !SSM {Name: /missing}")
+    assert "SSM parameters not found: /missing" in str(exc.value)
+
+
+class SSM(object):
+    def __init__(self):
+        self.calls = []
+
+    def describe_parameters(self, **kwargs):
+        self.calls.append(("describe_parameters", kwargs))
+        return {"Parameters": [{"Name": "/a", "Tags": ["x"]}]}
+
+    def put_parameter(self, **kwargs):
+        self.calls.append(("put_parameter", kwargs))
+        return {"Version": len(self.calls)}
+
+
+def test_call_aws_memoizes_read_only_actions(monkeypatch):
+    ssm = SSM()
+    monkeypatch.setattr(gpwm.utils, "get_boto_client", lambda *a, **k: ssm)
+    monkeypatch.setattr(gpwm.utils, "CALL_AWS_CACHE", {})
+    monkeypatch.setattr(
+        gpwm.utils,
+        "CALL_AWS_STATS",
+        {"hits": 0, "misses": 0, "uncacheable": 0}
+    )
+
+    first = gpwm.utils.call_aws(
+        "ssm",
+        "describe_parameters",
+        {"MaxResults": 10, "Filters": []}
+    )
+    # the same arguments, in another order
+    second = gpwm.utils.call_aws(
+        "ssm",
+        "describe_parameters",
+        {"Filters": [], "MaxResults": 10},
+        result_filter="Parameters[0].Name"
+    )
+    assert second == "/a"
+    assert len(ssm.calls) == 1
+    gpwm.utils.call_aws("ssm", "describe_parameters", {"MaxResults": 5})
+    assert len(ssm.calls) == 2
+
+    # callers get copies, so changing a result doesn't change the others
+    first["Parameters"][0]["Tags"].append("y")
+    third = gpwm.utils.call_aws(
+        "ssm",
+        "describe_parameters",
+        {"MaxResults": 10, "Filters": []}
+    )
+    assert third["Parameters"][0]["Tags"] == ["x"]
+
+    # actions changing anything are always called
+    gpwm.utils.call_aws("ssm", "put_parameter", {"Name": "/a"})
+    gpwm.utils.call_aws("ssm", "put_parameter", {"Name": "/a"})
+    assert [c[0] for c in ssm.calls].count("put_parameter") == 2
+    assert gpwm.utils.CALL_AWS_STATS == {
+        "hits": 2,
+        "misses": 2,
+        "uncacheable": 2
+    }
+
+
+class Response(object):
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = text
+        self.headers = headers or {}
+
+
+class Session(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+def test_fetch_http_template_revalidates(monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "CACHE_BACKEND", "sqlite")
+    monkeypatch.setattr(gpwm.cache, "FETCH_CACHE", None)
+    session = Session([
+        Response(200, "v1", {"ETag": '"1"'}),
+        Response(304),
+        Response(200, "v2", {"ETag": '"2"'})
+    ])
+    monkeypatch.setattr(gpwm.utils, "get_http_session", lambda: session)
+    url = urlparse("https://example.com/vpc.mako")
+
+    assert gpwm.utils.get_template_body(url) == "v1"
+    assert gpwm.utils.get_template_body(url) == "v1"
+    assert gpwm.utils.get_template_body(url) == "v2"
+    assert session.requests == [
+        {},
+        {"If-None-Match": '"1"'},
+        {"If-None-Match": '"1"'}
+    ]
+    cached = gpwm.cache.get_fetch_cache().get(urlunparse(url))
+    assert cached[0] == "v2"
+    assert cached[1]["etag"] == '"2"'
+
+
+class S3(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_object(self, **kwargs):
+        from botocore.exceptions import ClientError
+        self.calls.append(kwargs)
+        if "IfNoneMatch" in kwargs:
+            raise ClientError(
+                {"Error": {"Code": "304", "Message": "Not Modified"}},
+                "GetObject"
+            )
+        return {"Body": io.BytesIO(b"body"), "ETag": '"1"'}
+
+
+def test_fetch_s3_template_revalidates(monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "CACHE_BACKEND", "sqlite")
+    monkeypatch.setattr(gpwm.cache, "FETCH_CACHE", None)
+    s3 = S3()
+    monkeypatch.setattr(gpwm.utils, "get_boto_client", lambda *a, **k: s3)
+
+    url = urlparse("s3://bucket/vpc.mako")
+    assert gpwm.utils.get_template_body(url) == "body"
+    assert gpwm.utils.get_template_body(url) == "body"
+    assert s3.calls == [
+        {"Bucket": "bucket", "Key": "vpc.mako"},
+        {"Bucket": "bucket", "Key": "vpc.mako", "IfNoneMatch": '"1"'}
+    ]
+
+    # versions never change, so they're not revalidated
+    versioned = urlparse("s3://bucket/vpc.mako?VersionId=3")
+    assert gpwm.utils.get_template_body(versioned) == "body"
+    assert gpwm.utils.get_template_body(versioned) == "body"
+    assert len(s3.calls) == 3
+
+
+def test_provider_sdks_are_imported_lazily():
+    code = (
+        "import sys; import gpwm.cli; "
+        "print(sorted(m for m in ['boto3', 'botocore', 'apiclient', "
+        "'googleapiclient'] if m in sys.modules))"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    )
+    assert output.decode("utf-8").strip() == "[]"
+
+
+def test_get_provider_client(monkeypatch):
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    assert created == []
+    client = gpwm.utils.get_provider_client(("aws", "client"), factory)
+    assert gpwm.utils.get_provider_client(("aws", "client"), factory) is \
+        client
+    assert created == [client]
+
+
+def test_discovery_file_cache(tmp_path, monkeypatch):
+    cache = gpwm.utils.DiscoveryFileCache(str(tmp_path), ttl=10)
+    url = "https://www.googleapis.com/discovery/v1/apis/dm/v2/rest"
+    assert cache.get(url) is None
+    cache.set(url, "{}")
+    assert cache.get(url) == "{}"
+    now = time.time()
+    monkeypatch.setattr(gpwm.utils.time, "time", lambda: now + 11)
+    assert cache.get(url) is None
+
+
+def test_boto_clients_are_shared(monkeypatch):
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS_SETTINGS", None)
+    monkeypatch.setattr(gpwm.utils, "MAX_POOL_CONNECTIONS", 7)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "x")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "x")
+
+    ec2 = gpwm.utils.get_boto_client("ec2", region="us-east-1")
+    assert gpwm.utils.get_boto_client("ec2", region="us-east-1") is ec2
+    assert gpwm.utils.get_boto_client("ec2", region="us-west-2") is not ec2
+    assert ec2.meta.config.max_pool_connections == 7
+
+    # eg another --max-pool-connections in the next daemon request
+    monkeypatch.setattr(gpwm.utils, "MAX_POOL_CONNECTIONS", 9)
+    client = gpwm.utils.get_boto_client("ec2", region="us-east-1")
+    assert client is not ec2
+    assert client.meta.config.max_pool_connections == 9
+
+
+def test_http_session_is_shared(monkeypatch):
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS", {})
+    monkeypatch.setattr(gpwm.utils, "PROVIDER_CLIENTS_SETTINGS", None)
+    monkeypatch.setattr(gpwm.utils, "MAX_POOL_CONNECTIONS", 7)
+    session = gpwm.utils.get_http_session()
+    assert gpwm.utils.get_http_session() is session
+    assert session.get_adapter("https://example.com")._pool_maxsize == 7
+
+
+def test_compiled_templates_are_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpwm.utils, "TEMPLATE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        gpwm.utils,
+        "COMPILED_TEMPLATES",
+        collections.OrderedDict()
+    )
+    monkeypatch.setattr(gpwm.utils, "JINJA_ENVIRONMENT", None)
+
+    mako = gpwm.utils.get_mako_template("a: ${value}\n")
+    assert gpwm.utils.get_mako_template("a: ${value}\n") is mako
+    assert gpwm.utils.get_mako_template("b: ${value}\n") is not mako
+    assert mako.render(value=1) == "a: 1\n"
+    # the compiled modules are kept on disk for the next runs
+    assert len(os.listdir(str(tmp_path / "mako_modules"))) == 2
+
+    jinja = gpwm.utils.get_jinja_template("a: {{ value }}\n")
+    assert gpwm.utils.get_jinja_template("a: {{ value }}\n") is jinja
+    assert jinja.render(value=1) == "a: 1"
+    assert len(os.listdir(str(tmp_path / "jinja"))) == 1
+
+
+def test_compiled_templates_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpwm.utils, "TEMPLATE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        gpwm.utils,
+        "COMPILED_TEMPLATES",
+        collections.OrderedDict()
+    )
+    monkeypatch.setattr(gpwm.utils, "COMPILED_TEMPLATES_MAX_SIZE", 2)
+    monkeypatch.setattr(gpwm.utils, "JINJA_ENVIRONMENT", None)
+    monkeypatch.setattr(gpwm.utils, "JINJA_SOURCES", {})
+
+    first = gpwm.utils.get_jinja_template("{{ 1 }}")
+    gpwm.utils.get_jinja_template("{{ 2 }}")
+    # the first template is now the most recently used
+    assert gpwm.utils.get_jinja_template("{{ 1 }}") is first
+    gpwm.utils.get_jinja_template("{{ 3 }}")
+    assert len(gpwm.utils.COMPILED_TEMPLATES) == 2
+    assert len(gpwm.utils.JINJA_SOURCES) == 2
+    assert gpwm.utils.get_jinja_template("{{ 1 }}") is first
+    assert gpwm.utils.get_jinja_template("{{ 2 }}").render() == "2"
+
+
+def test_dump_yaml():
+    data = {"Resources": {"Bucket": {"Type": "AWS::S3::Bucket"}}}
+    assert gpwm.utils.dump_yaml(data, default_flow_style=False) == (
+        "Resources:\n  Bucket:\n    Type: AWS::S3::Bucket\n"
+    )
+    assert gpwm.utils.load_yaml(gpwm.utils.dump_yaml(data)) == data
+
+
+def test_stack_outputs_are_fetched_once(monkeypatch):
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE", None)
+    monkeypatch.setattr(gpwm.cache, "STACK_CACHE_SETTINGS", None)
+    monkeypatch.setattr(
+        gpwm.utils,
+        "get_stack_cache_prefix",
+        lambda stack_name, provider="cloudformation", **kwargs:
+            "cloudformation:{}:".format(stack_name)
+    )
+    calls = []
+
+    class Cloudformation(object):
+        def describe_stacks(self, StackName):
+            calls.append(StackName)
+            return {"Stacks": [{
+                "StackName": StackName,
+                "Outputs": [
+                    {"OutputKey": "VpcId", "OutputValue": "vpc-1"},
+                    {"OutputKey": "SubnetId", "OutputValue": "subnet-1"}
+                ]
+            }]}
+
+    monkeypatch.setattr(
+        gpwm.utils,
+        "get_boto_client",
+        lambda service, **kwargs: Cloudformation()
+    )
+    assert gpwm.utils.get_stack_output("vpc", "VpcId") == "vpc-1"
+    assert gpwm.utils.get_stack_output("vpc", "SubnetId") == "subnet-1"
+    assert gpwm.utils.get_stack_output("vpc", "Missing") == ""
+    assert gpwm.utils.get_stack_output("vpc", "Missing") == ""
+    # one fetch for the index, one more for the missing output
+    assert calls == ["vpc", "vpc"]
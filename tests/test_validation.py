@@ -0,0 +1,257 @@
+import collections
+
+import gpwm.utils
+import gpwm.validation
+
+
+def validate(template, **kwargs):
+    return gpwm.validation.TemplateValidator(template, **kwargs).validate()
+
+
+def vpc_template():
+    return {
+        "Parameters": {"Cidr": {"Type": "String"}},
+        "Conditions": {
+            "IsProd": {"Fn::Equals": [{"Ref": "AWS::Region"}, "us-east-1"]}
+        },
+        "Resources": {
+            "VPC": {
+                "Type": "AWS::EC2::VPC",
+                "Properties": {"CidrBlock": {"Ref": "Cidr"}}
+            },
+            "Subnet": {
+                "Type": "AWS::EC2::Subnet",
+                "DependsOn": "VPC",
+                "Condition": "IsProd",
+                "Properties": {
+                    "VpcId": {"Ref": "VPC"},
+                    "CidrBlock": {"Fn::Select": [0, {"Fn::Cidr": [
+                        {"Fn::GetAtt": "VPC.CidrBlock"}, 1, 8
+                    ]}]},
+                    "Tags": [{
+                        "Key": "Name",
+                        "Value": {"Fn::Sub": "${AWS::StackName}-${VPC}"}
+                    }]
+                }
+            }
+        },
+        "Outputs": {
+            "VPC": {
+                "Value": {"Ref": "VPC"},
+                "Export": {"Name": "vpc-VPC"}
+            }
+        }
+    }
+
+
+def test_valid_template():
+    assert validate(vpc_template()) == []
+
+
+def test_unknown_section_and_attribute():
+    template = vpc_template()
+    template["Resource"] = {}
+    template["Resources"]["VPC"]["Propertie"] = {}
+    assert validate(template) == [
+        "Resource: unknown template section",
+        "Resources.VPC: unknown resource attribute Propertie"
+    ]
+
+
+def test_broken_references():
+    template = vpc_template()
+    properties = template["Resources"]["Subnet"]["Properties"]
+    properties["VpcId"] = {"Ref": "Vpc"}
+    properties["Tags"][0]["Value"] = {"Fn::Sub": "${Missing}"}
+    template["Resources"]["Subnet"]["DependsOn"] = ["VPC", "Gateway"]
+    template["Resources"]["Subnet"]["Condition"] = "IsDev"
+    assert sorted(validate(template)) == [
+        "Resources.Subnet.Tags[0].Value.Fn::Sub: unknown variable Missing",
+        "Resources.Subnet.VpcId.Ref: unknown parameter or resource Vpc",
+        "Resources.Subnet: DependsOn unknown resource Gateway",
+        "Resources.Subnet: unknown condition IsDev"
+    ]
+
+
+def test_malformed_functions():
+    template = vpc_template()
+    template["Resources"]["VPC"]["Properties"]["CidrBlock"] = {
+        "Fn::Join": ["-"]
+    }
+    template["Conditions"]["IsProd"] = {"Fn::Not": [{"Condition": "Nope"}]}
+    assert sorted(validate(template)) == [
+        "Conditions.IsProd[0].Condition: unknown condition Nope",
+        "Resources.VPC.CidrBlock.Fn::Join: arguments must be a list of 2 "
+        "elements"
+    ]
+
+
+def test_duplicate_exports():
+    template = vpc_template()
+    template["Outputs"]["Other"] = {
+        "Value": "x",
+        "Export": {"Name": "vpc-VPC"}
+    }
+    assert validate(template) == [
+        "Outputs.Other: export name vpc-VPC already used by Outputs.VPC"
+    ]
+
+
+def test_limits():
+    template = vpc_template()
+    template["Outputs"] = {
+        "Output{}".format(i): {"Value": "x"}
+        for i in range(gpwm.validation.MAX_OUTPUTS + 1)
+    }
+    errors = validate(template, template_body_size=60000)
+    assert errors == [
+        "Template: body is 60000 bytes, larger than the 51200 bytes allowed "
+        "inline. Use a template bucket",
+        "Outputs: 201 entries, more than the maximum of 200"
+    ]
+    assert validate(
+        vpc_template(),
+        template_body_size=60000,
+        inline=False
+    ) == []
+
+
+def test_transformed_template():
+    template = {
+        "Transform": "AWS::Serverless-2016-10-31",
+        "Globals": {"Function": {"Timeout": 10}},
+        "Resources": {
+            "Function": {
+                "Type": "AWS::Serverless::Function",
+                "Connectors": {},
+                "Properties": {
+                    "Handler": "index.handler",
+                    "Role": {"Fn::GetAtt": "FunctionRole.Arn"}
+                }
+            },
+            "Permission": {
+                "Type": "AWS::Lambda::Permission",
+                "DependsOn": "FunctionAliaslive",
+                "Properties": {
+                    "FunctionName": {"Ref": "Function.Alias"},
+                    "SourceArn": {"Fn::Sub": "${ServerlessRestApi}"},
+                    "Principal": {"Fn::Join": ["-"]}
+                }
+            }
+        }
+    }
+    # only the shape of the functions is checked
+    assert validate(template) == [
+        "Resources.Permission.Principal.Fn::Join: arguments must be a list "
+        "of 2 elements"
+    ]
+
+
+def test_for_each():
+    template = vpc_template()
+    template["Transform"] = "AWS::LanguageExtensions"
+    template["Resources"]["Fn::ForEach::Topics"] = [
+        "Name",
+        ["A", "B"],
+        {"Topic${Name}": {"Type": "AWS::SNS::Topic"}}
+    ]
+    template["Outputs"]["Fn::ForEach::TopicArns"] = [
+        "Name",
+        ["A", "B"],
+        {"Topic${Name}": {"Value": {"Ref": {"Fn::Sub": "Topic${Name}"}}}}
+    ]
+    assert validate(template) == []
+
+
+def test_malformed_condition_in_if():
+    template = vpc_template()
+    template["Resources"]["VPC"]["Properties"]["CidrBlock"] = {
+        "Fn::If": [["IsProd"], 1, 2]
+    }
+    assert validate(template) == [
+        "Resources.VPC.CidrBlock.Fn::If: condition must be a string"
+    ]
+
+
+def test_malformed_resource_condition():
+    template = vpc_template()
+    template["Resources"]["Subnet"]["Condition"] = {"Ref": "IsProd"}
+    assert validate(template) == [
+        "Resources.Subnet: condition must be a string"
+    ]
+
+
+def test_malformed_output_condition():
+    template = vpc_template()
+    template["Outputs"]["VPC"]["Condition"] = ["IsProd"]
+    assert validate(template) == ["Outputs.VPC: condition must be a string"]
+
+
+def test_malformed_depends_on():
+    template = vpc_template()
+    template["Resources"]["Subnet"]["DependsOn"] = ["VPC", {"Ref": "VPC"}]
+    assert validate(template) == [
+        "Resources.Subnet: DependsOn must list resource names"
+    ]
+    template["Resources"]["Subnet"]["DependsOn"] = {"VPC": True}
+    assert validate(template) == [
+        "Resources.Subnet: DependsOn must be a string or a list"
+    ]
+
+
+def test_non_string_keys():
+    template = vpc_template()
+    template["Resources"]["VPC"]["Properties"]["X"] = {1: 2}
+    template["Resources"]["VPC"]["Properties"]["Y"] = {1: {"Ref": "Nope"}}
+    assert validate(template) == [
+        "Resources.VPC.Y.1.Ref: unknown parameter or resource Nope"
+    ]
+
+
+def test_references_to_for_each_loops():
+    template = vpc_template()
+    template["Transform"] = "AWS::LanguageExtensions"
+    template["Resources"]["Fn::ForEach::Topics"] = [
+        "Name",
+        ["A", "B"],
+        {"Topic${Name}": {"Type": "AWS::SNS::Topic"}}
+    ]
+    template["Outputs"]["Topics"] = {"Value": {"Ref": "Fn::ForEach::Topics"}}
+    template["Outputs"]["TopicArn"] = {
+        "Value": {"Fn::GetAtt": ["Fn::ForEach::Topics", "TopicArn"]}
+    }
+    assert sorted(validate(template)) == [
+        "Outputs.TopicArn.Value.Fn::GetAtt: can't reference the "
+        "Fn::ForEach loop Fn::ForEach::Topics",
+        "Outputs.Topics.Value.Ref: can't reference the Fn::ForEach loop "
+        "Fn::ForEach::Topics"
+    ]
+
+
+def test_jinja_for_each_template(monkeypatch):
+    monkeypatch.setattr(
+        gpwm.utils,
+        "COMPILED_TEMPLATES",
+        collections.OrderedDict()
+    )
+    template = gpwm.utils.parse_jinja("topics", """
+Transform: AWS::LanguageExtensions
+Resources:
+  Queue:
+    Type: AWS::SQS::Queue
+  Fn::ForEach::Topics:
+    - Name
+    - [{{ names | join(", ") }}]
+    - Topic${Name}:
+        Type: AWS::SNS::Topic
+Outputs:
+  Fn::ForEach::TopicArns:
+    - Name
+    - [{{ names | join(", ") }}]
+    - Topic${Name}:
+        Value:
+          Ref:
+            Fn::Sub: Topic${Name}
+""", {"names": ["A", "B"]})
+    assert sorted(template["Outputs"]) == ["Fn::ForEach::TopicArns", "Queue"]
+    assert validate(template) == []